@@ -0,0 +1,2 @@
+@echo off
+start "" %CD%\..\src\bin\repair_pairing.py
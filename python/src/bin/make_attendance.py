@@ -1,29 +1,13 @@
 #!/usr/bin/env python
+"""
+The same as top_honors.py attendance
+"""
 
-import inspect
 import os
 import sys
-import traceback
-
-def main():
-    try:
-        # http://stackoverflow.com/questions/714063/python-importing-modules-from-parent-folder
-        currentdir = os.path.dirname(
-            os.path.abspath(inspect.getfile(inspect.currentframe())))
-        parentdir = os.path.dirname(currentdir)
-        sys.path.insert(0, os.path.join(parentdir, 'lib'))
-        import pairing
-
-        pairing.make_attendance_sheet()
-
-    except Exception as e:
-        print "Error:"
-        print
-        traceback.print_exc()
-        print
-        print "Type Control-C to Exit"
-        while True:
-            pass
 
 if __name__ == "__main__":
-    main()
+    sys.path.insert(0, os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lib'))
+    import pairing_cli
+    sys.exit(pairing_cli.main('attendance', *sys.argv[1:]))
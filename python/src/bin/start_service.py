@@ -0,0 +1,13 @@
+#!/usr/bin/env python
+"""
+The same as top_honors.py service
+"""
+
+import os
+import sys
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lib'))
+    import pairing_cli
+    sys.exit(pairing_cli.main('service', *sys.argv[1:]))
@@ -81,16 +81,30 @@ from __future__ import absolute_import, division, with_statement
 import collections
 import contextlib
 import datetime
+import gc
+import glob
+import hashlib
+import heapq
 import inspect
 import itertools
+import json
 import logging
+import multiprocessing
 import operator
 import optparse
 import os.path
+import random
 import re
 import sys
+import time
 import traceback
 
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
 # -------------------------------------------------------
 # Data files
 
@@ -100,14 +114,33 @@ ATTENDANCE_FILE = 'Attendance.csv'
 # Output
 PAIRING_FILE = 'Pairing.csv'
 ACTUAL_PAIRING_FILE = 'ActualPairing.csv'
+COMPARISON_FILE = 'Comparison.csv'
 
 # Auxiliary Data
 STUDENT_FILE = os.path.join('data', 'Students.csv')
 TUTOR_FILE   = os.path.join('data', 'Tutors.csv')
 HIST_FILE    = os.path.join('data', 'HistoricalPairings.csv')
 PARAM_FILE   = os.path.join('data', 'Parameters.csv')
+# If this exists, it's used instead of the historical data, student
+# and tutor files, see pairing_sqlite.py
+HIST_DB      = os.path.join('data', 'pairing.db')
+# If this exists, the historical data is kept in one file per season
+# and session in this directory instead, see PartitionedHistoricalData
+HIST_DIR      = os.path.join('data', 'history')
+HIST_MANIFEST = os.path.join(HIST_DIR, 'Manifest.csv')
+# If this exists, the seasons before the current one have been folded
+# into it, see CompactedHistoricalData
+HIST_ARCHIVE = os.path.join('data', 'HistoryArchive.csv')
+CACHE_FILE   = os.path.join('data', 'SolveCache.json')
+# The session's FeatureTable, see load_scoring_index
+INDEX_FILE   = os.path.join('data', 'ScoringIndex.json')
 LOG_FILE     = os.path.join('data', 'log.txt')
 
+# The pairing service, see pairing_service.py
+SERVICE_HOST    = 'localhost'
+SERVICE_PORT    = 8473
+SERVICE_TIMEOUT = 60
+
 ALL_TOPICS   = (('NUMBERS', '#', '#S'),
                 ('WORD PROBLEMS', 'WP'),
                 ('PLACE VALUE', 'PV'),
@@ -142,24 +175,38 @@ logging.basicConfig(format=LOG_FORMAT)
 
 def main(*args):
     opts = getopts(args)
+    if opts.memory_report:
+        start_memory_report()
     if opts.make_files:
         make_files(session=opts.session, date=opts.date)
-    elif opts.run_2012 or opts.run_2013:
+    elif opts.split_history:
+        split_history()
+    elif opts.join_history:
+        join_history()
+    elif opts.compact_history:
+        compact_history()
+    elif opts.run_2012 or opts.run_2013 or opts.run_year:
         given_params = dict((k, getattr(opts, k))
                             for k in ScoreParams.PARAMS
                             if hasattr(opts, k))
         params = ScoreParams(**given_params)
         if opts.run_2012:
-            hist = get_2012_data()
+            year = 2012
+        elif opts.run_2013:
+            year = 2013
         else:
-            hist = get_2013_data()
+            year = opts.run_year
+        first_year = year if opts.history_from is None else opts.history_from
+        hist = DataCatalog().get_data(first_year, year)
         run_pairing_code(opts.date,
                          opts.session,
                          hist=hist,
                          params=params,
                          show_details=opts.verbose)
+    if opts.memory_report:
+        print MEMORY_REPORT.report()
     if opts.spin:
-        spin()
+        wait_to_exit()
 
 def getopts(args=None):
     parser = optparse.OptionParser()
@@ -176,6 +223,19 @@ def getopts(args=None):
     parser.add_option('--make_files',
                       action='store_true',
                       help='make initial csv files')
+    parser.add_option('--split_history',
+                      action='store_true',
+                      help='split the historical data into a file for '
+                      'each season and session')
+    parser.add_option('--join_history',
+                      action='store_true',
+                      help='write the historical data file from the '
+                      'files for each season and session')
+    parser.add_option('--compact_history',
+                      action='store_true',
+                      help='fold the historical data from before the '
+                      'current season into counts for each tutor and '
+                      'student, and each pair of students')
     parser.add_option('--run_2012',
                       action='store_true',
                       help='run for 2012, expecting data to be in the '
@@ -184,14 +244,27 @@ def getopts(args=None):
                       action='store_true',
                       help='run for 2013, expecting data to be in the '
                       'data directory')
+    parser.add_option('--run_year',
+                      type=int,
+                      help='run for the season that starts in this year, '
+                      'expecting data to be in data/<year>')
+    parser.add_option('--history_from',
+                      type=int,
+                      help='with --run_year, also use the history from '
+                      'the seasons since this year')
+    parser.add_option('--memory_report',
+                      action='store_true',
+                      help='show how much memory each phase and each '
+                      'of the main data structures use')
     parser.add_option('--spin',
                       action='store_true',
-                      help="if true, instead of existing, go into an "
-                      "infinite loop to give users a chance to read "
-                      "the output")
+                      help="if true, wait for Enter before exiting, to "
+                      "give users a chance to read the output")
     for param in ScoreParams.PARAMS:
+        default = ScoreParams.PARAMS[param]
         parser.add_option('--' + param,
-                          default=ScoreParams.PARAMS[param])
+                          type='string' if isinstance(default, str) else 'int',
+                          default=default)
 
     (opts, args) = parser.parse_args(list(args) if len(args) > 0 else None)
 
@@ -216,23 +289,24 @@ def from_windows(func):
             log_to_file()
             cmdline = ' '.join(sys.argv)
             logging.info("Running : %s", cmdline)
+            if '--memory_report' in sys.argv:
+                sys.argv.remove('--memory_report')
+                start_memory_report()
             func()
+            if MEMORY_REPORT is not None:
+                print MEMORY_REPORT.report()
             logging.info("Finished running %s", cmdline)
     return wrapped_func
 
 @from_windows
 def make_attendance_sheet(date=None):
     # Validate other data
-    hist = HistoricalData().from_csv(HIST_FILE)
-    allstds = Students().from_csv(STUDENT_FILE)
-    alltuts = Tutors().from_csv(TUTOR_FILE)
+    hist = open_history()
+    allstds = open_students()
+    alltuts = open_tutors()
     hist.validate(allstds, alltuts)
 
-    Attendance.to_csv(ATTENDANCE_FILE,
-                      Students().from_csv(STUDENT_FILE),
-                      Tutors().from_csv(TUTOR_FILE),
-                      HistoricalData().from_csv(HIST_FILE),
-                      date=date)
+    Attendance.to_csv(ATTENDANCE_FILE, allstds, alltuts, hist, date=date)
 
     # Validate what we just wrote
     (tutors, student_topics, date) = Attendance.from_csv(ATTENDANCE_FILE)
@@ -241,72 +315,178 @@ def make_attendance_sheet(date=None):
 
 @from_windows
 def run_pairing():
-    hist = HistoricalData().from_csv(HIST_FILE)
-    allstds = Students().from_csv(STUDENT_FILE)
-    alltuts = Tutors().from_csv(TUTOR_FILE)
-    # Confirm that the historical data has only recognized tutors and
-    # students
-    hist.validate(allstds, alltuts)
-    params = ScoreParams.from_csv(PARAM_FILE)
+    """
+    Find a pairing for Attendance.csv.  run_pairing --solver NAME uses
+    that solver instead of the one in Parameters.csv.
+    """
+    solver = pop_argv_option('--solver')
     (tutors, student_topics, date) = Attendance.from_csv(ATTENDANCE_FILE)
     session = get_session_from_cwd()
-    hist = hist.get_data_before(date, session)
-    Attendance.validate(tutors, student_topics, alltuts, allstds,
-                        ATTENDANCE_FILE)
 
     print "Running ... "
-    pairing = good_pairing(hist, student_topics.keys(), tutors,
-                           student_topics, params)
-    # get score
-    (score, annotations) = get_score(pairing, hist, student_topics,
-                                     params=params)
+    # The order of the students matters when there are ties
+    students = student_topics.keys()
+    reply = call_service('solve', tutors=tutors, students=students,
+                         student_topics=student_topics, date=date,
+                         solver=solver)
+    if reply is None:
+        (pairing, score, annotations) = solve_attendance(
+            load_session(date=date, session=session), tutors, students,
+            student_topics, cache=SolveCache(CACHE_FILE), solver=solver)
+    else:
+        pairing = [tuple(p) for p in reply['pairing']]
+        score = reply['score']
+        annotations = annotations_from_json(reply['annotations'])
     # output to a file
     PairingFile.to_csv(PAIRING_FILE, pairing, student_topics, annotations,
                        score=score, date=date)
 
     # validate what we just wrote
     pairs = PairingFile.from_csv(PAIRING_FILE, session)
-    PairingFile.validate(pairs, allstds, alltuts, ALL_TOPICS)
+    PairingFile.validate(pairs, open_students(), open_tutors(), ALL_TOPICS)
+
+@from_windows
+def repair_pairing():
+    """
+    Like run_pairing, but starts from the pairing that's already in
+    the pairing file, so that people who arrive late or leave early
+    don't reshuffle students who are already seated.  Only the groups
+    that change are rescored; the others keep the Score and Reason
+    already in the file.
+    """
+    (tutors, student_topics, date) = Attendance.from_csv(ATTENDANCE_FILE)
+    session = get_session_from_cwd()
+    current = [(p.tutor, p.student, p.topic)
+               for p in PairingFile.from_csv(PAIRING_FILE, session)]
+    old_annotations = PairingFile.read_annotations(PAIRING_FILE)
+
+    print "Repairing ... "
+    students = student_topics.keys()
+    reply = call_service('repair', tutors=tutors, students=students,
+                         student_topics=student_topics, date=date,
+                         current=current,
+                         annotations=annotations_to_json(old_annotations))
+    if reply is None:
+        (pairing, score, annotations, changed) = repair_attendance(
+            load_session(date=date, session=session), tutors, students,
+            student_topics, current, old_annotations)
+    else:
+        pairing = [tuple(p) for p in reply['pairing']]
+        score = reply['score']
+        annotations = annotations_from_json(reply['annotations'])
+        changed = set(reply['changed'])
+    print "Changed {0} of {1} tutors".format(
+        len(changed.intersection(tutors)), len(tutors))
+    PairingFile.to_csv(PAIRING_FILE, pairing, student_topics, annotations,
+                       score=score, date=date)
+
+    # validate what we just wrote
+    pairs = PairingFile.from_csv(PAIRING_FILE, session)
+    PairingFile.validate(pairs, open_students(), open_tutors(), ALL_TOPICS)
 
 @from_windows
 def save_pairing():
     session = get_session_from_cwd()
     pairs = PairingFile.from_csv(PAIRING_FILE, session)
-    allstds = Students().from_csv(STUDENT_FILE)
-    alltuts = Tutors().from_csv(TUTOR_FILE)
+    allstds = open_students()
+    alltuts = open_tutors()
     PairingFile.validate(pairs, allstds, alltuts, ALL_TOPICS)
-    hist = HistoricalData().from_csv(HIST_FILE)
+    hist = open_history()
     # XXX Should we remove from the historical data any existing pairs
     # for this date?  We can get the date from any of the pairs read
     # from the PairingFile.
     hist.add_list(pairs)
-    with open(HIST_FILE, 'w') as fd:
-        fd.write(hist.to_csv())
-        fd.write("\n")
+    if not os.path.exists(HIST_DB) and not os.path.exists(HIST_MANIFEST):
+        with open(HIST_FILE, 'w') as fd:
+            fd.write(hist.to_csv())
+            fd.write("\n")
+    update_scoring_index(hist, session, pairs)
 
 @from_windows
 def score_pairing():
-    hist = HistoricalData().from_csv(HIST_FILE)
-    allstds = Students().from_csv(STUDENT_FILE)
-    alltuts = Tutors().from_csv(TUTOR_FILE)
-    params = ScoreParams.from_csv(PARAM_FILE)
     (tutors, student_topics, date) = Attendance.from_csv(ATTENDANCE_FILE)
-    Attendance.validate(tutors, student_topics, alltuts, allstds,
-                        ATTENDANCE_FILE)
     session = get_session_from_cwd()
     pairs = PairingFile.from_csv(PAIRING_FILE, session)
-    PairingFile.validate(pairs, allstds, alltuts, ALL_TOPICS)
+    PairingFile.validate(pairs, open_students(), open_tutors(), ALL_TOPICS)
     pairing = [(pair.tutor, pair.student) for pair in pairs]
-    (score, annotations) = get_score(pairing, hist, student_topics,
-                                     params=params)
+    reply = call_service('score', tutors=tutors,
+                         student_topics=student_topics, date=date,
+                         pairing=pairing)
+    if reply is None:
+        (score, annotations) = score_attendance(
+            load_session(), tutors, student_topics, pairing)
+    else:
+        score = reply['score']
+        annotations = annotations_from_json(reply['annotations'])
     PairingFile.to_csv(PAIRING_FILE, pairing, student_topics, annotations,
                        score=score, date=date)
 
 @from_windows
-def score_historical_pairing(date=20131109):
-    hist = HistoricalData().from_csv(HIST_FILE)
+def compare_pairings():
+    """
+    Score several candidate pairings for the attendance and rank them.
+    The candidates are the files given on the command line, or every
+    Pairing*.csv in the session directory, and a file can have more
+    than one candidate in it (see PairingFile.read_candidates).
+
+    The changes, overall and for each tutor, are against the first
+    candidate (Pairing.csv, if we looked for the files).  Files with
+    no pairs are skipped, and it's an error if there are no candidates.
+    """
+    (tutors, student_topics, date) = Attendance.from_csv(ATTENDANCE_FILE)
+    session = get_session_from_cwd()
+    filenames = sys.argv[1:]
+    if len(filenames) == 0:
+        filenames = sorted(glob.glob('Pairing*.csv'),
+                           key=lambda fn: (fn != PAIRING_FILE, fn))
+    allstds = open_students()
+    alltuts = open_tutors()
+    names = []
+    pairings = []
+    for fn in filenames:
+        for (name, pairs) in PairingFile.read_candidates(fn, session):
+            if len(pairs) == 0:
+                print "Skipping {0}, which has no pairs".format(name)
+                continue
+            PairingFile.validate(pairs, allstds, alltuts, ALL_TOPICS)
+            names.append(name)
+            pairings.append([(pair.tutor, pair.student) for pair in pairs])
+    if len(pairings) == 0:
+        raise ValueError("No candidate pairings found in {0}".format(
+            ', '.join(filenames) if filenames else 'Pairing*.csv'))
+    reply = call_service('compare', tutors=tutors,
+                         student_topics=student_topics, date=date,
+                         pairings=pairings)
+    if reply is None:
+        results = compare_attendance(load_session(), tutors, student_topics,
+                                     pairings)
+    else:
+        results = reply['results']
+    report = comparison_report(names, results)
+    print report
+    with open(COMPARISON_FILE, 'w') as fd:
+        fd.write(report)
+        fd.write("\n")
+
+@from_windows
+def score_historical_pairing():
+    """
+    Write the pairing saved in the historical data for a date to the
+    actual pairing file, with its score.  score_last_pairing --date
+    DATE scores that date, and by default it's the last date saved
+    for this session.
+    """
+    date = pop_argv_option('--date')
+    hist = open_history()
     params = ScoreParams.from_csv(PARAM_FILE)
     session = get_session_from_cwd()
+    if date is None:
+        dates = [pair.date for pair in hist.get_matches(session=session)]
+        if len(dates) == 0:
+            raise ValueError("No pairings have been saved for session "
+                             "{0}".format(session))
+        date = max(dates)
+    date = int(date)
     (score, annotations) = score_historical(hist, date, session,
                                             params=params)
 
@@ -314,6 +494,519 @@ def score_historical_pairing(date=20131109):
     PairingFile.to_csv(ACTUAL_PAIRING_FILE, pairing, student_topics, annotations,
                        score=score, date=date)
 
+# -------------------------------------------------------
+# These functions do the work behind the API functions above.  They
+# run either in this process or in the pairing service (see
+# pairing_service.py), which keeps the data files loaded between
+# commands.
+#
+
+def load_session(directory=os.curdir, date=None, session=None):
+    """
+    Read the historical data, students, tutors and score parameters
+    for the session in directory, and confirm that the historical
+    data only has recognized tutors and students.
+
+    If date is given, only keep the historical data for session from
+    before date.
+
+    @return a tuple of (hist, students, tutors, params)
+    """
+    with memory_phase('load'):
+        hist = open_history(directory)
+        allstds = open_students(directory)
+        alltuts = open_tutors(directory)
+        # Narrow it down first, so we don't read history we won't use
+        if date is not None:
+            hist = hist.get_data_before(date, session)
+            load_scoring_index(hist, session, directory)
+        hist.validate(allstds, alltuts)
+        params = ScoreParams.from_csv(os.path.join(directory, PARAM_FILE))
+    track_memory('HistoricalData.data', hist.data)
+    track_memory('Students', allstds.data)
+    track_memory('Tutors', alltuts.data)
+    return (hist, allstds, alltuts, params)
+
+def open_history(directory=os.curdir):
+    """
+    The historical data for the session in directory, from the sqlite
+    database if there is one, or the partitioned files if there are
+    some, otherwise from the csv file (and the archive of old seasons,
+    if it's been compacted).  Adding to the sqlite or partitioned
+    versions saves them; the csv version has to be written out.
+    """
+    if os.path.exists(os.path.join(directory, HIST_DB)):
+        import pairing_sqlite
+        return pairing_sqlite.SqliteHistoricalData(
+            pairing_sqlite.connect(os.path.join(directory, HIST_DB)))
+    if os.path.exists(os.path.join(directory, HIST_MANIFEST)):
+        return PartitionedHistoricalData(os.path.join(directory, HIST_DIR))
+    if os.path.exists(os.path.join(directory, HIST_ARCHIVE)):
+        return CompactedHistoricalData(
+            archive=HistoryArchive().from_csv(
+                os.path.join(directory, HIST_ARCHIVE))).from_csv(
+                    os.path.join(directory, HIST_FILE))
+    return HistoricalData().from_csv(os.path.join(directory, HIST_FILE))
+
+def open_students(directory=os.curdir):
+    if os.path.exists(os.path.join(directory, HIST_DB)):
+        import pairing_sqlite
+        return pairing_sqlite.SqliteStudents(
+            pairing_sqlite.connect(os.path.join(directory, HIST_DB)))
+    return Students().from_csv(os.path.join(directory, STUDENT_FILE))
+
+def open_tutors(directory=os.curdir):
+    if os.path.exists(os.path.join(directory, HIST_DB)):
+        import pairing_sqlite
+        return pairing_sqlite.SqliteTutors(
+            pairing_sqlite.connect(os.path.join(directory, HIST_DB)))
+    return Tutors().from_csv(os.path.join(directory, TUTOR_FILE))
+
+def load_scoring_index(hist, session, directory=os.curdir):
+    """
+    If the scoring index in directory was made from exactly the pairs
+    in hist, the historical data for session, use its FeatureTable for
+    hist rather than working it out again.
+
+    This only saves building the FeatureTable.  The pairs themselves
+    are still read every time: to narrow them down to before the date,
+    to check the fingerprint, to validate them, and for the
+    annotations on the pairing's score.  So startup still grows with
+    the history, just more slowly.
+    """
+    filename = os.path.join(directory, INDEX_FILE)
+    if not os.path.exists(filename):
+        return
+    with open(filename) as fd:
+        index = json.load(fd)
+    if (index['session'] != session.decode('utf-8') or
+        index['fingerprint'] != hist.fingerprint):
+        logging.info("Not using %s, it doesn't match the historical data",
+                     filename)
+        return
+    hist.features = FeatureTable.from_json(index['features'])
+
+def update_scoring_index(hist, session, pairs, directory=os.curdir):
+    """
+    Add pairs, which were just added to hist (the historical data for
+    all sessions), to the scoring index for session.  If the index
+    wasn't up to date with hist before the pairs were added (or is for
+    another session), it's made again from all of session's history.
+    """
+    filename = os.path.join(directory, INDEX_FILE)
+    session_hist = hist.get_session_data(session)
+    new_pairs = [pair for pair in pairs if pair.session == session]
+    before = ((session_hist.digest - sum(pair.digest() for pair in new_pairs))
+              % CsvList.DIGEST_MODULUS)
+    table = None
+    if os.path.exists(filename):
+        with open(filename) as fd:
+            index = json.load(fd)
+        if (index['session'] == session.decode('utf-8') and
+            index['fingerprint'] == '{0:032x}'.format(before)):
+            table = FeatureTable.from_json(index['features'])
+            table.add_pairs(new_pairs)
+    if table is None:
+        logging.info("Making %s from scratch", filename)
+        table = FeatureTable(session_hist)
+    with open(filename, 'w') as fd:
+        json.dump({'session' : session,
+                   'fingerprint' : session_hist.fingerprint,
+                   'features' : table.to_json()}, fd, sort_keys=True)
+        fd.write("\n")
+
+def solve_attendance(data, tutors, students, student_topics, cache=None,
+                     solver=None):
+    """
+    Find a good pairing for the attendance, with the solver in the
+    score parameters (see solve_pairing).
+
+    If this exact problem has been solved before, the answer comes
+    from the cache.  Otherwise, if the cache has a pairing for mostly
+    the same people (see SolveCache.closest), it's given to the solver
+    as a seed to start from, if the solver takes one (see
+    register_solver).  good_pairing fixes the seed up for who's here
+    and keeps it if it scores better than solving afresh:
+
+    >>> import tempfile
+    >>> flags = dict((f, False) for f in Pair.BOOL_FIELDS)
+    >>> hist = HistoricalData(
+    ...     [Pair(20130105 + 7 * w, 'am', 'Ann', 'Di', **flags)
+    ...      for w in range(3)] +
+    ...     [Pair(20130105 + 7 * w, 'am', 'Ed', 'Bo', **flags)
+    ...      for w in range(3)] +
+    ...     [Pair(20130126, 'am', 'Ann', 'Bo', **flags)])
+    >>> data = (hist, Students([Student(name='Bo'), Student(name='Di')]),
+    ...         Tutors([Tutor(full_name=t) for t in ('Ann', 'Cy', 'Ed')]),
+    ...         ScoreParams())
+    >>> topics = {'Bo': '#', 'Di': 'WP'}
+    >>> with quiet_stdout():
+    ...     fresh = solve_attendance(data, ['Ann', 'Cy'], ['Bo', 'Di'], topics)
+    >>> fresh[:2]
+    ([('Ann', 'Bo'), ('Cy', 'Di')], 1)
+    >>> cache = SolveCache(os.path.join(tempfile.mkdtemp(), 'cache.json'))
+    >>> base = cache.base_fingerprint(hist, data[3])
+    >>> cache.put('earlier', base, ['Ann', 'Cy', 'Ed'], topics,
+    ...           [('Ann', 'Di'), ('Cy', 'Bo')], 3, {})
+    >>> with quiet_stdout():
+    ...     seeded = solve_attendance(data, ['Ann', 'Cy'], ['Bo', 'Di'],
+    ...                               topics, cache=cache)
+    >>> seeded[:2]
+    ([('Ann', 'Di'), ('Cy', 'Bo')], 3)
+
+    A solver that doesn't take a seed solves afresh.  Either way, the
+    solver asked for is the one that's used:
+
+    >>> @register_solver('first_tutor')
+    ... def solve_first_tutor(hist, students, tutors, student_topics,
+    ...                       params, deadline):
+    ...     return ([(tutors[0], s) for s in students], {})
+    >>> data = (HistoricalData(), Students([Student(name='Bo')]),
+    ...         Tutors([Tutor(full_name='Ann'), Tutor(full_name='Cy')]),
+    ...         ScoreParams(solver='first_tutor'))
+    >>> cache = SolveCache(os.path.join(tempfile.mkdtemp(), 'cache.json'))
+    >>> base = cache.base_fingerprint(data[0], data[3])
+    >>> cache.put('earlier', base, ['Ann', 'Cy'], {'Bo': '#'},
+    ...           [('Cy', 'Bo')], 0, {})
+    >>> cache.closest(base, ['Cy', 'Ann'], {'Bo': '#'})['pairing']
+    [['Cy', 'Bo']]
+    >>> solve_attendance(data, ['Cy', 'Ann'], ['Bo'], {'Bo': '#'},
+    ...                  cache=cache)[0]
+    [('Cy', 'Bo')]
+    >>> del SOLVERS['first_tutor']
+
+    @param data: the tuple returned by load_session, with only the
+    historical data from before this week
+
+    @param cache: a SolveCache, or None to always solve from scratch
+
+    @param solver: the name of a solver to use instead of the one in
+    the score parameters
+
+    @return a tuple of (pairing, score, annotations)
+    """
+    (hist, allstds, alltuts, params) = data
+    if solver is not None:
+        params = params.copy(solver=solver)
+    Attendance.validate(tutors, student_topics, alltuts, allstds,
+                        ATTENDANCE_FILE)
+    if cache is None:
+        with memory_phase('solve'):
+            (pairing, _) = solve_pairing(hist, students, tutors,
+                                         student_topics, params)
+        (score, annotations) = get_score(pairing, hist, student_topics,
+                                         params=params)
+        track_memory('annotations', annotations)
+        return (pairing, score, annotations)
+
+    base = cache.base_fingerprint(hist, params)
+    key = cache.key(base, tutors, students, student_topics)
+    entry = cache.get(key)
+    if entry is not None:
+        print "Using the pairing from the last time this was run"
+        return ([tuple(p) for p in entry['pairing']], entry['score'],
+                annotations_from_json(entry['annotations']))
+    seed = None
+    if getattr(SOLVERS.get(params.solver), 'takes_seed', False):
+        entry = cache.closest(base, tutors, student_topics)
+        if entry is not None:
+            print "Starting from a similar pairing"
+            seed = [tuple(p) for p in entry['pairing']]
+    with memory_phase('solve'):
+        (pairing, _) = solve_pairing(hist, students, tutors,
+                                     student_topics, params, seed=seed)
+    (score, annotations) = get_score(pairing, hist, student_topics,
+                                     params=params)
+    track_memory('annotations', annotations)
+    cache.put(key, base, tutors, student_topics, pairing, score, annotations)
+    return (pairing, score, annotations)
+
+def repair_attendance(data, tutors, students, student_topics, current,
+                      old_annotations):
+    """
+    Repair the current pairing, a list of (tutor, student, topic), for
+    the attendance using good_repair.  Groups that don't change keep
+    their annotations from old_annotations.
+
+    @param data: like for solve_attendance
+
+    @return a tuple of (pairing, score, annotations, changed), where
+    changed is the set of tutors whose groups changed
+    """
+    (hist, allstds, alltuts, params) = data
+    Attendance.validate(tutors, student_topics, alltuts, allstds,
+                        ATTENDANCE_FILE)
+    with memory_phase('repair'):
+        (pairing, changed) = good_repair(hist,
+                                         [(t, s) for (t, s, _) in current],
+                                         students, tutors, student_topics,
+                                         params)
+    # A student whose topic changed can change their group's score too
+    changed.update(t for (t, s, topic) in current
+                   if s in student_topics and topic != student_topics[s])
+    annotations = {}
+    window = HistoryWindow.of(hist, params)
+    for (tutor, group) in HistoricalData.pairing_by_tutor(pairing).items():
+        if (tutor not in changed and
+            all((tutor, s) in old_annotations for s in group)):
+            annotations.update(((tutor, s), old_annotations[(tutor, s)])
+                               for s in group)
+            continue
+        (_, group_ann) = get_group_score(
+            hist, tutor, group,
+            [normalize_topic(student_topics[s]) for s in group],
+            params=params, window=window)
+        for student in group:
+            annotations[(tutor, student)] = group_ann.get((tutor, student),
+                                                          [])
+    score = sum(a[0] for ann in annotations.itervalues() for a in ann)
+    return (pairing, score, annotations, changed)
+
+def score_attendance(data, tutors, student_topics, pairing):
+    """
+    Score the pairing for the attendance.
+
+    @param data: the tuple returned by load_session.  Like
+    score_pairing always has, this scores against all of the
+    historical data.
+
+    @return a tuple of (score, annotations)
+    """
+    (hist, allstds, alltuts, params) = data
+    Attendance.validate(tutors, student_topics, alltuts, allstds,
+                        ATTENDANCE_FILE)
+    with memory_phase('score'):
+        (score, annotations) = get_score(pairing, hist, student_topics,
+                                         params=params)
+    track_memory('annotations', annotations)
+    return (score, annotations)
+
+def compare_attendance(data, tutors, student_topics, pairings):
+    """
+    Score each of a list of candidate pairings for the attendance.
+
+    @param data: like for score_attendance
+
+    @return the list returned by score_candidates
+    """
+    (hist, allstds, alltuts, params) = data
+    Attendance.validate(tutors, student_topics, alltuts, allstds,
+                        ATTENDANCE_FILE)
+    return score_candidates(hist, student_topics, pairings, params=params)
+
+def comparison_report(names, results):
+    """
+    A csv report of candidate pairings, best score first, and then
+    the score for each tutor in each candidate.  Changes are against
+    the first candidate.
+
+    @param names: the name of each candidate
+
+    @param results: (score, tutor_scores) for each candidate, as
+    returned by score_candidates
+    """
+    (base_score, base_tutors) = results[0]
+    ranked = sorted(range(len(results)), key=lambda ii: (-results[ii][0], ii))
+    lines = [','.join(('Rank', 'Candidate', 'Score', 'Change'))]
+    for (rank, ii) in enumerate(ranked):
+        lines.append(','.join((str(rank + 1), names[ii],
+                               str(results[ii][0]),
+                               '{0:+d}'.format(results[ii][0] - base_score))))
+    lines.append('')
+    lines.append(','.join(['Tutor', names[0]] +
+                          [names[ii] + ' Change' for ii in ranked if ii != 0]))
+    all_tutors = sorted(set(tutor
+                            for (_, tutor_scores) in results
+                            for tutor in tutor_scores))
+    for tutor in all_tutors:
+        base = base_tutors.get(tutor, 0)
+        lines.append(','.join(
+            [tutor, str(base)] +
+            ['{0:+d}'.format(results[ii][1].get(tutor, 0) - base)
+             for ii in ranked if ii != 0]))
+    return '\n'.join(lines)
+
+def call_service(command, **payload):
+    """
+    Ask the pairing service to run command for the session in the
+    current directory.  Returns the reply, or None if the service
+    isn't running (or doesn't serve this directory), in which case the
+    caller should do the work itself.
+
+    If the service is running but fails, or doesn't answer within
+    SERVICE_TIMEOUT seconds, that's an error: doing the work here
+    would race the service, which may still be working on it.
+    """
+    # These take longer to import than the rest of this module, and are
+    # only needed here
+    import errno
+    import socket
+    import urllib2
+
+    payload['directory'] = os.path.abspath(os.curdir)
+    request = urllib2.Request(
+        'http://{0}:{1}/{2}'.format(SERVICE_HOST, SERVICE_PORT, command),
+        json.dumps(payload), {'Content-Type': 'application/json'})
+    try:
+        reply = urllib2.urlopen(request, timeout=SERVICE_TIMEOUT)
+        result = from_json(json.load(reply))
+    except urllib2.HTTPError as e:
+        error = json.loads(e.read())['error']
+        if e.code == 403:
+            logging.info("Pairing service won't run %s here (%s), running "
+                         "it here", command, error)
+            return None
+        raise RuntimeError("Pairing service failed:\n{0}".format(error))
+    except (urllib2.URLError, socket.error) as e:
+        reason = getattr(e, 'reason', e)
+        if getattr(reason, 'errno', None) != errno.ECONNREFUSED:
+            raise RuntimeError("Pairing service didn't answer {0}: {1}".format(
+                command, reason))
+        logging.info("Pairing service is not running, running %s here",
+                     command)
+        return None
+    logging.info("Ran %s in the pairing service", command)
+    return result
+
+def from_json(obj):
+    """
+    json gives back unicode strings, but everything else here uses
+    utf-8 encoded strs (which is what's in the csv files).
+
+    >>> from_json({u'a': [u'Jos\\xe9e', 1]})
+    {'a': ['Jos\\xc3\\xa9e', 1]}
+    """
+    if isinstance(obj, unicode):
+        return obj.encode('utf-8')
+    if isinstance(obj, list):
+        return [from_json(o) for o in obj]
+    if isinstance(obj, dict):
+        return dict((from_json(k), from_json(v)) for (k, v) in obj.items())
+    return obj
+
+def annotations_to_json(annotations):
+    """
+    Annotations are keyed by (tutor, student), which json can't do, so
+    turn them into a list of [tutor, student, [[points, reason], ...]]
+    """
+    return [[tutor, student, annotations[(tutor, student)]]
+            for (tutor, student) in annotations]
+
+def annotations_from_json(ann_list):
+    return dict(((tutor, student), [tuple(a) for a in ann])
+                for (tutor, student, ann) in ann_list)
+
+class SolveCache(object):
+    """
+    An on-disk cache of solved pairings, so that running the pairing
+    again for the same attendance (say, after undoing an edit) doesn't
+    have to solve it again.
+
+    Entries are keyed on a fingerprint of everything the solver looks
+    at: the historical data before the date, the score parameters,
+    and the tutors, students and topics in the order they were given.
+    Only the most recently used MAX_ENTRIES are kept.
+
+    >>> import tempfile
+    >>> cache = SolveCache(os.path.join(tempfile.mkdtemp(), 'cache.json'))
+    >>> base = cache.base_fingerprint(HistoricalData(), ScoreParams())
+    >>> key = cache.key(base, ['Ann'], ['Bo'], {'Bo': '#'})
+    >>> cache.get(key) is None
+    True
+    >>> cache.put(key, base, ['Ann'], {'Bo': '#'}, [('Ann', 'Bo')], 0, {})
+    >>> cache.get(key)['pairing']
+    [['Ann', 'Bo']]
+    >>> cache.closest(base, ['Ann'], {'Bo': '#', 'Di': '#'},
+    ...               min_similarity=0.5)['pairing']
+    [['Ann', 'Bo']]
+    >>> cache.closest(base, ['Ann', 'Cy'], {'Bo': '#', 'Di': '#'}) is None
+    True
+    """
+    MAX_ENTRIES = 20
+    # How much of an entry has to be the same for closest to use it
+    MIN_SIMILARITY = 0.8
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    @classmethod
+    def base_fingerprint(cls, hist, params):
+        """
+        A fingerprint of the historical data and the score parameters
+        """
+        digest = hashlib.sha1(hist.fingerprint)
+        digest.update(params.to_csv())
+        return digest.hexdigest()
+
+    @classmethod
+    def key(cls, base, tutors, students, student_topics):
+        digest = hashlib.sha1(base)
+        digest.update(json.dumps([list(tutors),
+                                  [(s, student_topics[s]) for s in students]]))
+        return digest.hexdigest()
+
+    def load(self):
+        if not os.path.exists(self.filename):
+            return []
+        with open(self.filename) as fd:
+            return from_json(json.load(fd))
+
+    def save(self, entries):
+        with open(self.filename, 'w') as fd:
+            json.dump(entries[-self.MAX_ENTRIES:], fd)
+
+    def get(self, key):
+        """
+        Return the entry for key, or None if there isn't one
+        """
+        entries = self.load()
+        for (ii, entry) in enumerate(entries):
+            if entry['key'] == key:
+                # Move it to the end, as the most recently used
+                entries.append(entries.pop(ii))
+                self.save(entries)
+                return entry
+        return None
+
+    def closest(self, base, tutors, student_topics, min_similarity=None):
+        """
+        Return the entry, with the same historical data and score
+        parameters, that's the most similar to the tutors and students
+        given, or None if none of them are at least min_similarity
+        (by default MIN_SIMILARITY) similar.  The similarity is the
+        number of tutors and students (with the same topics) in both,
+        over the number in either.
+        """
+        if min_similarity is None:
+            min_similarity = self.MIN_SIMILARITY
+        people = (set(('tutor', t) for t in tutors) |
+                  set(('student', s, t) for (s, t) in student_topics.items()))
+        best = None
+        best_similarity = min_similarity
+        for entry in self.load():
+            if entry['base'] != base:
+                continue
+            other = (set(('tutor', t) for t in entry['tutors']) |
+                     set(('student', s, t)
+                         for (s, t) in entry['student_topics'].items()))
+            similarity = len(people & other) / max(1, len(people | other))
+            if similarity >= best_similarity:
+                best = entry
+                best_similarity = similarity
+        return best
+
+    def put(self, key, base, tutors, student_topics, pairing, score,
+            annotations):
+        entries = [e for e in self.load() if e['key'] != key]
+        entries.append({'key' : key,
+                        'base' : base,
+                        'tutors' : list(tutors),
+                        'student_topics' : student_topics,
+                        'pairing' : pairing,
+                        'score' : score,
+                        'annotations' : annotations_to_json(annotations)})
+        self.save(entries)
+
 # -------------------------------------------------------
 # These functions capture the real main code.  Main is just a switch
 # around either run_pairing_code or make_files
@@ -340,20 +1033,26 @@ def make_files(date, session):
     with open(HIST_FILE, 'w') as fd:
         fd.write(hist.to_csv())
         fd.write("\n")
-    if (hist != HistoricalData().from_csv(HIST_FILE)):
-        raise RuntimeError("Error dumping historical data")
+    written = HistoricalData().from_csv(HIST_FILE)
+    if hist != written:
+        raise RuntimeError("Error dumping historical data:\n" +
+                           hist.diff_report(written))
     with open(STUDENT_FILE, 'w') as fd:
         stds = Students(Student(name=n) for n in hist.all_students)
         fd.write(stds.to_csv())
         fd.write("\n")
-    if stds != Students().from_csv(STUDENT_FILE):
-        raise RuntimeError("Error dumping student data")
+    written = Students().from_csv(STUDENT_FILE)
+    if stds != written:
+        raise RuntimeError("Error dumping student data:\n" +
+                           stds.diff_report(written))
     with open(TUTOR_FILE, 'w') as fd:
         tuts = Tutors(Tutor(t) for t in set(p.tutor for p in hist.data))
         fd.write(tuts.to_csv())
         fd.write("\n")
-    if tuts != Tutors().from_csv(TUTOR_FILE):
-        raise RuntimeError("Error dumping tutor data")
+    written = Tutors().from_csv(TUTOR_FILE)
+    if tuts != written:
+        raise RuntimeError("Error dumping tutor data:\n" +
+                           tuts.diff_report(written))
 
 # -------------------------------------------------------
 
@@ -370,13 +1069,18 @@ def run_pairing_code(date=20130413,
     print "Calculating ... "
     print
 
-    (actual, student_topics) = hist.get_pairing(date, session)
-    (actual_score, actual_ann) = score_historical(hist, date, session, params)
+    with memory_phase('load'):
+        (actual, student_topics) = hist.get_pairing(date, session)
+        (actual_score, actual_ann) = score_historical(hist, date, session,
+                                                      params)
+    track_memory('HistoricalData.data', hist.data)
 
-    best = good_historical_score(hist, date, session, params)
-    (best_score, best_ann) = get_score(
-        best, hist.get_data_before(date, session),
-        student_topics)
+    with memory_phase('solve'):
+        best = good_historical_score(hist, date, session, params)
+        (best_score, best_ann) = get_score(
+            best, hist.get_data_before(date, session),
+            student_topics)
+    track_memory('annotations', best_ann)
 
     print " ... Done"
     print
@@ -410,12 +1114,32 @@ def run_safely(spin=True, log_level=logging.ERROR):
         logging.log(log_level, traceback.format_exc())
         if spin:
             print
-            spin()
+            wait_to_exit()
         raise
 
-def spin():
-    print "Type Control-C to Exit"
-    while True:
+@contextlib.contextmanager
+def quiet_stdout():
+    """
+    Throw away whatever is printed in the with block
+    """
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = stdout
+
+def wait_to_exit():
+    """
+    Wait for the user to press Enter, so that the window a command was
+    started in doesn't close before they've read the output.  This
+    blocks on the input, so it doesn't use any cpu while it waits.
+    """
+    print "Press Enter to Exit"
+    try:
+        raw_input()
+    except (EOFError, KeyboardInterrupt):
         pass
 
 def log_to_file(file=LOG_FILE):
@@ -433,6 +1157,20 @@ def log_to_file(file=LOG_FILE):
     fh.setFormatter(logging.Formatter(LOG_FORMAT))
     logger.addHandler(fh)
 
+def pop_argv_option(option):
+    """
+    If sys.argv has option followed by a value, take them both out of
+    sys.argv and return the value, otherwise return None
+    """
+    if option not in sys.argv:
+        return None
+    index = sys.argv.index(option)
+    if index + 1 >= len(sys.argv):
+        raise ValueError("{0} needs a value".format(option))
+    value = sys.argv[index + 1]
+    del sys.argv[index:index + 2]
+    return value
+
 def get_session_from_cwd():
     return os.path.basename(os.path.abspath(os.path.curdir))
 
@@ -441,6 +1179,135 @@ def get_today():
 
 # -------------------------------------------------------
 
+# The MemoryReport for this run, if one was asked for with
+# --memory_report
+MEMORY_REPORT = None
+
+def start_memory_report():
+    global MEMORY_REPORT
+    MEMORY_REPORT = MemoryReport()
+    return MEMORY_REPORT
+
+@contextlib.contextmanager
+def memory_phase(name):
+    """
+    Record what happens inside this as a phase of the MemoryReport, if
+    there is one
+    """
+    if MEMORY_REPORT is None:
+        yield
+    else:
+        with MEMORY_REPORT.phase(name):
+            yield
+
+def track_memory(name, obj):
+    """
+    Add obj to the MemoryReport, if there is one
+    """
+    if MEMORY_REPORT is not None:
+        MEMORY_REPORT.track(name, obj)
+
+class MemoryReport(object):
+    """
+    Where the memory goes, to see which structures matter most as the
+    history gets bigger.  It has:
+
+    - For each phase (loading the data, solving, ...), the peak
+      resident memory afterwards and how much the phase raised it
+      (where the resource module exists, which isn't on Windows), and
+      the types with the most new objects during the phase.
+
+    - For each structure that was tracked, how many objects it's
+      made of and roughly how many bytes they take up (see
+      sys.getsizeof).  An object that's part of more than one
+      structure is only counted in the first one tracked, so, for
+      example, the data_by_key index is only charged for the index
+      itself, not for the Pairs that are already in HistoricalData.
+    """
+    TOP_TYPES = 5
+
+    def __init__(self):
+        self.phases = []
+        self.structures = []
+        self._seen = set()
+
+    @classmethod
+    def peak_kb(cls):
+        if resource is None:
+            return None
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    @classmethod
+    def type_counts(cls):
+        """
+        The number of objects of each type that the garbage collector
+        knows about (which leaves out things like strs and ints)
+        """
+        counts = collections.defaultdict(int)
+        for obj in gc.get_objects():
+            counts[type(obj).__name__] += 1
+        return counts
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        before = self.peak_kb()
+        types = self.type_counts()
+        start = time.time()
+        yield
+        seconds = time.time() - start
+        after = self.peak_kb()
+        growth = self.type_counts()
+        for (typ, count) in types.iteritems():
+            growth[typ] -= count
+        top = sorted(((count, typ) for (typ, count) in growth.iteritems()
+                      if count > 0), reverse=True)[:self.TOP_TYPES]
+        self.phases.append((name, seconds, after,
+                            None if after is None else after - before,
+                            [(typ, count) for (count, typ) in top]))
+
+    def sizeof(self, obj):
+        """
+        Return (objects, bytes) for obj and everything it refers to
+        that hasn't been counted yet
+        """
+        n_objects = 0
+        n_bytes = 0
+        todo = [obj]
+        while todo:
+            obj = todo.pop()
+            if id(obj) in self._seen:
+                continue
+            self._seen.add(id(obj))
+            n_objects += 1
+            n_bytes += sys.getsizeof(obj)
+            if isinstance(obj, dict):
+                todo.extend(obj.iterkeys())
+                todo.extend(obj.itervalues())
+            elif isinstance(obj, (list, tuple, set, frozenset)):
+                todo.extend(obj)
+            elif hasattr(obj, '__dict__'):
+                todo.append(obj.__dict__)
+        return (n_objects, n_bytes)
+
+    def track(self, name, obj):
+        (n_objects, n_bytes) = self.sizeof(obj)
+        self.structures.append((name, n_objects, n_bytes))
+
+    def report(self):
+        lines = []
+        for (name, seconds, peak, raised, top) in self.phases:
+            lines.append("Phase {0}: {1:.2f} seconds, peak {2} KB "
+                         "(+{3} KB)".format(name, seconds, peak, raised))
+            if len(top) > 0:
+                lines.append("    new objects: " + ', '.join(
+                    '{0} {1}'.format(count, typ) for (typ, count) in top))
+        for (name, n_objects, n_bytes) in self.structures:
+            lines.append("{0:30s} {1:10d} objects {2:12d} bytes".format(
+                name, n_objects, n_bytes))
+        return '\n'.join(lines)
+
+# -------------------------------------------------------
+
 class SpellChecker(object):
     """
     Given an attribute name, look for names with edit distance two or
@@ -555,6 +1422,17 @@ class CsvObject(object):
     def __ne__(self, other):
         return not (self == other)
 
+    def __hash__(self):
+        return hash(tuple(getattr(self, f) for f in self.FIELDS))
+
+    def digest(self):
+        """
+        A hash of the object's contents as a 128 bit int.  Unlike
+        hash(), this is the same from one run to the next.
+        """
+        return int(hashlib.md5('\0'.join(self.csv_values())).hexdigest(),
+                   16)
+
     def __repr__(self):
         """
         This returns a string which, when evaluated, returns an object
@@ -583,12 +1461,14 @@ class CsvObject(object):
     def csv_bool(cls, val):
         return 'TRUE' if val else ''
 
+    def csv_values(self):
+        return [str(self.csv_bool(getattr(self, f))
+                    if f in self.BOOL_FIELDS
+                    else getattr(self, f))
+                for f in self.FIELDS]
+
     def to_csv(self, delim=','):
-        return delim.join(
-            str(self.csv_bool(getattr(self, f))
-                if f in self.BOOL_FIELDS
-                else getattr(self, f))
-            for f in self.FIELDS)
+        return delim.join(self.csv_values())
 
     @classmethod
     def from_csv_field(cls, fld, val):
@@ -646,22 +1526,85 @@ class Pair(CsvObject):
         return valid
 
 class CsvList(object):
+    """
+    A list of CsvObjects.
+
+    Two CsvLists are equal if they have the same objects, in any
+    order.  That's checked with a digest of the contents, which is
+    kept up to date as objects are added (the objects shouldn't be
+    changed once they're in the list), so it's quick.  diff tells you
+    what's actually different.
+
+    >>> a = Tutors([Tutor('Ann'), Tutor('Bo')])
+    >>> b = Tutors([Tutor('Bo')])
+    >>> a == b
+    False
+    >>> b.add(Tutor('Ann'))
+    >>> a == b
+    True
+    >>> b.add(Tutor('Cy', is_active=False))
+    >>> print a.diff_report(b)
+    + Cy,
+    """
     OBJ_CLASS = CsvObject
     ORDER = OBJ_CLASS.FIELDS
     BY_KEY = False
     KEY_UNIQUE = False
+    DIGEST_MODULUS = 2 ** 128
 
     def __init__(self, data=None):
         self.data = [] if data is None else list(data)
         self._data_by_key = None
+        # Worked out when it's first needed, then kept up to date
+        self._digest = None if len(self.data) > 0 else 0
+
+    @property
+    def digest(self):
+        """
+        The sum of the digests of the objects, which doesn't depend on
+        their order
+        """
+        if self._digest is None:
+            self._digest = (sum(obj.digest() for obj in self.data) %
+                            self.DIGEST_MODULUS)
+        return self._digest
+
+    @property
+    def fingerprint(self):
+        return '{0:032x}'.format(self.digest)
 
     def __eq__(self, other):
-        return (sorted(self.data, key=operator.attrgetter(*self.ORDER)) ==
-                sorted(other.data, key=operator.attrgetter(*self.ORDER)))
+        return self.digest == other.digest
 
     def __ne__(self, other):
         return not (self == other)
 
+    def diff(self, other):
+        """
+        Return a tuple of two lists: the objects in self that aren't in
+        other, and the objects in other that aren't in self.
+        """
+        mine = collections.Counter(self.data)
+        theirs = collections.Counter(other.data)
+        return (sorted((mine - theirs).elements(),
+                       key=operator.attrgetter(*self.ORDER)),
+                sorted((theirs - mine).elements(),
+                       key=operator.attrgetter(*self.ORDER)))
+
+    def diff_report(self, other, limit=20):
+        """
+        A description of the differences between self and other, with
+        a line for each object, starting with '-' for the ones that
+        are only in self and '+' for the ones that are only in other.
+        """
+        (missing, extra) = self.diff(other)
+        lines = (['- ' + obj.to_csv() for obj in missing] +
+                 ['+ ' + obj.to_csv() for obj in extra])
+        if len(lines) > limit:
+            lines = lines[:limit] + ['... and {0} more'.format(
+                len(lines) - limit)]
+        return '\n'.join(lines)
+
     def to_csv(self):
         return '\n'.join([self.OBJ_CLASS.csv_header()] +
                          [obj.to_csv()
@@ -711,10 +1654,13 @@ class CsvList(object):
     def add(self, obj):
         self._data_by_key = None
         self.data.append(obj)
+        if self._digest is not None:
+            self._digest = ((self._digest + obj.digest()) %
+                            self.DIGEST_MODULUS)
 
     def add_list(self, obj_list):
-        self._data_by_key = None
-        self.data.extend(obj_list)
+        for obj in obj_list:
+            self.add(obj)
 
     @classmethod
     def key_func(self, obj):
@@ -753,6 +1699,8 @@ class HistoricalData(CsvList):
 
     def __init__(self, data=None):
         super(HistoricalData, self).__init__(data)
+        # See FeatureTable.of
+        self.features = None
 
     @classmethod
     def key_func(self, pair):
@@ -769,6 +1717,10 @@ class HistoricalData(CsvList):
             by_tutor[tutor].append(student)
         return by_tutor
 
+    def add(self, obj):
+        super(HistoricalData, self).add(obj)
+        self.features = None
+
     def add_pairs(self, pairs):
         self.add_list(pairs)
 
@@ -789,6 +1741,15 @@ class HistoricalData(CsvList):
         return HistoricalData([d for d in self.data
                                if d.date < date and d.session == session])
 
+    def get_session_data(self, session):
+        return HistoricalData(self.get_matches(session=session))
+
+    def in_memory(self):
+        """
+        A plain copy of self, which can be sent to other processes
+        """
+        return HistoricalData(list(self.data))
+
     # This get_matches has the same functionality as
     # CsvList.get_matches, but it's much faster.  This gets called a
     # lot, so speeding it up a little makes a big difference.
@@ -818,6 +1779,10 @@ class HistoricalData(CsvList):
     def all_tutors(self):
         return sorted(set([d.tutor for d in self.data]))
 
+    @property
+    def all_dates(self):
+        return sorted(set([d.date for d in self.data]))
+
     @property
     def previous_date(self, date=None):
         dates = sorted(set([p.date for p in self.data]), reverse=True)
@@ -1024,42 +1989,109 @@ class PairingFile(object):
 
     @classmethod
     def from_csv(cls, filename, session):
+        with open(filename) as fd:
+            return cls.from_lines(fd, session)
+
+    @classmethod
+    def parse_score(cls, val):
+        """
+        Scores are ints, unless past work counts less as it gets older
+        (see HistoryWindow)
+
+        >>> (PairingFile.parse_score('12'), PairingFile.parse_score('2.5'))
+        (12, 2.5)
+        """
+        score = float(val)
+        return int(score) if score.is_integer() else score
+
+    @classmethod
+    def from_lines(cls, lines, session):
         pairing = []
         date = get_today()
+        header = None
+        for line in lines:
+            line = line.rstrip()
+            if line.lower().startswith('date'):
+                date = int(line.split(',', 2)[1])
+                continue
+            if line.lower().startswith('score'):
+                score = cls.parse_score(line.split(',', 2)[1])
+                continue
+            if header is None:
+                header = line
+                continue
+            # The Reason column can have commas in it
+            vals = line.split(',', 10)
+            if len(vals) != 9 and len(vals) != 11:
+                raise ValueError("Invalid pairing, wrong number of "
+                                 "fields: {0}".format(line))
+            (tutor, student, topic, tutor_on_own,
+             student_on_own, avoid_tutor, avoid_student,
+             good_tutor_match, good_student_match) = vals[:9]
+            # XXX get the columns from the header?
+            pairing.append(Pair(from_csv=True,
+                                date=date,
+                                session=session,
+                                tutor=tutor,
+                                student=student,
+                                topic=topic,
+                                tutor_on_own=tutor_on_own,
+                                on_own=student_on_own,
+                                avoid_student=avoid_student,
+                                avoid_tutor=avoid_tutor,
+                                good_tutor_match=good_tutor_match,
+                                good_student_match=good_student_match))
+        return pairing
+
+    @classmethod
+    def read_candidates(cls, filename, session):
+        """
+        Read one or more pairings from a file.  A file can have several
+        pairings in it, each one like a whole pairing file, with a line
+        'Candidate,<name>' before each of them.
+
+        @return a list of (name, pairs).  The name is the file name, or
+        if there are Candidate lines, the file name and the candidate's
+        name.
+        """
+        with open(filename) as fd:
+            lines = fd.readlines()
+        starts = [ii for (ii, line) in enumerate(lines)
+                  if line.lower().startswith('candidate,')]
+        if len(starts) == 0:
+            return [(filename, cls.from_lines(lines, session))]
+        candidates = []
+        for (ii, start) in enumerate(starts):
+            end = starts[ii + 1] if ii + 1 < len(starts) else len(lines)
+            name = lines[start].rstrip().split(',', 2)[1]
+            candidates.append(('{0}:{1}'.format(filename, name),
+                               cls.from_lines(lines[start + 1:end], session)))
+        return candidates
+
+    @classmethod
+    def read_annotations(cls, filename):
+        """
+        Read back the Score and Reason columns written by to_csv, as a
+        dict from (tutor, student) to [(score, reason)].  Rows without
+        a score are left out.
+        """
+        annotations = {}
         with open(filename) as fd:
             header = None
             for line in fd:
                 line = line.rstrip()
-                if line.lower().startswith('date'):
-                    date = int(line.split(',', 2)[1])
-                    continue
-                if line.lower().startswith('score'):
-                    score = int(line.split(',', 2)[1])
+                if (line.lower().startswith('date') or
+                    line.lower().startswith('score')):
                     continue
                 if header is None:
                     header = line
                     continue
-                vals = line.split(',')
-                if len(vals) != 8 and len(vals) != 10:
-                    raise ValueError("Invalid pairing, wrong number of "
-                                     "fields: {0}".format(line))
-                (tutor, student, topic, tutor_on_own,
-                 student_on_own, avoid_tutor, avoid_student,
-                 good_tutor_match, good_student_match) = vals[:8]
-                # XXX get the columns from the header?
-                pairing.append(Pair(from_csv=True,
-                                    date=date,
-                                    session=session,
-                                    tutor=tutor,
-                                    student=student,
-                                    topic=topic,
-                                    tutor_on_own=tutor_on_own,
-                                    on_own=student_on_own,
-                                    avoid_student=avoid_student,
-                                    avoid_tutor=avoid_tutor,
-                                    good_tutor_match=good_tutor_match,
-                                    good_student_match=good_student_match))
-        return pairing
+                vals = line.split(',', 10)
+                if len(vals) != 11 or vals[9] == '':
+                    continue
+                annotations[(vals[0], vals[1])] = [
+                    (cls.parse_score(vals[9]), vals[10])]
+        return annotations
 
     @classmethod
     def validate(cls, pairs, all_students, all_tutors, all_topics):
@@ -1213,63 +2245,595 @@ class ParseManualFile(object):
                                          on_own=on_own,
                                          avoid_student=avoid_student,
                                          avoid_tutor=avoid_tutor,
+                                         good_tutor_match=False,
                                          good_student_match=good_match))
                 last_fld = fld
         return data
 
-def get_2012_data():
-    currentdir = os.path.dirname(
-        os.path.abspath(inspect.getfile(inspect.currentframe())))
-    data_dir = os.path.join(os.path.dirname(os.path.dirname(currentdir)),
-                            'data', '2012')
-    data = []
-    data.extend(ParseManualFile.read_file(os.path.join(data_dir,
-                                                       'am_purple.csv'),
-                                          'am_purple', 2012))
-    data.extend(ParseManualFile.read_file(os.path.join(data_dir,
-                                                       'am_orange.csv'),
-                                          'am_orange', 2012))
-    data.extend(ParseManualFile.read_file(os.path.join(data_dir, 'pm.csv'),
-                                          'pm', 2012))
-    return HistoricalData(data)
+def get_season(date):
+    """
+    The year a date's school year started in, which is how the data
+    directories are named.  This follows ParseManualFile.parse_date:
+    January through May belong to the previous year's season.
+
+    >>> get_season(20121215)
+    2012
+    >>> get_season(20130504)
+    2012
+    """
+    year = date // 10000
+    month = (date // 100) % 100
+    return year - 1 if month < 6 else year
 
-def get_2013_data():
+def get_data_dir():
     currentdir = os.path.dirname(
         os.path.abspath(inspect.getfile(inspect.currentframe())))
-    data_dir = os.path.join(os.path.dirname(os.path.dirname(currentdir)),
-                            'data', '2013')
-    data = []
-    data.extend(ParseManualFile.read_file(os.path.join(data_dir, 'am.csv'),
-                                          'am', 2013))
-    data.extend(ParseManualFile.read_file(os.path.join(data_dir, 'pm.csv'),
-                                          'pm', 2013))
-    return HistoricalData(data)
+    return os.path.join(os.path.dirname(os.path.dirname(currentdir)),
+                        'data')
 
-# --------------------------------------------------------------------
-# Functions to score a pairing
-#
+class DataCatalog(object):
+    """
+    All of the old spreadsheets, which live in data/<year>/<session>.csv
+    where <year> is the season (see get_season).  Adding a season is
+    just a matter of adding the files.
 
-class ScoreParams(object):
-    PARAMS = {'award_past_work'          : 1,
-              'award_good_tutor_match'   : 5,
-              'award_good_student_match' : 5,
-              'penalty_avoid_tutor'      : 20,
-              'penalty_multiple_students': 1,
-              'penalty_avoid_student'    : 20,
-              'penalty_tutor_on_own'     : 10,
-              'penalty_student_on_own'   : 10,
-              'penalty_different_topics' : 10}
+    Nothing is read until it's needed, and each spreadsheet is parsed
+    at most once per process (unless it changes), no matter how many
+    DataCatalogs ask for it.
+    """
+    # (filename, modification time) -> list of Pairs
+    _loaded = {}
 
-    def __init__(self, **kwargs):
-        for param in self.PARAMS:
-            val = kwargs[param] if param in kwargs else self.PARAMS[param]
-            setattr(self, param, val)
-        for kwarg in kwargs:
-            if kwarg not in self.PARAMS:
-                raise ValueError("Bad score parameter {0}, "
-                                 "should be one of {1}".
-                                 format(kwarg,
-                                        ', '.join(self.PARAMS)))
+    def __init__(self, data_dir=None):
+        if data_dir is None:
+            data_dir = get_data_dir()
+        self.data_dir = data_dir
+
+    def seasons(self):
+        """
+        Return a sorted list of (year, session) for all the
+        spreadsheets in the data directory
+        """
+        found = []
+        for year in os.listdir(self.data_dir):
+            if not year.isdigit():
+                continue
+            for fn in os.listdir(os.path.join(self.data_dir, year)):
+                (session, ext) = os.path.splitext(fn)
+                if ext == '.csv':
+                    found.append((int(year), session))
+        return sorted(found)
+
+    @property
+    def years(self):
+        return sorted(set(year for (year, _) in self.seasons()))
+
+    def load(self, year, session):
+        """
+        Return the list of Pairs in one spreadsheet
+        """
+        fn = os.path.join(self.data_dir, str(year), session + '.csv')
+        key = (os.path.abspath(fn), os.path.getmtime(fn))
+        if key not in self._loaded:
+            logging.info("Parsing %s", fn)
+            self._loaded[key] = ParseManualFile.read_file(fn, session, year)
+        return self._loaded[key]
+
+    def get_data(self, first_year=None, last_year=None, sessions=None):
+        """
+        Return a CatalogHistoricalData for the seasons from first_year
+        to last_year (inclusive, None meaning no limit), for the given
+        sessions (None meaning all of them).  Nothing is read until
+        the data is used.
+        """
+        seasons = [(year, session) for (year, session) in self.seasons()
+                   if (first_year is None or year >= first_year) and
+                      (last_year is None or year <= last_year) and
+                      (sessions is None or session in sessions)]
+        return CatalogHistoricalData(self, seasons)
+
+class CatalogHistoricalData(HistoricalData):
+    """
+    HistoricalData for some of the seasons in a DataCatalog.  Using
+    self.data reads all of them, but get_pairing and get_data_before
+    only read the seasons they need.
+    """
+    def __init__(self, catalog, seasons):
+        self.catalog = catalog
+        self.seasons = seasons
+        self._data = None
+        self._data_by_key = None
+        self._digest = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = [pair
+                          for (year, session) in self.seasons
+                          for pair in self.catalog.load(year, session)]
+        return self._data
+
+    def load(self, keep):
+        """
+        The Pairs from the seasons for which keep(year, session) is true
+        """
+        return [pair
+                for (year, session) in self.seasons
+                if keep(year, session)
+                for pair in self.catalog.load(year, session)]
+
+    def add(self, obj):
+        self.data.append(obj)
+        self._data_by_key = None
+        self._digest = None
+        self.features = None
+
+    def add_list(self, obj_list):
+        self.data.extend(obj_list)
+        self._data_by_key = None
+        self._digest = None
+        self.features = None
+
+    def get_pairing(self, date, session):
+        if self._data is not None:
+            return HistoricalData.get_pairing(self, date, session)
+        season = get_season(date)
+        return HistoricalData(self.load(
+            lambda y, s: y == season and s == session)).get_pairing(date,
+                                                                   session)
+
+    def get_data_before(self, date, session):
+        if self._data is not None:
+            return HistoricalData.get_data_before(self, date, session)
+        season = get_season(date)
+        return HistoricalData(self.load(
+            lambda y, s: y <= season and s == session)).get_data_before(
+                date, session)
+
+class HistoryPartition(CsvObject):
+    """
+    One line of the manifest of a PartitionedHistoricalData: which
+    dates are in the file for a season and session, and how many
+    pairs it has.
+    """
+    INT_FIELDS  = ('season', 'first_date', 'last_date', 'rows')
+    STR_FIELDS  = ('session',)
+    FIELDS = STR_FIELDS + INT_FIELDS
+
+    @property
+    def filename(self):
+        return os.path.join(str(self.season), self.session + '.csv')
+
+class HistoryManifest(CsvList):
+    OBJ_CLASS = HistoryPartition
+    ORDER = ('session', 'season')
+    BY_KEY = True
+    KEY_UNIQUE = True
+
+    @classmethod
+    def key_func(cls, part):
+        return (part.session, part.season)
+
+class PartitionedHistoricalData(HistoricalData):
+    """
+    HistoricalData kept in a directory with a file for each season and
+    session, <season>/<session>.csv, laid out like the DataCatalog,
+    plus Manifest.csv saying what's in each file.  Using self.data
+    reads all of the files, but get_pairing and get_data_before only
+    read the ones with dates they need, and adding pairs only rewrites
+    the files for those pairs (and the manifest).
+    """
+    def __init__(self, hist_dir):
+        self.hist_dir = hist_dir
+        manifest = os.path.join(hist_dir, os.path.basename(HIST_MANIFEST))
+        # If there's no manifest yet, this starts out empty
+        self.manifest = HistoryManifest()
+        if os.path.exists(manifest):
+            self.manifest.from_csv(manifest)
+        self._data = None
+        self._data_by_key = None
+        self._digest = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = self.load(lambda part: True)
+        return self._data
+
+    def read_partition(self, part):
+        return HistoricalData().from_csv(
+            os.path.join(self.hist_dir, part.filename))
+
+    def load(self, keep):
+        """
+        The Pairs from the partitions for which keep(partition) is true
+        """
+        return [pair
+                for part in sorted(self.manifest.data,
+                                   key=operator.attrgetter(
+                                       *HistoryManifest.ORDER))
+                if keep(part)
+                for pair in self.read_partition(part).data]
+
+    def add(self, obj):
+        self.add_list([obj])
+
+    def add_list(self, obj_list):
+        by_partition = collections.defaultdict(list)
+        for pair in obj_list:
+            by_partition[(pair.session, get_season(pair.date))].append(pair)
+        parts = dict(self.manifest.data_by_key)
+        for ((session, season), pairs) in sorted(by_partition.items()):
+            if (session, season) in parts:
+                hist = self.read_partition(parts[(session, season)])
+            else:
+                hist = HistoricalData()
+            hist.add_list(pairs)
+            dates = [pair.date for pair in hist.data]
+            part = HistoryPartition(session=session,
+                                    season=season,
+                                    first_date=min(dates),
+                                    last_date=max(dates),
+                                    rows=len(hist.data))
+            write_data(os.path.join(self.hist_dir, part.filename), hist)
+            parts[(session, season)] = part
+        self.manifest = HistoryManifest(parts.values())
+        write_data(os.path.join(self.hist_dir,
+                                os.path.basename(HIST_MANIFEST)),
+                   self.manifest)
+        if self._data is not None:
+            self._data.extend(obj_list)
+        self._data_by_key = None
+        self._digest = None
+        self.features = None
+
+    def get_pairing(self, date, session):
+        if self._data is not None:
+            return HistoricalData.get_pairing(self, date, session)
+        return HistoricalData(self.load(
+            lambda p: (p.session == session and
+                       p.first_date <= date <= p.last_date))).get_pairing(
+                           date, session)
+
+    def get_data_before(self, date, session):
+        if self._data is not None:
+            return HistoricalData.get_data_before(self, date, session)
+        return HistoricalData(self.load(
+            lambda p: p.session == session and p.first_date < date)
+                              ).get_data_before(date, session)
+
+def write_data(filename, csv_list):
+    """
+    Write csv_list to filename, making the directory if needed
+    """
+    dirname = os.path.dirname(filename)
+    if dirname != '' and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    with open(filename, 'w') as fd:
+        fd.write(csv_list.to_csv())
+        fd.write("\n")
+
+def split_history(directory=os.curdir):
+    """
+    Copy the historical data file in directory into a partitioned
+    history, which is used from then on (see open_history)
+    """
+    hist = HistoricalData().from_csv(os.path.join(directory, HIST_FILE))
+    if os.path.exists(os.path.join(directory, HIST_MANIFEST)):
+        raise RuntimeError("{0} already exists".format(
+            os.path.join(directory, HIST_MANIFEST)))
+    parts = PartitionedHistoricalData(os.path.join(directory, HIST_DIR))
+    parts.add_list(hist.data)
+    if PartitionedHistoricalData(parts.hist_dir) != hist:
+        raise RuntimeError("Error splitting historical data")
+    for part in parts.manifest.data:
+        print "Wrote {0} rows to {1}".format(part.rows, part.filename)
+
+def join_history(directory=os.curdir):
+    """
+    Write the historical data file in directory from the partitioned
+    history
+    """
+    hist = PartitionedHistoricalData(os.path.join(directory, HIST_DIR))
+    write_data(os.path.join(directory, HIST_FILE), hist)
+    print "Wrote {0} rows to {1}".format(len(hist.data), HIST_FILE)
+
+class HistorySummary(CsvObject):
+    """
+    One line of a HistoryArchive, which is everything scoring needs to
+    know about some pairs from one season and session.
+
+    For kind TUTOR, first and second are a tutor and a student, count
+    is how many weeks they worked together, and the flags are set if
+    they were set on any of those weeks.  For kind STUDENTS, first and
+    second are two students, count is how many weeks they were in the
+    same group, and avoid_student and good_student_match are set if
+    anyone in any of those groups had them set.  date is the last of
+    the weeks.
+    """
+    TUTOR = 'tutor'
+    STUDENTS = 'students'
+    INT_FIELDS  = ('season', 'date', 'count')
+    STR_FIELDS  = ('session', 'kind', 'first', 'second')
+    BOOL_FIELDS = Pair.BOOL_FIELDS
+    FIELDS = STR_FIELDS + INT_FIELDS + BOOL_FIELDS
+
+    def pairs(self):
+        """
+        Pairs that look the same as this to get_group_score: for a
+        TUTOR row, count copies of the tutor working with the student
+        on the last date, and for a STUDENTS row, the two students in a
+        group with no tutor.
+        """
+        flags = dict((f, getattr(self, f)) for f in self.BOOL_FIELDS)
+        if self.kind == self.TUTOR:
+            return [Pair(self.date, self.session, self.first, self.second,
+                         **flags)] * self.count
+        return [Pair(self.date, self.session, '', student, **flags)
+                for student in (self.first, self.second)]
+
+class HistoryArchive(CsvList):
+    """
+    The seasons that compact_history has folded into HistorySummary
+    lines.
+
+    >>> pairs = [
+    ...     Pair(20130105, 'am', 'Ann', 'Bo', avoid_student=True,
+    ...          tutor_on_own=False, on_own=False, avoid_tutor=False,
+    ...          good_tutor_match=False, good_student_match=False),
+    ...     Pair(20130105, 'am', 'Ann', 'Cy', tutor_on_own=False,
+    ...          on_own=False, avoid_student=False, avoid_tutor=False,
+    ...          good_tutor_match=True, good_student_match=False),
+    ...     Pair(20130112, 'am', 'Ann', 'Bo', tutor_on_own=False,
+    ...          on_own=False, avoid_student=False, avoid_tutor=False,
+    ...          good_tutor_match=False, good_student_match=False)]
+    >>> for row in HistoryArchive.summarize(pairs).data:
+    ...     print row.to_csv()
+    am,students,Bo,Cy,2012,20130105,1,,,TRUE,,,
+    am,tutor,Ann,Bo,2012,20130112,2,,,,,,
+    am,tutor,Ann,Cy,2012,20130105,1,,,,,TRUE,
+    """
+    OBJ_CLASS = HistorySummary
+    ORDER = ('session', 'season', 'kind', 'first', 'second')
+    BY_KEY = True
+    KEY_UNIQUE = True
+
+    @classmethod
+    def key_func(cls, row):
+        return (row.session, row.season, row.kind, row.first, row.second)
+
+    @classmethod
+    def combine(cls, rows):
+        """
+        Fold rows into one line for each key
+        """
+        by_key = collections.defaultdict(list)
+        for row in rows:
+            by_key[cls.key_func(row)].append(row)
+        combined = []
+        for (key, same) in sorted(by_key.items()):
+            flags = dict((f, any(getattr(r, f) for r in same))
+                         for f in HistorySummary.BOOL_FIELDS)
+            flags.update(zip(cls.ORDER, key))
+            combined.append(HistorySummary(
+                date=max(r.date for r in same),
+                count=sum(r.count for r in same), **flags))
+        return cls(combined)
+
+    @classmethod
+    def summarize(cls, pairs):
+        """
+        @return a HistoryArchive for pairs
+        """
+        rows = []
+        groups = collections.defaultdict(list)
+        for pair in pairs:
+            flags = dict((f, getattr(pair, f)) for f in Pair.BOOL_FIELDS)
+            flags['avoid_student'] = flags['good_student_match'] = False
+            rows.append(HistorySummary(
+                pair.session, HistorySummary.TUTOR, pair.tutor, pair.student,
+                get_season(pair.date), pair.date, 1, **flags))
+            groups[HistoricalData.key_func(pair)].append(pair)
+        # Like get_student_pairings, students are marked if anyone in
+        # their group was
+        for group in groups.itervalues():
+            avoid = any(p.avoid_student for p in group)
+            good = any(p.good_student_match for p in group)
+            students = sorted(set(p.student for p in group))
+            for (ii, first) in enumerate(students):
+                for second in students[ii+1:]:
+                    rows.append(HistorySummary(
+                        group[0].session, HistorySummary.STUDENTS, first,
+                        second, get_season(group[0].date), group[0].date, 1,
+                        avoid_student=avoid, good_student_match=good,
+                        **dict.fromkeys(('tutor_on_own', 'on_own',
+                                         'avoid_tutor', 'good_tutor_match'),
+                                        False)))
+        return cls.combine(rows)
+
+class CompactedHistoricalData(HistoricalData):
+    """
+    HistoricalData where the seasons before the current one are kept
+    in a HistoryArchive instead of as Pairs.  self.data is just the
+    Pairs; the archive is scored along with them by FeatureTable, and
+    get_matches and get_student_pairings include Pairs made up from
+    the archive (see HistorySummary.pairs) so get_group_score gets the
+    same answers.  Archived pairs all have the last date of their
+    season, so a HistoryWindow by weeks treats each archived season as
+    one week.
+    """
+    def __init__(self, data=None, archive=None):
+        super(CompactedHistoricalData, self).__init__(data)
+        self.archive = HistoryArchive() if archive is None else archive
+
+    @classmethod
+    def compact(cls, hist):
+        """
+        hist (which may already be compacted), with the pairs from
+        before the season of its last pair folded into the archive
+        """
+        archive = getattr(hist, 'archive', HistoryArchive())
+        if len(hist.data) == 0:
+            return cls([], archive)
+        season = get_season(max(pair.date for pair in hist.data))
+        old = [pair for pair in hist.data if get_season(pair.date) < season]
+        return cls([pair for pair in hist.data
+                    if get_season(pair.date) >= season],
+                   HistoryArchive.combine(
+                       archive.data + HistoryArchive.summarize(old).data))
+
+    @property
+    def digest(self):
+        return ((CsvList.digest.fget(self) + self.archive.digest) %
+                self.DIGEST_MODULUS)
+
+    @property
+    def all_dates(self):
+        return sorted(set([d.date for d in self.data] +
+                          [r.date for r in self.archive.data]))
+
+    def get_data_before(self, date, session):
+        return CompactedHistoricalData(
+            HistoricalData.get_data_before(self, date, session).data,
+            HistoryArchive([r for r in self.archive.data
+                            if r.date < date and r.session == session]))
+
+    def get_session_data(self, session):
+        return CompactedHistoricalData(
+            self.get_matches(session=session),
+            HistoryArchive([r for r in self.archive.data
+                            if r.session == session]))
+
+    def in_memory(self):
+        return CompactedHistoricalData(list(self.data), self.archive)
+
+    def get_matches(self,
+                    tutor=None,
+                    student=None,
+                    date=None,
+                    session=None):
+        matches = HistoricalData.get_matches(self, tutor=tutor,
+                                             student=student, date=date,
+                                             session=session)
+        if tutor is None and student is None:
+            return matches
+        return matches + [
+            pair
+            for r in self.archive.data
+            if (r.kind == HistorySummary.TUTOR
+                and (date is None or date == r.date)
+                and (session is None or session == r.session)
+                and (tutor is None or tutor == r.first)
+                and (student is None or student == r.second))
+            for pair in r.pairs()]
+
+    def get_student_pairings(self, student1, student2):
+        students = sorted((student1, student2))
+        return (HistoricalData.get_student_pairings(self, student1,
+                                                    student2) +
+                [r.pairs() for r in self.archive.data
+                 if (r.kind == HistorySummary.STUDENTS and
+                     [r.first, r.second] == students)])
+
+def compact_history(directory=os.curdir):
+    """
+    Fold the historical data in directory from before the current
+    season into the archive, which is used from then on (see
+    open_history)
+    """
+    if (os.path.exists(os.path.join(directory, HIST_DB)) or
+        os.path.exists(os.path.join(directory, HIST_MANIFEST))):
+        raise RuntimeError("Only {0} can be compacted".format(HIST_FILE))
+    hist = open_history(directory)
+    if len(hist.data) == 0:
+        return
+    compacted = CompactedHistoricalData.compact(hist)
+    # Everything should score the same way
+    for session in sorted(set(pair.session for pair in hist.data)):
+        if not FeatureTable(hist.get_session_data(session)).same_scores(
+                FeatureTable(compacted.get_session_data(session))):
+            raise RuntimeError("Error compacting historical data for "
+                               "session {0}".format(session))
+    write_data(os.path.join(directory, HIST_ARCHIVE), compacted.archive)
+    write_data(os.path.join(directory, HIST_FILE), compacted)
+    print "Folded {0} rows into {1} rows in {2}, {3} rows left in {4}".format(
+        len(hist.data) - len(compacted.data), len(compacted.archive.data),
+        HIST_ARCHIVE,
+        len(compacted.data), HIST_FILE)
+
+def get_2012_data():
+    return DataCatalog().get_data(2012, 2012)
+
+def get_2013_data():
+    return DataCatalog().get_data(2013, 2013)
+
+# --------------------------------------------------------------------
+# Functions to score a pairing
+#
+
+class ScoreParams(object):
+    PARAMS = {'award_past_work'          : 1,
+              'award_good_tutor_match'   : 5,
+              'award_good_student_match' : 5,
+              'penalty_avoid_tutor'      : 20,
+              'penalty_multiple_students': 1,
+              'penalty_avoid_student'    : 20,
+              'penalty_tutor_on_own'     : 10,
+              'penalty_student_on_own'   : 10,
+              'penalty_different_topics' : 10,
+              # Not a score: how many points moving a student who is
+              # already seated has to gain before repair_pairing will
+              # move them
+              'repair_min_gain'          : 5,
+              # Not scores either: which of SOLVERS finds the pairing,
+              # and how many seconds it has to do it (0 for no limit,
+              # and not every solver can stop early)
+              'solver'                   : 'good_pairing',
+              'solver_seconds'           : 0,
+              # Also not scores: for the portfolio solver, how many
+              # randomized runs of the greedy pairing to try (1 means
+              # just good_pairing), the seed for their random numbers,
+              # and how many points of noise they add to each
+              # candidate tutor's score
+              'portfolio_starts'         : 1,
+              'portfolio_seed'           : 0,
+              'portfolio_noise'          : 1,
+              # How much of the history counts (see HistoryWindow):
+              # only the last N weeks, only the last N seasons, and
+              # the number of weeks it takes for past work to count
+              # half as much.  0 means no limit.  A week is a date
+              # in the history, not a calendar week, so summers and
+              # holidays without sessions don't count.  With sticky
+              # flags, avoid and on own marks count no matter how old.
+              'history_weeks'            : 0,
+              'history_seasons'          : 0,
+              'history_half_life'        : 0,
+              'history_sticky_flags'     : 1,
+              # Not a score: 1 to make the solvers only put a student
+              # with a tutor they should avoid, or a second student
+              # with a tutor marked on own, when there's no other
+              # choice (see CandidateTutors.is_excluded).  0 leaves
+              # those as penalties like any other.
+              'hard_constraints'         : 0}
+
+    def __init__(self, **kwargs):
+        for param in self.PARAMS:
+            val = kwargs[param] if param in kwargs else self.PARAMS[param]
+            setattr(self, param, val)
+        for kwarg in kwargs:
+            if kwarg not in self.PARAMS:
+                raise ValueError("Bad score parameter {0}, "
+                                 "should be one of {1}".
+                                 format(kwarg,
+                                        ', '.join(self.PARAMS)))
+
+    def copy(self, **kwargs):
+        """
+        A copy of self, with the parameters in kwargs changed
+        """
+        vals = dict((param, getattr(self, param)) for param in self.PARAMS)
+        vals.update(kwargs)
+        return self.__class__(**vals)
 
     def to_csv(self):
         return '\n'.join(
@@ -1282,7 +2846,10 @@ class ScoreParams(object):
             vals = {}
             for line in fd:
                 (fld, val) = line.split(',')
-                vals[fld] = int(val)
+                if isinstance(cls.PARAMS.get(fld), str):
+                    vals[fld] = val.strip()
+                else:
+                    vals[fld] = int(val)
         return cls(**vals)
 
     def __eq__(self, other):
@@ -1310,25 +2877,35 @@ def normalize_topic(topic, check=True):
     else:
         return None
 
-def get_group_score(hist, tutor, students, topics, params=None, **kwargs):
+def get_group_score(hist, tutor, students, topics, params=None, window=None,
+                    **kwargs):
+    """
+    @param window: the HistoryWindow for hist and params, if it's
+    already been made (see HistoryWindow.of)
+    """
     if params is None:
         params = ScoreParams(**kwargs)
+    if window is None:
+        window = HistoryWindow.of(hist, params)
+    counts = window.counts
+    weight = window.weight
 
     annotations = collections.defaultdict(list)
     score = 0
     for student in students:
         prev = hist.get_matches(tutor=tutor, student=student)
-        points_past_work = len(prev) * params.award_past_work
+        past_work = sum(weight(p) for p in prev)
+        points_past_work = past_work * params.award_past_work
         if points_past_work > 0:
             score += points_past_work
             logging.debug("Score %s: Increasing score by %s because %s and %s "
                           "have worked together %s other times",
-                          score, points_past_work, tutor, student, len(prev))
+                          score, points_past_work, tutor, student, past_work)
             annotations[(tutor, student)].append(
                 (points_past_work,
-                 "+{0}*{1} because {2} and {3} have worked together".
-                 format(len(prev), params.award_past_work, tutor, student)))
-        if any([p.avoid_tutor for p in prev]):
+                 "+{0:g}*{1} because {2} and {3} have worked together".
+                 format(past_work, params.award_past_work, tutor, student)))
+        if any([counts(p, 'avoid_tutor') for p in prev]):
             score -= params.penalty_avoid_tutor
             logging.debug("Score %s: Decreasing score by %s because %s should "
                           "avoid tutor %s",
@@ -1337,7 +2914,7 @@ def get_group_score(hist, tutor, students, topics, params=None, **kwargs):
                 (-params.penalty_avoid_tutor,
                   "-{0} because {1} and {2} shouldn't work together".
                   format(params.penalty_avoid_tutor, tutor, student)))
-        if any([p.good_tutor_match for p in prev]):
+        if any([counts(p, 'good_tutor_match') for p in prev]):
             score += params.award_good_tutor_match
             logging.debug("Score %s: Increasing score by %s because %s is a "
                           "good fit with tutor %s",
@@ -1375,7 +2952,8 @@ def get_group_score(hist, tutor, students, topics, params=None, **kwargs):
              "on different topics {3}".format(
                  params.penalty_different_topics,
                  students, tutor, topics)))
-    if any([p.tutor_on_own for p in hist.get_matches(tutor=tutor)]):
+    if any([counts(p, 'tutor_on_own')
+            for p in hist.get_matches(tutor=tutor)]):
         score -= params.penalty_tutor_on_own
         logging.debug("Score %s: Decreasing score by %s because tutor %s "
                       "should work alone",
@@ -1385,7 +2963,8 @@ def get_group_score(hist, tutor, students, topics, params=None, **kwargs):
               "-{0} because tutor {1} should only work on own".
               format(params.penalty_tutor_on_own, tutor)))
     for student in students:
-        if any([p.on_own for p in hist.get_matches(student=student)]):
+        if any([counts(p, 'on_own')
+                for p in hist.get_matches(student=student)]):
             score -= params.penalty_student_on_own
             logging.debug("Score %s: Decreasing score by %s because "
                           "student %s should work alone",
@@ -1399,7 +2978,7 @@ def get_group_score(hist, tutor, students, topics, params=None, **kwargs):
             hist_pairs = hist.get_student_pairings(students[ii],
                                                    students[jj])
             for pairs in hist_pairs:
-                if any([p.avoid_student for p in pairs]):
+                if any([counts(p, 'avoid_student') for p in pairs]):
                     score -= params.penalty_avoid_student
                     logging.debug("Score %s: Decreasing score by %s "
                                   "because student %s "
@@ -1415,7 +2994,7 @@ def get_group_score(hist, tutor, students, topics, params=None, **kwargs):
                                  students[jj])))
                     break
             for pairs in hist_pairs:
-                if any([p.good_student_match for p in pairs]):
+                if any([counts(p, 'good_student_match') for p in pairs]):
                     score += params.award_good_student_match
                     logging.debug("Score %s: Increasing score by %s "
                                   "because student %s "
@@ -1471,17 +3050,424 @@ def get_score(pairing, hist, student_topics, params=None, **kwargs):
         params = ScoreParams(**kwargs)
 
     by_tutor = HistoricalData.pairing_by_tutor(pairing)
+    window = HistoryWindow.of(hist, params)
     score = 0
     annotations = {}
     for tutor in by_tutor:
         group = by_tutor[tutor]
         topics = [normalize_topic(student_topics[s]) for s in group]
         group_score, group_ann = get_group_score(hist, tutor, group, topics,
-                                                 params=params)
+                                                 params=params, window=window)
         score += group_score
         annotations.update(group_ann)
     return score, annotations
 
+class HistoryWindow(object):
+    """
+    How much each week of the historical data counts when scoring,
+    under the history_* score parameters.  The weeks are the dates in
+    the history (so a summer without sessions isn't 13 weeks), counted
+    back from the most recent one, which is week 0.  A week
+    outside of the last history_weeks weeks or the last
+    history_seasons seasons doesn't count at all, and past work from
+    a week inside them counts 0.5 ** (week / history_half_life) times.
+    The flags on a pair count when its week counts at all, except that
+    with history_sticky_flags, the avoid and on own flags always count.
+
+    >>> params = ScoreParams(history_weeks=2, history_half_life=1)
+    >>> window = HistoryWindow([20130105, 20130112, 20130119], params)
+    >>> [window.weight(Pair(d, 'am', 'Ann', 'Bo', avoid_student=False,
+    ...                     tutor_on_own=False, on_own=True, avoid_tutor=False,
+    ...                     good_tutor_match=True, good_student_match=False))
+    ...  for d in (20130105, 20130112, 20130119)]
+    [0, 0.5, 1.0]
+    >>> old = Pair(20130105, 'am', 'Ann', 'Bo', avoid_student=False,
+    ...            tutor_on_own=False, on_own=True, avoid_tutor=False,
+    ...            good_tutor_match=True, good_student_match=False)
+    >>> (window.counts(old, 'on_own'), window.counts(old, 'good_tutor_match'))
+    (True, False)
+    """
+    STICKY_FLAGS = ('avoid_tutor', 'avoid_student', 'tutor_on_own', 'on_own')
+
+    def __init__(self, dates=(), params=None):
+        """
+        @param dates: the dates in the historical data
+        @param params: the ScoreParams, or None for all of the history
+        """
+        self.key = None if params is None else self.params_key(params)
+        # date -> weight, or None when everything counts fully
+        self.weights = None
+        if self.key is None:
+            return
+        self.sticky = params.history_sticky_flags != 0
+        self.weights = {}
+        dates = sorted(set(dates), reverse=True)
+        for (week, date) in enumerate(dates):
+            if 0 < params.history_weeks <= week:
+                weight = 0
+            elif (params.history_seasons > 0 and
+                  get_season(date) <= (get_season(dates[0]) -
+                                       params.history_seasons)):
+                weight = 0
+            elif params.history_half_life > 0:
+                weight = 0.5 ** (week / params.history_half_life)
+            else:
+                weight = 1
+            self.weights[date] = weight
+
+    @classmethod
+    def of(cls, hist, params=None):
+        """
+        The HistoryWindow for hist under params: ALL_HISTORY when the
+        history_* parameters are off, and otherwise one for hist's
+        dates.  This only looks at the dates, so it doesn't need a
+        FeatureTable.
+        """
+        if params is None or cls.params_key(params) is None:
+            return ALL_HISTORY
+        return cls(hist.all_dates, params)
+
+    @classmethod
+    def params_key(cls, params):
+        """
+        The history_* parameters, or None if they're all off
+        """
+        key = (params.history_weeks, params.history_seasons,
+               params.history_half_life)
+        if not any(key):
+            return None
+        return key + (params.history_sticky_flags,)
+
+    def weight(self, pair):
+        if self.weights is None:
+            return 1
+        return self.weights.get(pair.date, 0)
+
+    def counts(self, pair, flag):
+        """
+        Whether flag (the name of one of the Pair's boolean fields) is
+        set on pair and counts
+        """
+        if not getattr(pair, flag):
+            return False
+        if self.weights is None:
+            return True
+        return ((self.sticky and flag in self.STICKY_FLAGS) or
+                self.weights.get(pair.date, 0) > 0)
+
+ALL_HISTORY = HistoryWindow()
+
+class FeatureTable(object):
+    """
+    Everything get_group_score looks up in the historical data,
+    worked out in one pass over it: for each (tutor, student), how
+    many times they've worked together and whether they've been marked
+    to avoid each other or as a good match; who has been marked as
+    working on their own; and for each pair of students, whether
+    they've been marked to avoid each other or as a good match.
+
+    The score of a group is then the sum, over the score parameters,
+    of a count (its features) times the parameter (its weight, see
+    weights).  So the features for a pairing can be worked out once
+    and scored quickly under many different ScoreParams.
+
+    >>> hist = HistoricalData([
+    ...     Pair(20130105, 'am', 'Ann', 'Bo', avoid_student=True,
+    ...          tutor_on_own=False, on_own=False, avoid_tutor=False,
+    ...          good_tutor_match=False, good_student_match=False),
+    ...     Pair(20130105, 'am', 'Ann', 'Cy', tutor_on_own=False,
+    ...          on_own=False, avoid_student=False, avoid_tutor=False,
+    ...          good_tutor_match=True, good_student_match=False)])
+    >>> table = FeatureTable(hist)
+    >>> features = table.group_features('Ann', ['Bo', 'Cy'], ['#', 'WP'])
+    >>> sorted((k, v) for (k, v) in features.items() if v != 0)
+    ... # doctest: +NORMALIZE_WHITESPACE
+    [('award_good_tutor_match', 1), ('award_past_work', 2),
+     ('penalty_avoid_student', -1), ('penalty_different_topics', -1),
+     ('penalty_multiple_students', -1)]
+    >>> params = ScoreParams()
+    >>> table.dot(features, params)
+    -24
+    >>> get_group_score(hist, 'Ann', ['Bo', 'Cy'], ['#', 'WP'])[0]
+    -24
+    """
+    # The score parameters that are features, in the order
+    # get_group_score looks at them
+    FEATURES = ('award_past_work',
+                'penalty_avoid_tutor',
+                'award_good_tutor_match',
+                'penalty_multiple_students',
+                'penalty_different_topics',
+                'penalty_tutor_on_own',
+                'penalty_student_on_own',
+                'penalty_avoid_student',
+                'award_good_student_match')
+
+    def __init__(self, hist=None, window=ALL_HISTORY):
+        self.window = window
+        self.pair_counts = collections.defaultdict(int)
+        self.avoid_tutor = set()
+        self.good_tutor_match = set()
+        self.tutors_on_own = set()
+        self.students_on_own = set()
+        self.attendance = collections.defaultdict(int)
+        self.avoid_students = set()
+        self.good_students = set()
+        # HistoricalData.key_func -> [set of students, any avoid_student,
+        # any good_student_match], so that the student marks can be
+        # kept up to date as pairs are added
+        self.groups = {}
+        # The same for the STUDENTS lines of a HistoryArchive
+        self.archived_groups = []
+        if hist is not None:
+            self.add_pairs(hist.data)
+            archive = getattr(hist, 'archive', None)
+            if archive is not None:
+                self.add_archive(archive.data)
+
+    @classmethod
+    def of(cls, hist, params=None):
+        """
+        The FeatureTable for hist, counting the history that params
+        says to (see HistoryWindow).  It's made the first time it's
+        asked for (unless load_session found one in the scoring index)
+        and kept with hist until anything is added to it, or it's asked
+        for with a different window.
+        """
+        key = None if params is None else HistoryWindow.params_key(params)
+        table = getattr(hist, 'features', None)
+        if table is None or table.window.key != key:
+            table = cls(hist, HistoryWindow.of(hist, params))
+            hist.features = table
+        return table
+
+    def add_pairs(self, pairs):
+        """
+        Add pairs to the table.  With a HistoryWindow other than
+        ALL_HISTORY, the weights depend on all of the dates, so this is
+        only for making the table.
+        """
+        counts = self.window.counts
+        touched = set()
+        for pair in pairs:
+            key = (pair.tutor, pair.student)
+            weight = self.window.weight(pair)
+            if weight > 0:
+                self.pair_counts[key] += weight
+            self.attendance[pair.student] += 1
+            if counts(pair, 'avoid_tutor'):
+                self.avoid_tutor.add(key)
+            if counts(pair, 'good_tutor_match'):
+                self.good_tutor_match.add(key)
+            if counts(pair, 'tutor_on_own'):
+                self.tutors_on_own.add(pair.tutor)
+            if counts(pair, 'on_own'):
+                self.students_on_own.add(pair.student)
+            group_key = HistoricalData.key_func(pair)
+            if group_key not in self.groups:
+                self.groups[group_key] = [set(), False, False]
+            group = self.groups[group_key]
+            group[0].add(pair.student)
+            group[1] = group[1] or counts(pair, 'avoid_student')
+            group[2] = group[2] or counts(pair, 'good_student_match')
+            touched.add(group_key)
+        for group_key in touched:
+            self.mark_group(*self.groups[group_key])
+
+    def add_archive(self, rows):
+        """
+        Add the HistorySummary lines in rows to the table
+        """
+        counts = self.window.counts
+        for row in rows:
+            if row.kind == HistorySummary.STUDENTS:
+                group = [set((row.first, row.second)),
+                         counts(row, 'avoid_student'),
+                         counts(row, 'good_student_match')]
+                self.archived_groups.append(group)
+                self.mark_group(*group)
+                continue
+            key = (row.first, row.second)
+            weight = self.window.weight(row)
+            if weight > 0:
+                self.pair_counts[key] += weight * row.count
+            self.attendance[row.second] += row.count
+            if counts(row, 'avoid_tutor'):
+                self.avoid_tutor.add(key)
+            if counts(row, 'good_tutor_match'):
+                self.good_tutor_match.add(key)
+            if counts(row, 'tutor_on_own'):
+                self.tutors_on_own.add(row.first)
+            if counts(row, 'on_own'):
+                self.students_on_own.add(row.second)
+
+    def same_scores(self, other):
+        """
+        Whether other gives the same score to every group
+        """
+        return all(getattr(self, attr) == getattr(other, attr)
+                   for attr in ('pair_counts', 'avoid_tutor',
+                                'good_tutor_match', 'tutors_on_own',
+                                'students_on_own', 'avoid_students',
+                                'good_students'))
+
+    def mark_group(self, students, avoid, good):
+        # Like get_student_pairings: two students are marked if any
+        # past group with both of them in it has the flag on anyone.
+        marks = []
+        if avoid:
+            marks.append(self.avoid_students)
+        if good:
+            marks.append(self.good_students)
+        for mark in marks:
+            for s1 in students:
+                for s2 in students:
+                    if s1 != s2:
+                        mark.add((s1, s2))
+
+    def to_json(self):
+        return {'pair_counts' : sorted([t, s, n] for ((t, s), n)
+                                       in self.pair_counts.iteritems()),
+                'avoid_tutor' : sorted(self.avoid_tutor),
+                'good_tutor_match' : sorted(self.good_tutor_match),
+                'tutors_on_own' : sorted(self.tutors_on_own),
+                'students_on_own' : sorted(self.students_on_own),
+                'attendance' : sorted(self.attendance.iteritems()),
+                'groups' : sorted([d, t, sorted(g[0]), g[1], g[2]]
+                                  for ((d, t), g) in self.groups.iteritems()),
+                'archived_groups' : sorted([sorted(g[0]), g[1], g[2]]
+                                           for g in self.archived_groups)}
+
+    @classmethod
+    def from_json(cls, obj):
+        """
+        The opposite of to_json.  obj is straight from json, since
+        converting just the names back to strs here is a lot quicker
+        than using from_json on all of it.
+        """
+        def utf8(name):
+            return name.encode('utf-8')
+        def pairs(lst):
+            return ((utf8(a), utf8(b)) for (a, b) in lst)
+        table = cls()
+        for (tutor, student, count) in obj['pair_counts']:
+            table.pair_counts[(utf8(tutor), utf8(student))] = count
+        table.avoid_tutor.update(pairs(obj['avoid_tutor']))
+        table.good_tutor_match.update(pairs(obj['good_tutor_match']))
+        table.tutors_on_own.update(utf8(t) for t in obj['tutors_on_own'])
+        table.students_on_own.update(utf8(s) for s in obj['students_on_own'])
+        table.attendance.update((utf8(s), n) for (s, n) in obj['attendance'])
+        for (date, tutor, students, avoid, good) in obj['groups']:
+            students = set(utf8(s) for s in students)
+            table.groups[(date, utf8(tutor))] = [students, avoid, good]
+            table.mark_group(students, avoid, good)
+        for (students, avoid, good) in obj.get('archived_groups', []):
+            group = [set(utf8(s) for s in students), avoid, good]
+            table.archived_groups.append(group)
+            table.mark_group(*group)
+        return table
+
+    @classmethod
+    def weights(cls, params):
+        """
+        The weight of each feature under params
+        """
+        weights = dict((param, getattr(params, param))
+                       for param in params.PARAMS)
+        # get_group_score only counts past work when it's worth points
+        weights['award_past_work'] = max(0, params.award_past_work)
+        return weights
+
+    @classmethod
+    def dot(cls, features, params):
+        weights = cls.weights(params)
+        return sum(count * weights[param]
+                   for (param, count) in features.iteritems())
+
+    def group_features(self, tutor, students, topics):
+        """
+        The features for tutor working with students, where topics are
+        the students' (normalized) topics.  Penalties count down, so
+        the score is always the plain dot product.
+        """
+        features = dict.fromkeys(self.FEATURES, 0)
+        for student in students:
+            key = (tutor, student)
+            features['award_past_work'] += self.pair_counts.get(key, 0)
+            if key in self.avoid_tutor:
+                features['penalty_avoid_tutor'] -= 1
+            if key in self.good_tutor_match:
+                features['award_good_tutor_match'] += 1
+        n_students = len(students)
+        if n_students < 2:
+            return features
+        features['penalty_multiple_students'] -= (n_students - 1) ** 2
+        if any(t != topics[0] for t in topics[1:]):
+            features['penalty_different_topics'] -= 1
+        if tutor in self.tutors_on_own:
+            features['penalty_tutor_on_own'] -= 1
+        for student in students:
+            if student in self.students_on_own:
+                features['penalty_student_on_own'] -= 1
+        for ii in xrange(n_students):
+            for jj in xrange(ii+1, n_students):
+                key = (students[ii], students[jj])
+                if key in self.avoid_students:
+                    features['penalty_avoid_student'] -= 1
+                if key in self.good_students:
+                    features['award_good_student_match'] += 1
+        return features
+
+    def pairing_features(self, pairing, student_topics):
+        """
+        The features for a whole pairing, the sum of the features for
+        each group
+        """
+        features = collections.defaultdict(int)
+        by_tutor = HistoricalData.pairing_by_tutor(pairing)
+        for tutor in by_tutor:
+            group = by_tutor[tutor]
+            topics = [normalize_topic(student_topics[s]) for s in group]
+            for (param, count) in self.group_features(
+                    tutor, group, topics).iteritems():
+                features[param] += count
+        return dict(features)
+
+    def group_score(self, tutor, students, topics, params):
+        """
+        The same score as get_group_score, without the annotations
+        """
+        return self.dot(self.group_features(tutor, students, topics),
+                        params)
+
+def score_candidates(hist, student_topics, pairings, params=None):
+    """
+    Score a list of pairings for the same students, like get_score.
+    Tutors usually have the same group in many of the pairings, so
+    each group is only scored once.
+
+    @return a list with a tuple for each pairing of the score and a
+    dict from each tutor to the score for their group
+    """
+    if params is None:
+        params = ScoreParams()
+    table = FeatureTable.of(hist, params)
+    group_scores = {}
+    results = []
+    for pairing in pairings:
+        tutor_scores = {}
+        by_tutor = HistoricalData.pairing_by_tutor(pairing)
+        for tutor in by_tutor:
+            key = (tutor, tuple(by_tutor[tutor]))
+            if key not in group_scores:
+                topics = [normalize_topic(student_topics[s])
+                          for s in by_tutor[tutor]]
+                group_scores[key] = table.group_score(
+                    tutor, by_tutor[tutor], topics, params)
+            tutor_scores[tutor] = group_scores[key]
+        results.append((sum(tutor_scores.values()), tutor_scores))
+    return results
+
 def score_historical(hist, date, session, params=None):
     (actual, student_topics) = hist.get_pairing(date, session)
     past_data = hist.get_data_before(date, session)
@@ -1492,7 +3478,361 @@ def score_historical(hist, date, session, params=None):
 # list of students and tutors, or for a historical date
 #
 
-def good_pairing(hist, students, tutors, student_topics, params=None):
+class CandidateTutors(object):
+    """
+    Candidate generation shared by the pairing solvers.
+
+    For a student and the groups built so far, this ranks the present
+    tutors by an optimistic upper bound on how much adding the student
+    to that tutor's group can change the score.  Everything in
+    get_group_score except the student-vs-student history is exact in
+    the bound, so a tutor the student should avoid, or a tutor marked
+    tutor_on_own who already has a student, has their penalty in the
+    bound and is pruned as soon as another tutor scores better.
+
+    A tutor is only skipped when its bound can't beat (or tie with an
+    earlier tutor) the best exact score found so far, so a solver
+    using best_tutor picks the same tutor it would have picked by
+    scoring every one of them, like the original good_pairing did.
+
+    With the hard_constraints parameter, those two cases (see
+    is_excluded) also count for EXCLUDED_PENALTY more, so they're only
+    taken when every tutor is excluded.  That changes which tutor is
+    picked, so it's off by default.
+
+    Tutors (or students) with the same history with everyone here are
+    interchangeable: swapping them never changes the score.  In a new
+    season that's most of them, so they're put into classes (see
+    find_classes), and best_tutor only scores the first of the tutors
+    in a class whose groups are the same up to swapping students in a
+    class.  The others would tie with it, and lose the tie.
+
+    >>> hist = HistoricalData([
+    ...     Pair(20130105, 'am', 'Ann', 'Bo', avoid_tutor=True,
+    ...          tutor_on_own=False, on_own=False, avoid_student=False,
+    ...          good_tutor_match=False, good_student_match=False),
+    ...     Pair(20130105, 'am', 'Cy', 'Di', tutor_on_own=True,
+    ...          on_own=False, avoid_student=False, avoid_tutor=False,
+    ...          good_tutor_match=False, good_student_match=False)])
+    >>> cands = CandidateTutors(hist, ['Ann', 'Cy', 'Ed'],
+    ...                         {'Bo': '#', 'Di': '#'})
+    >>> cands.is_excluded('Ann', 'Bo', [])
+    True
+    >>> cands.is_excluded('Cy', 'Bo', ['Di'])
+    True
+    >>> cands.best_tutor('Bo', {'Cy': ['Di']})
+    ('Ed', 0)
+    >>> cands.best_tutor('Bo', {'Cy': ['Di']}, among=['Ann', 'Cy'])
+    ('Cy', -11)
+
+    When the penalties are small enough that an excluded tutor scores
+    best, they're picked, just as when every tutor is scored with
+    get_score, unless hard_constraints is set:
+
+    >>> topics = {'Bo': '#', 'Di': '#', 'Hal': '#'}
+    >>> def every_tutor(student, groups, tutors, params):
+    ...     pairs = [(t, s) for t in groups for s in groups[t]]
+    ...     scores = [get_score(pairs + [(t, student)], hist, topics,
+    ...                         params)[0] for t in tutors]
+    ...     return tutors[scores.index(max(scores))]
+    >>> params = ScoreParams(penalty_avoid_tutor=0, penalty_tutor_on_own=0)
+    >>> groups = {'Cy': ['Di'], 'Ed': ['Hal']}
+    >>> cands = CandidateTutors(hist, ['Ann', 'Cy', 'Ed'], topics, params)
+    >>> cands.best_tutor('Bo', groups), every_tutor(
+    ...     'Bo', groups, ['Ann', 'Cy', 'Ed'], params)
+    (('Ann', 1), 'Ann')
+    >>> cands.best_tutor('Bo', groups, among=['Cy', 'Ed']), every_tutor(
+    ...     'Bo', groups, ['Cy', 'Ed'], params)
+    (('Cy', -1), 'Cy')
+    >>> cands = CandidateTutors(hist, ['Ann', 'Cy', 'Ed'], topics,
+    ...                         params.copy(hard_constraints=1))
+    >>> cands.best_tutor('Bo', groups)
+    ('Ed', -1)
+    >>> cands = CandidateTutors(hist, ['Ann', 'Ed', 'Fay'],
+    ...                         {'Bo': '#', 'Hal': '#', 'Ivy': '#', 'Jo': '#'})
+    >>> cands.tutor_classes()
+    [['Ann'], ['Ed', 'Fay']]
+    >>> cands.best_tutor('Ivy', {'Ed': ['Hal'], 'Fay': ['Jo']},
+    ...                  among=['Ed', 'Fay'])
+    ('Ed', -1)
+    >>> (cands.n_scored, cands.n_symmetric)
+    (1, 1)
+    """
+
+    # With hard_constraints, how much worse than any allowed choice an
+    # excluded one counts for, so that it's only made when there's
+    # nothing else
+    EXCLUDED_PENALTY = 10 ** 6
+
+    def __init__(self, hist, tutors, student_topics, params=None):
+        if params is None:
+            params = ScoreParams()
+        self.hist = hist
+        self.tutors = list(tutors)
+        self.student_topics = student_topics
+        self.params = params
+        self.n_scored = 0
+        self.n_pruned = 0
+        self.n_symmetric = 0
+        self._group_scores = {}
+        # See find_classes
+        self._tutor_class = None
+        self._student_class = None
+
+        # Everything the bounds and scores need, from one pass over
+        # the history
+        self.features = FeatureTable.of(hist, params)
+        self.pair_counts = self.features.pair_counts
+        self.avoid_tutor = self.features.avoid_tutor
+        self.good_tutor_match = self.features.good_tutor_match
+        self.tutors_on_own = self.features.tutors_on_own
+        self.students_on_own = self.features.students_on_own
+        self.attendance = self.features.attendance
+
+    def topic(self, student):
+        return normalize_topic(self.student_topics[student])
+
+    def pair_score(self, tutor, student):
+        """
+        The points for tutor and student that don't depend on the rest
+        of the group: past work, avoid_tutor and good_tutor_match.
+        """
+        key = (tutor, student)
+        # get_group_score only counts past work when it's worth points
+        score = max(0, self.pair_counts.get(key, 0) *
+                    self.params.award_past_work)
+        if key in self.avoid_tutor:
+            score -= self.params.penalty_avoid_tutor
+        if key in self.good_tutor_match:
+            score += self.params.award_good_tutor_match
+        return score
+
+    def find_classes(self):
+        """
+        Put the tutors and students here into classes of ones who are
+        interchangeable: tutors with the same past work, avoid_tutor
+        and good_tutor_match with every student here, who are either
+        both marked tutor_on_own or both not; and students with the
+        same topic and history with every tutor here, the same
+        avoid_student and good_student_match marks with the other
+        students, who are either both marked on_own or both not.
+
+        Students who have been marked with each other end up in
+        different classes even if they could be swapped, which only
+        means fewer tutors get skipped.
+
+        Each tutor and student is mapped to the first one in their
+        class, in the order they were given.
+        """
+        tutors = self.tutors
+        students = sorted(self.student_topics)
+        def relation(tutor, student):
+            key = (tutor, student)
+            return (self.pair_counts.get(key, 0), key in self.avoid_tutor,
+                    key in self.good_tutor_match)
+        def first_of_class(names, signature):
+            first = {}
+            classes = {}
+            for name in names:
+                classes[name] = first.setdefault(signature(name), name)
+            return classes
+        self._tutor_class = first_of_class(tutors, lambda t: (
+            t in self.tutors_on_own,
+            tuple(relation(t, s) for s in students)))
+        self._student_class = first_of_class(students, lambda s: (
+            self.topic(s), s in self.students_on_own,
+            tuple(relation(t, s) for t in tutors),
+            frozenset(o for o in students
+                      if (s, o) in self.features.avoid_students),
+            frozenset(o for o in students
+                      if (s, o) in self.features.good_students)))
+
+    def tutor_classes(self):
+        """
+        The classes of interchangeable tutors, as lists of tutors in
+        the order they were given
+        """
+        if self._tutor_class is None:
+            self.find_classes()
+        classes = collections.defaultdict(list)
+        for tutor in self.tutors:
+            classes[self._tutor_class[tutor]].append(tutor)
+        return [classes[t] for t in self.tutors if t in classes and
+                classes[t][0] == t]
+
+    def symmetry_key(self, tutor, group):
+        """
+        A key that's the same for tutor and group as for any other
+        tutor and group that are the same up to swapping
+        interchangeable tutors and students, or None if tutor or
+        someone in group isn't here.
+        """
+        if self._tutor_class is None:
+            self.find_classes()
+        if tutor not in self._tutor_class:
+            return None
+        classes = []
+        for student in group:
+            if student not in self._student_class:
+                return None
+            classes.append(self._student_class[student])
+        return (self._tutor_class[tutor], tuple(sorted(classes)))
+
+    def is_excluded(self, tutor, student, group):
+        """
+        True if putting student with tutor (who already has the
+        students in group) breaks a hard constraint.
+        """
+        return ((tutor, student) in self.avoid_tutor or
+                (len(group) > 0 and tutor in self.tutors_on_own))
+
+    def excluded_penalty(self, tutor, student, group):
+        """
+        EXCLUDED_PENALTY if hard_constraints is set and putting student
+        with tutor is excluded, otherwise 0
+        """
+        if (self.params.hard_constraints and
+            self.is_excluded(tutor, student, group)):
+            return self.EXCLUDED_PENALTY
+        return 0
+
+    def constrained_delta(self, tutor, student, group):
+        """
+        delta, less excluded_penalty for adding student to tutor's group
+        """
+        return (self.delta(tutor, student, group) -
+                self.excluded_penalty(tutor, student, group))
+
+    def constrained_score(self, tutor, group):
+        """
+        group_score, less excluded_penalty for each student in group
+        with tutor and the rest of the group
+        """
+        score = self.group_score(tutor, group)
+        for (ii, student) in enumerate(group):
+            score -= self.excluded_penalty(
+                tutor, student, list(group[:ii]) + list(group[ii+1:]))
+        return score
+
+    def upper_bound(self, tutor, student, group):
+        """
+        An upper bound on how much adding student to tutor's group
+        changes the score.
+        """
+        params = self.params
+        bound = self.pair_score(tutor, student)
+        n_group = len(group)
+        if n_group == 0:
+            return bound
+        bound -= (2 * n_group - 1) * params.penalty_multiple_students
+        topics = [self.topic(s) for s in group]
+        if (self.topic(student) != topics[0] and
+            all(t == topics[0] for t in topics[1:])):
+            bound -= params.penalty_different_topics
+        if student in self.students_on_own:
+            bound -= params.penalty_student_on_own
+        if n_group == 1:
+            if tutor in self.tutors_on_own:
+                bound -= params.penalty_tutor_on_own
+            if group[0] in self.students_on_own:
+                bound -= params.penalty_student_on_own
+        # We don't know the student-vs-student history without looking,
+        # so assume the best for each student already in the group.
+        bound += n_group * (max(0, params.award_good_student_match) +
+                            max(0, -params.penalty_avoid_student))
+        return bound
+
+    def group_score(self, tutor, group):
+        key = self.symmetry_key(tutor, group)
+        if key is None:
+            key = (tutor, tuple(group))
+        if key not in self._group_scores:
+            self._group_scores[key] = self.features.group_score(
+                tutor, list(group), [self.topic(s) for s in group],
+                self.params)
+        return self._group_scores[key]
+
+    def delta(self, tutor, student, group):
+        """
+        The exact change in score from adding student to tutor's group
+        """
+        return (self.group_score(tutor, list(group) + [student]) -
+                self.group_score(tutor, group))
+
+    def candidates(self, student, groups):
+        """
+        Return a list of (upper_bound, index, tutor) for student, most
+        promising first.  index is the tutor's position in the list of
+        tutors we were given, and breaks ties between equal bounds.
+        The bound is less excluded_penalty.
+
+        @param groups: a dict from tutor to the list of students
+        already assigned to that tutor
+        """
+        ranked = []
+        for (ii, tutor) in enumerate(self.tutors):
+            group = groups.get(tutor, ())
+            bound = (self.upper_bound(tutor, student, group) -
+                     self.excluded_penalty(tutor, student, group))
+            ranked.append((bound, ii, tutor))
+        return sorted(ranked, key=lambda c: (-c[0], c[1]))
+
+    def best_tutor(self, student, groups, among=None, rng=None, noise=0):
+        """
+        Return (tutor, delta) for the tutor which gives the highest
+        score when student is added to their group, or None if there
+        are no tutors.  Ties go to the tutor that comes first in the
+        list of tutors.  With hard_constraints, a tutor that's excluded
+        (see is_excluded) is only picked if they all are.
+
+        @param among: if given, only consider these tutors
+
+        @param rng, noise: if rng is given, add a random number between
+        0 and noise to each tutor's score before picking the highest.
+        delta is still the real change in score.
+        """
+        if rng is None:
+            noise = 0
+        best = None
+        ranked = self.candidates(student, groups)
+        if among is not None:
+            ranked = [c for c in ranked if c[2] in among]
+        # Interchangeable tutors have the same bound, so the first of
+        # them is scored first.  With noise, they don't tie.
+        seen = set()
+        for (nn, (bound, ii, tutor)) in enumerate(ranked):
+            if (best is not None and
+                (bound + noise, -ii) < (best[0], -best[1])):
+                self.n_pruned += len(ranked) - nn
+                break
+            if rng is None:
+                key = self.symmetry_key(tutor, groups.get(tutor, ()))
+                if key is not None and key in seen:
+                    self.n_symmetric += 1
+                    continue
+                seen.add(key)
+            group = groups.get(tutor, ())
+            delta = self.delta(tutor, student, group)
+            self.n_scored += 1
+            score = delta - self.excluded_penalty(tutor, student, group)
+            if rng is not None:
+                score += rng.uniform(0, noise)
+            if best is None or (score, -ii) > (best[0], -best[1]):
+                best = (score, ii, tutor, delta)
+        if best is None:
+            return None
+        return (best[2], best[3])
+
+    def track_memory(self):
+        """
+        Add the index and caches to the MemoryReport, if there is one
+        """
+        track_memory('HistoricalData.data_by_key', self.hist.data_by_key)
+        track_memory('FeatureTable', self.features)
+        track_memory('CandidateTutors group scores', self._group_scores)
+
+def good_pairing(hist, students, tutors, student_topics, params=None,
+                 stats=None):
     """
     Start with an empty pairing.
     Sort the students by their attendance record.
@@ -1503,33 +3843,779 @@ def good_pairing(hist, students, tutors, student_topics, params=None):
     This is not guaranteed to result in the best pairing, but it will
     usually result in a pretty good one.
 
-    No attempt was made to make this efficient.
+    The candidate tutors for each student come from CandidateTutors,
+    which skips any tutor that can't beat the best one found so far.
+
+    @param stats: if given, a dict to put the number of candidate
+    tutors scored, pruned and skipped as interchangeable in
     """
+    cands = CandidateTutors(hist, tutors, student_topics, params)
     by_attendance = sorted(students,
                            reverse=True,
-                           key = lambda s: len(hist.get_matches(student=s)))
+                           key = lambda s: cands.attendance[s])
     pairing = []
+    groups = collections.defaultdict(list)
     n_students = len(students)
     for (n, student) in enumerate(by_attendance):
         print "Running {0}/{1}:".format(n, n_students), student
-        best_score = None
-        best_pair = None
-        for tutor in tutors:
-            (this_score, _) = get_score(pairing + [(tutor, student)],
-                                        hist, student_topics,
-                                        params)
-            if best_score is None or this_score > best_score:
-                best_score = this_score
-                best_pair = (tutor, student)
-        pairing.append(best_pair)
+        best = cands.best_tutor(student, groups)
+        if best is None:
+            pairing.append(None)
+            continue
+        (tutor, _) = best
+        groups[tutor].append(student)
+        pairing.append((tutor, student))
+    logging.info("Scored %s candidate tutors, pruned %s, skipped %s "
+                 "interchangeable ones", cands.n_scored, cands.n_pruned,
+                 cands.n_symmetric)
+    cands.track_memory()
+    if stats is not None:
+        stats.update(scored=cands.n_scored, pruned=cands.n_pruned,
+                     symmetric=cands.n_symmetric)
+    return pairing
+
+def regret_pairing(hist, students, tutors, student_topics, params=None,
+                   stats=None):
+    """
+    Like good_pairing, but instead of taking the students in a fixed
+    order, always place the student with the most to lose next: the
+    one with the biggest gap (their regret) between the score from
+    adding them to their best tutor's group and to their second best.
+    That way a student with only one good tutor gets them before
+    someone else takes them.  Ties go to the student who comes first
+    in good_pairing's order, and a student's best tutor is picked like
+    in CandidateTutors.best_tutor.
+
+    Each student's score with each tutor is kept, along with a
+    priority queue of the students by regret.  Placing a student only
+    changes their tutor's group, so after that only that tutor's score
+    is worked out again for each of the other students, and a student
+    only gets a new place in the queue if their regret changed.
+
+    @param stats: if given, a dict to put the number of scores worked
+    out, and the number of times a student's regret changed, in
+    """
+    cands = CandidateTutors(hist, tutors, student_topics, params)
+    tutors = cands.tutors
+    if len(tutors) == 0:
+        return [None] * len(students)
+    by_attendance = sorted(students,
+                           reverse=True,
+                           key = lambda s: cands.attendance[s])
+    rank = dict((s, ii) for (ii, s) in enumerate(by_attendance))
+    n_tutors = len(tutors)
+    groups = collections.defaultdict(list)
+    # student -> the score from adding them to each tutor's group
+    deltas = dict((s, [cands.constrained_delta(t, s, ()) for t in tutors])
+                  for s in students)
+    n_scored = len(students) * n_tutors
+    n_changed = 0
+    # student -> (index of best tutor, index of second best tutor)
+    top = {}
+    # student -> their key in the queue; older keys are ignored
+    current = {}
+    queue = []
+
+    def update(student):
+        row = deltas[student]
+        ranked = heapq.nlargest(2, xrange(n_tutors),
+                                key=lambda ii: (row[ii], -ii))
+        top[student] = (ranked[0], ranked[-1])
+        key = (row[ranked[-1]] - row[ranked[0]], rank[student])
+        if current.get(student) != key:
+            current[student] = key
+            heapq.heappush(queue, (key, student))
+            return True
+        return False
+
+    for student in by_attendance:
+        update(student)
+    pairing = []
+    while len(queue) > 0:
+        (key, student) = heapq.heappop(queue)
+        if current.get(student) != key:
+            continue
+        del current[student]
+        ii = top[student][0]
+        tutor = tutors[ii]
+        groups[tutor].append(student)
+        pairing.append((tutor, student))
+        for other in current.keys():
+            row = deltas[other]
+            row[ii] = cands.constrained_delta(tutor, other, groups[tutor])
+            n_scored += 1
+            (best, second) = top[other]
+            if ii in (best, second) or (row[ii], -ii) > (row[second],
+                                                        -second):
+                n_changed += update(other)
+    logging.info("Scored %s tutors for students, regret changed %s times",
+                 n_scored, n_changed)
+    cands.track_memory()
+    if stats is not None:
+        stats.update(scored=n_scored, regret_changes=n_changed)
+    return pairing
+
+def matched_pairing(hist, students, tutors, student_topics, params=None,
+                    stats=None):
+    """
+    When there are more students than tutors, some of them have to
+    share, and with good_pairing who shares with whom just falls out
+    of the order the students are taken in.  Instead, form the groups
+    first, then give each group a tutor:
+
+    - Start with each student in a group of their own.  While there
+      are more groups than tutors, merge some of them two at a time,
+      picking the merges with a maximum weight matching (see
+      pairing_matching) on a graph with a vertex for each group.  The
+      weight of an edge is the best score the two groups could get
+      together, with any tutor, minus the best scores they could get
+      apart.
+
+      Each round makes at most one merge per tutor: with up to twice
+      as many students as tutors, one round makes pairs and leaves the
+      rest on their own, with up to three times as many, the next
+      round adds a third student to some of the pairs, and so on.  To
+      make exactly that many merges, the graph also has a dummy vertex
+      for each group that should stay as it is, joined to every group
+      with weight 0, and everyone has to be matched.
+
+    - Then give each group a tutor with another maximum weight
+      matching, between the groups and the tutors, where the weight
+      of an edge is the score of the group with that tutor.
+
+    - The matchings don't see that the best tutors for different
+      groups are often the same, so finally, move students to the tutor
+      that's best for them (see CandidateTutors.best_tutor) while that
+      raises the score.
+
+    The scores are rounded to thousandths for the matchings, so they
+    can be done in integers, and with hard_constraints, excluded
+    students count like in CandidateTutors.best_tutor (see
+    CandidateTutors.constrained_score).
+
+    @param stats: if given, a dict to put the number of rounds of
+    merging, the number of edges in all of the matchings, and the
+    number of students moved at the end, in
+    """
+    import pairing_matching
+    cands = CandidateTutors(hist, tutors, student_topics, params)
+    tutors = cands.tutors
+    if len(tutors) == 0:
+        return [None] * len(students)
+    n_tutors = len(tutors)
+    by_attendance = sorted(students,
+                           reverse=True,
+                           key = lambda s: cands.attendance[s])
+
+    def weight(score):
+        return int(round(score * 1000))
+
+    def best_score(group):
+        return max(cands.constrained_score(t, group) for t in tutors)
+
+    groups = [[s] for s in by_attendance]
+    n_rounds = 0
+    n_edges = 0
+    while len(groups) > n_tutors:
+        n_rounds += 1
+        n_groups = len(groups)
+        n_same = 2 * max(n_tutors, n_groups - n_tutors) - n_groups
+        scores = [best_score(g) for g in groups]
+        edges = [(ii, jj, weight(best_score(groups[ii] + groups[jj]) -
+                                 scores[ii] - scores[jj]))
+                 for ii in xrange(n_groups)
+                 for jj in xrange(ii + 1, n_groups)]
+        edges.extend((ii, n_groups + dd, 0)
+                     for ii in xrange(n_groups)
+                     for dd in xrange(n_same))
+        n_edges += len(edges)
+        mate = pairing_matching.max_weight_matching(edges,
+                                                    maxcardinality=True)
+        merged = []
+        for (ii, jj) in enumerate(mate[:n_groups]):
+            if ii < jj < n_groups:
+                merged.append(groups[ii] + groups[jj])
+            elif jj < 0 or jj >= n_groups:
+                merged.append(groups[ii])
+        groups = merged
+        logging.info("Round %s: %s groups", n_rounds, len(groups))
+
+    n_groups = len(groups)
+    edges = [(ii, n_groups + jj,
+              weight(cands.constrained_score(tutor, group)))
+             for (ii, group) in enumerate(groups)
+             for (jj, tutor) in enumerate(tutors)]
+    n_edges += len(edges)
+    mate = pairing_matching.max_weight_matching(edges, maxcardinality=True)
+    tutor_of = {}
+    by_tutor = collections.defaultdict(list)
+    for (ii, group) in enumerate(groups):
+        tutor = tutors[mate[ii] - n_groups]
+        by_tutor[tutor] = list(group)
+        for student in group:
+            tutor_of[student] = tutor
+
+    # Each move raises the score, so this stops
+    n_moves = 0
+    moved = True
+    while moved:
+        moved = False
+        for student in by_attendance:
+            tutor = tutor_of[student]
+            by_tutor[tutor].remove(student)
+            current = cands.constrained_delta(tutor, student,
+                                              by_tutor[tutor])
+            (best, _) = cands.best_tutor(student, by_tutor)
+            delta = cands.constrained_delta(best, student, by_tutor[best])
+            if delta > current:
+                tutor_of[student] = tutor = best
+                n_moves += 1
+                moved = True
+            by_tutor[tutor].append(student)
+    logging.info("Formed %s groups in %s rounds, %s edges, then moved %s "
+                 "students", n_groups, n_rounds, n_edges, n_moves)
+    cands.track_memory()
+    if stats is not None:
+        stats.update(rounds=n_rounds, edges=n_edges, moves=n_moves)
+    return [(tutor_of[s], s) for s in by_attendance]
+
+def randomized_pairing(hist, students, tutors, student_topics, params=None,
+                       rng=None, noise=0):
+    """
+    good_pairing with some randomness, for portfolio_pairing:
+
+    - Tutors are shuffled, so ties between them are broken at random.
+    - Students are still taken in order of attendance, but students
+      whose attendance is within noise of each other may swap places.
+    - Each candidate tutor's score gets a random number between 0 and
+      noise added to it (see CandidateTutors.best_tutor).
+
+    With no rng, this gives the same pairing as good_pairing.
+    """
+    if rng is not None:
+        tutors = list(tutors)
+        rng.shuffle(tutors)
+    cands = CandidateTutors(hist, tutors, student_topics, params)
+    if rng is None:
+        order = sorted(students, reverse=True,
+                       key=lambda s: cands.attendance[s])
+    else:
+        order = sorted(students, reverse=True,
+                       key=lambda s: (cands.attendance[s] +
+                                      rng.uniform(0, noise),
+                                      rng.random()))
+    pairing = []
+    groups = collections.defaultdict(list)
+    for student in order:
+        best = cands.best_tutor(student, groups, rng=rng, noise=noise)
+        if best is None:
+            pairing.append(None)
+            continue
+        (tutor, _) = best
+        groups[tutor].append(student)
+        pairing.append((tutor, student))
+    return pairing
+
+# What each process in portfolio_pairing's pool needs.  It's set by
+# init_portfolio rather than passed with each start, so that the
+# historical data is only sent to each process once.
+_portfolio = None
+
+def init_portfolio(*args):
+    global _portfolio
+    _portfolio = args
+
+def run_portfolio_start(start):
+    """
+    Run start number start of portfolio_pairing.  Start 0 is
+    good_pairing; the others are randomized_pairing with a random
+    number generator seeded by the portfolio's seed and start.
+
+    @return a tuple of (score, start, pairing)
+    """
+    (hist, students, tutors, student_topics, params) = _portfolio
+    if start == 0:
+        rng = None
+    else:
+        rng = random.Random('{0}:{1}'.format(params.portfolio_seed, start))
+    pairing = randomized_pairing(hist, students, tutors, student_topics,
+                                 params, rng=rng,
+                                 noise=params.portfolio_noise)
+    (score, _) = get_score(pairing, hist, student_topics, params=params)
+    return (score, start, pairing)
+
+def portfolio_pairing(hist, students, tutors, student_topics, params=None,
+                      processes=None, deadline=None, seed=None, stats=None):
+    """
+    Run good_pairing and params.portfolio_starts - 1 randomized
+    versions of it (see randomized_pairing) on a pool of processes, and
+    return the pairing with the highest score.  Since good_pairing is
+    one of the starts, this never does worse than it.
+
+    Each start's random numbers depend only on params.portfolio_seed
+    and the start's number, and ties go to the lowest start, so the
+    same seed always gives the same pairing, however many processes
+    there are.
+
+    @param processes: how many processes to use, by default one for
+    each cpu
+
+    @param deadline: if given, a time.time() after which no more
+    results are waited for (good_pairing's always is).  Which starts
+    finish in time can vary, so then the result can too.
+
+    @param seed: if given, a pairing for mostly the same people.  It's
+    fixed up with good_repair and is one more start, after the others.
+
+    @param stats: if given, a dict to put the number of starts that
+    finished, and the best start and its score in
+    """
+    if params is None:
+        params = ScoreParams()
+    starts = params.portfolio_starts
+    if starts <= 1 and seed is None:
+        return good_pairing(hist, students, tutors, student_topics, params,
+                            stats=stats)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, starts)
+    args = (hist.in_memory(), list(students), list(tutors),
+            dict(student_topics), params)
+    print "Trying {0} pairings on {1} processes".format(starts, processes)
+    results = []
+    if processes <= 1:
+        init_portfolio(*args)
+        for start in range(starts):
+            if start > 0 and deadline is not None and time.time() > deadline:
+                break
+            results.append(run_portfolio_start(start))
+    else:
+        pool = multiprocessing.Pool(processes, init_portfolio, args)
+        try:
+            pending = pool.imap(run_portfolio_start, range(starts))
+            for start in range(starts):
+                if start == 0 or deadline is None:
+                    results.append(pending.next())
+                    continue
+                try:
+                    results.append(pending.next(
+                        max(0, deadline - time.time())))
+                except multiprocessing.TimeoutError:
+                    break
+        finally:
+            if len(results) < starts:
+                pool.terminate()
+            else:
+                pool.close()
+            pool.join()
+    if seed is not None:
+        (score, repaired) = repair_seed(hist, seed, students, tutors,
+                                        student_topics, params)
+        results.append((score, starts, repaired))
+    for (score, start, _) in results:
+        logging.info("Portfolio start %s scored %s", start, score)
+    (score, start, pairing) = max(results, key=lambda r: (r[0], -r[1]))
+    print "Best pairing was from start {0} with score {1}".format(start,
+                                                                 score)
+    if stats is not None:
+        stats.update(starts=len(results), best_start=start, score=score)
     return pairing
 
+def allocate_tutors(cands, clusters, tutors):
+    """
+    Divide the tutors between clusters of students for
+    clustered_pairing.  Each cluster gets a share of the tutors in
+    proportion to its number of students (but never more tutors than
+    students), and within those shares, tutors go to the clusters with
+    the students they have the best history with (see
+    CandidateTutors.pair_score).  When there are more clusters than
+    tutors, the smallest clusters get none.
+
+    @param clusters: a dict from topic to the list of students
+
+    @return a tuple of a dict from topic to the list of its tutors, and
+    a list of the tutors who weren't needed anywhere
+    """
+    n_students = sum(len(c) for c in clusters.itervalues())
+    n_tutors = len(tutors)
+    exact = dict((topic, len(group) * n_tutors / n_students)
+                 for (topic, group) in clusters.iteritems())
+    quotas = dict((topic, int(share)) for (topic, share) in exact.items())
+    # Largest remainder, then the biggest clusters
+    by_remainder = sorted(clusters, key=lambda t: (-(exact[t] - quotas[t]),
+                                                   -len(clusters[t]), t))
+    for topic in by_remainder[:n_tutors - sum(quotas.values())]:
+        quotas[topic] += 1
+    # Every cluster should get a tutor, if there are enough to go around
+    by_size = sorted(clusters, key=lambda t: (-len(clusters[t]), t))
+    for topic in reversed(by_size):
+        if quotas[topic] > 0:
+            continue
+        donors = [t for t in by_size if quotas[t] > 1]
+        if len(donors) == 0:
+            break
+        quotas[donors[0]] -= 1
+        quotas[topic] += 1
+    for topic in clusters:
+        quotas[topic] = min(quotas[topic], len(clusters[topic]))
+
+    affinity = sorted(((-sum(max(0, cands.pair_score(tutor, student))
+                             for student in clusters[topic]),
+                        ii, topic, tutor)
+                       for (ii, tutor) in enumerate(tutors)
+                       for topic in clusters))
+    allocation = dict((topic, []) for topic in clusters)
+    assigned = set()
+    for (_, _, topic, tutor) in affinity:
+        if tutor in assigned or len(allocation[topic]) >= quotas[topic]:
+            continue
+        allocation[topic].append(tutor)
+        assigned.add(tutor)
+    idle = [tutor for tutor in tutors if tutor not in assigned]
+    return (allocation, idle)
+
+def run_cluster(args):
+    """
+    Solve one cluster for clustered_pairing, in this process or in one
+    of its pool's
+    """
+    (hist, students, tutors, student_topics, params) = args
+    return good_pairing(hist, students, tutors, student_topics, params)
+
+def clustered_pairing(hist, students, tutors, student_topics, params=None,
+                      processes=1, stats=None):
+    """
+    Since students working on different topics are rarely put
+    together (see penalty_different_topics), split the students into a
+    cluster for each topic, divide the tutors between the clusters
+    (see allocate_tutors), and solve each cluster on its own with
+    good_pairing.  The clusters are much smaller than the whole
+    session, and can be solved in parallel.
+
+    Then, across all the clusters: students whose cluster didn't get a
+    tutor are added to the best group, like in good_pairing, and a
+    student who shares a tutor is moved to a tutor who has no students
+    if that gets a better score.
+
+    @param processes: how many processes to solve the clusters with.
+    Starting the processes usually takes longer than solving a
+    session's clusters, so by default they're solved in this process.
+
+    @param stats: if given, a dict to put the number of clusters
+    solved, students left over and tutors left idle in
+    """
+    if params is None:
+        params = ScoreParams()
+    cands = CandidateTutors(hist, tutors, student_topics, params)
+    tutors = list(tutors)
+    clusters = collections.defaultdict(list)
+    for student in students:
+        clusters[cands.topic(student)].append(student)
+    if len(clusters) == 0 or len(tutors) == 0:
+        return good_pairing(hist, students, tutors, student_topics, params,
+                            stats=stats)
+    (allocation, idle) = allocate_tutors(cands, clusters, tutors)
+
+    solved = [topic for topic in sorted(clusters) if allocation[topic]]
+    args = [(hist, clusters[topic], allocation[topic], student_topics,
+             params)
+            for topic in solved]
+    # good_pairing prints each student, which isn't much use here
+    with quiet_stdout():
+        if processes <= 1 or len(args) <= 1:
+            results = map(run_cluster, args)
+        else:
+            pool = multiprocessing.Pool(min(processes, len(args)))
+            try:
+                results = pool.map(run_cluster,
+                                   [(hist.in_memory(),) +
+                                    a[1:] for a in args])
+            finally:
+                pool.close()
+                pool.join()
+
+    groups = collections.defaultdict(list)
+    for result in results:
+        for (tutor, student) in result:
+            groups[tutor].append(student)
+    leftover = sorted((s
+                       for topic in clusters if not allocation[topic]
+                       for s in clusters[topic]),
+                      reverse=True, key=lambda s: cands.attendance[s])
+    for student in leftover:
+        (tutor, _) = cands.best_tutor(student, groups)
+        groups[tutor].append(student)
+
+    # Move students who share a tutor to a free one, if it's better
+    for tutor in sorted(groups):
+        for student in list(groups[tutor]):
+            if len(groups[tutor]) < 2:
+                break
+            free = set(t for t in tutors if len(groups.get(t, ())) == 0)
+            if len(free) == 0:
+                break
+            rest = [s for s in groups[tutor] if s != student]
+            # Both sides count the hard constraints, like best_tutor
+            loss = cands.constrained_delta(tutor, student, rest)
+            best = cands.best_tutor(student, {}, among=free)
+            if cands.constrained_delta(best[0], student, ()) > loss:
+                groups[tutor] = rest
+                groups[best[0]].append(student)
+    logging.info("Solved %s topic clusters, %s students left over, "
+                 "%s tutors idle", len(solved), len(leftover), len(idle))
+    if stats is not None:
+        stats.update(clusters=len(solved), leftover=len(leftover),
+                     idle=len(idle))
+    return [(tutor, student)
+            for tutor in sorted(groups)
+            for student in groups[tutor]]
+
+# The solvers that solve_pairing can use, by name.  See register_solver.
+SOLVERS = {}
+
+def register_solver(name, takes_seed=False):
+    """
+    A decorator to add a solver to SOLVERS.  A solver is called with
+    (hist, students, tutors, student_topics, params, deadline), where
+    deadline is a time.time() it should try to be done by, or None.
+    It returns a tuple of the pairing (a list of (tutor, student)) and
+    a dict of stats about how it went.  If the stats have a 'score',
+    it must be the pairing's score.
+
+    @param takes_seed: if true, the solver is also called with seed,
+    a pairing for mostly the same people to start from (for example,
+    from the SolveCache), or None.  It may be for tutors and students
+    who aren't here any more, and not have ones who are.
+    """
+    def register(func):
+        func.takes_seed = takes_seed
+        SOLVERS[name] = func
+        return func
+    return register
+
+@register_solver('good_pairing', takes_seed=True)
+def solve_good_pairing(hist, students, tutors, student_topics, params,
+                       deadline, seed=None):
+    stats = {}
+    pairing = good_pairing(hist, students, tutors, student_topics, params,
+                           stats=stats)
+    if seed is not None:
+        # The seed, fixed up, is only kept if it beats solving afresh
+        (score, _) = get_score(pairing, hist, student_topics, params=params)
+        (seed_score, repaired) = repair_seed(hist, seed, students, tutors,
+                                             student_topics, params)
+        stats.update(seeded=seed_score > score)
+        if seed_score > score:
+            print "The similar pairing scored {0}, better than {1}".format(
+                seed_score, score)
+            (pairing, score) = (repaired, seed_score)
+        stats.update(score=score)
+    return (pairing, stats)
+
+@register_solver('regret')
+def solve_regret(hist, students, tutors, student_topics, params, deadline):
+    stats = {}
+    pairing = regret_pairing(hist, students, tutors, student_topics, params,
+                             stats=stats)
+    return (pairing, stats)
+
+@register_solver('matching')
+def solve_matching(hist, students, tutors, student_topics, params, deadline):
+    stats = {}
+    pairing = matched_pairing(hist, students, tutors, student_topics, params,
+                              stats=stats)
+    return (pairing, stats)
+
+@register_solver('portfolio', takes_seed=True)
+def solve_portfolio(hist, students, tutors, student_topics, params,
+                    deadline, seed=None):
+    stats = {}
+    pairing = portfolio_pairing(hist, students, tutors, student_topics,
+                                params, deadline=deadline, seed=seed,
+                                stats=stats)
+    return (pairing, stats)
+
+@register_solver('clustered')
+def solve_clustered(hist, students, tutors, student_topics, params,
+                    deadline):
+    stats = {}
+    pairing = clustered_pairing(hist, students, tutors, student_topics,
+                                params, stats=stats)
+    return (pairing, stats)
+
+def solve_pairing(hist, students, tutors, student_topics, params=None,
+                  seed=None):
+    """
+    Find a pairing with params.solver, giving it params.solver_seconds
+    seconds if that's set.
+
+    @param seed: a pairing to start from, for solvers that take one
+    (see register_solver).  Other solvers ignore it.
+
+    @return a tuple of the pairing and the solver's stats, plus the
+    solver's name and how many seconds it took
+    """
+    if params is None:
+        params = ScoreParams()
+    if params.solver not in SOLVERS:
+        raise ValueError("Unknown solver {0}, should be one of {1}".format(
+            params.solver, ', '.join(sorted(SOLVERS))))
+    start = time.time()
+    deadline = None
+    if params.solver_seconds > 0:
+        deadline = start + params.solver_seconds
+    solver = SOLVERS[params.solver]
+    kwargs = {}
+    if solver.takes_seed:
+        kwargs['seed'] = seed
+    (pairing, stats) = solver(hist, students, tutors, student_topics,
+                              params, deadline, **kwargs)
+    stats = dict(stats, solver=params.solver,
+                 seconds=round(time.time() - start, 3))
+    logging.info("Solver stats: %s", stats)
+    return (pairing, stats)
+
+def check_pairing(pairing, stats, hist, students, tutors, student_topics,
+                  params=None):
+    """
+    Check what a solver came up with: every student is in the pairing
+    once, every tutor in it is one of tutors, and it gets the same
+    score from get_score as from score_candidates (and the stats, if
+    the solver reported a score).  Raises a RuntimeError if not.
+
+    @return the score
+    """
+    if params is None:
+        params = ScoreParams()
+    solver = stats.get('solver')
+    if None in pairing:
+        raise RuntimeError("Solver {0} left some students out".format(
+            solver))
+    paired = sorted(s for (_, s) in pairing)
+    if paired != sorted(students):
+        raise RuntimeError("Solver {0} paired {1} instead of {2}".format(
+            solver, paired, sorted(students)))
+    extra = set(t for (t, _) in pairing) - set(tutors)
+    if extra:
+        raise RuntimeError("Solver {0} used tutors {1} who aren't "
+                           "here".format(solver, sorted(extra)))
+    (score, _) = get_score(pairing, hist, student_topics, params=params)
+    [(fast_score, _)] = score_candidates(hist, student_topics, [pairing],
+                                         params=params)
+    scores = [fast_score] + ([stats['score']] if 'score' in stats else [])
+    if any(abs(other - score) > 1e-9 for other in scores):
+        raise RuntimeError("Solver {0}'s pairing scored {1} but also "
+                           "{2}".format(solver, score, scores))
+    return score
+
+def good_repair(hist, pairing, students, tutors, student_topics,
+                params=None, min_gain=None):
+    """
+    Change an existing pairing as little as possible to account for
+    the students and tutors who are here now:
+
+    - Pairs whose student and tutor are both still here are kept.
+    - Students who just arrived, or whose tutor left, are added one at
+      a time to the best tutor, like in good_pairing.
+    - A student who is already seated is only moved to a tutor whose
+      group changed (or who just arrived) if that gains at least
+      min_gain points (params.repair_min_gain if not given).
+
+    @return a tuple of the new pairing and the set of tutors whose
+    groups changed
+
+    >>> hist = HistoricalData()
+    >>> (pairing, changed) = good_repair(
+    ...     hist, [('Ann', 'Bo'), ('Ann', 'Di'), ('Cy', 'Ed')],
+    ...     ['Bo', 'Di', 'Ed', 'Flo'], ['Ann', 'Gus'],
+    ...     {'Bo': '#', 'Di': '#', 'Ed': '#', 'Flo': '#'})
+    >>> sorted(pairing)
+    [('Ann', 'Bo'), ('Ann', 'Di'), ('Gus', 'Ed'), ('Gus', 'Flo')]
+    >>> sorted(changed)
+    ['Cy', 'Gus']
+    """
+    if params is None:
+        params = ScoreParams()
+    cands = CandidateTutors(hist, tutors, student_topics, params)
+    present = set(tutors)
+    groups = collections.defaultdict(list)
+    seated = set()
+    changed = set()
+    for (tutor, student) in pairing:
+        if (tutor in present and student in student_topics and
+            student not in seated):
+            groups[tutor].append(student)
+            seated.add(student)
+        else:
+            changed.add(tutor)
+
+    # Seat everyone who isn't seated yet
+    unseated = sorted([s for s in students if s not in seated],
+                      reverse=True,
+                      key=lambda s: cands.attendance[s])
+    for student in unseated:
+        best = cands.best_tutor(student, groups)
+        if best is None:
+            continue
+        (tutor, _) = best
+        groups[tutor].append(student)
+        changed.add(tutor)
+
+    # Only move students who are already seated if it's worth it.
+    # Every move gains at least one point, so this stops.
+    if min_gain is None:
+        min_gain = params.repair_min_gain
+    min_gain = max(1, min_gain)
+    moved = True
+    while moved:
+        moved = False
+        for tutor in sorted(groups):
+            for student in list(groups[tutor]):
+                rest = [s for s in groups[tutor] if s != student]
+                loss = (cands.group_score(tutor, groups[tutor]) -
+                        cands.group_score(tutor, rest))
+                others = dict(groups)
+                others[tutor] = rest
+                # Tutors who just arrived or whose group already changed
+                open_tutors = ((changed | (present - set(groups))) -
+                               set([tutor]))
+                best = cands.best_tutor(student, others, among=open_tutors)
+                if best is None or best[1] - loss < min_gain:
+                    continue
+                logging.info("Moving %s from %s to %s gains %s points",
+                             student, tutor, best[0], best[1] - loss)
+                groups[tutor] = rest
+                groups[best[0]].append(student)
+                changed.update((tutor, best[0]))
+                moved = True
+
+    pairing = [(tutor, student)
+               for tutor in sorted(groups)
+               for student in groups[tutor]]
+    cands.track_memory()
+    return (pairing, changed)
+
+def repair_seed(hist, seed, students, tutors, student_topics, params=None):
+    """
+    Fix up seed, a pairing for mostly the same people (see
+    register_solver), for the students and tutors here with
+    good_repair, moving anyone that gains a point.
+
+    @return a tuple of its score and the fixed up pairing
+    """
+    (repaired, _) = good_repair(hist, seed, students, tutors,
+                                student_topics, params, min_gain=1)
+    (score, _) = get_score(repaired, hist, student_topics, params=params)
+    return (score, repaired)
+
 def good_historical_score(hist, date, session, params=None):
     (actual, student_topics) = hist.get_pairing(date, session)
     students = set([p[1] for p in actual])
     tutors = set([p[0] for p in actual if p[0].strip() != ''])
     past_data = hist.get_data_before(date, session)
-    return good_pairing(past_data, students, tutors, student_topics, params)
+    (pairing, _) = solve_pairing(past_data, students, tutors,
+                                 student_topics, params)
+    return pairing
 
 # --------------------------------------------------------------------
 # Functions to print or compare pairings
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+"""
+Replay the old spreadsheets through the solvers, to check that making
+them faster doesn't make the pairings worse.
+
+For every week in the DataCatalog (data/<year>/<session>.csv), each
+solver (see pairing.SOLVERS) gets the students and tutors who were
+actually there that week, and the history from before it, just like
+good_historical_score.  Each solver's pairing is checked with
+pairing.check_pairing.  For each solver and week we record:
+
+  score          the score of the solver's pairing
+  vs_actual      score minus the score of the pairing that was used
+                 that week (see score_historical)
+  vs_best        score minus the best score any solver got that week
+  seconds        how long the solver took
+  peak_kb        how much the solver raised the peak memory use of
+                 its process (not available on Windows)
+  stats          the stats the solver reported
+
+If a solver fails (it raises an exception, its pairing doesn't pass
+check_pairing, or its process dies), that week's result for it is just
+the error, and the summary counts the errors.  The other totals are
+over the weeks it didn't fail.
+
+Each solver runs in its own process for each week, so that the peak
+memory is just for that run.  The results, and a summary for each
+solver, are written as JSON with sorted keys, so two runs can be
+diffed:
+
+  python pairing_benchmark.py [--output benchmark.json] [--year 2012]
+"""
+# -------------------------------------------------------
+# Imports and Constants
+#
+
+from __future__ import absolute_import, division, with_statement
+
+import json
+import logging
+import multiprocessing
+import optparse
+import Queue
+import sys
+import time
+import traceback
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+import pairing
+
+# -------------------------------------------------------
+# Main + command line parsing
+#
+
+def main(*args):
+    opts = getopts(args)
+    params = pairing.ScoreParams()
+    if opts.params is not None:
+        params = pairing.ScoreParams.from_csv(opts.params)
+    solvers = sorted(pairing.SOLVERS) if opts.solver is None else opts.solver
+    results = run_benchmark(pairing.DataCatalog(opts.data_dir), solvers,
+                            params, years=opts.year,
+                            portfolio_starts=opts.portfolio_starts)
+    with open(opts.output, 'w') as fd:
+        json.dump(results, fd, sort_keys=True, indent=1)
+        fd.write("\n")
+    for solver in solvers:
+        print "{0:15s} {1}".format(solver, json.dumps(
+            results['summary'][solver], sort_keys=True))
+
+def getopts(args=None):
+    parser = optparse.OptionParser()
+    parser.add_option('--output',
+                      default='benchmark.json',
+                      help='where to write the results')
+    parser.add_option('--data_dir',
+                      help='the directory with the old spreadsheets, by '
+                      'default the one in this repository')
+    parser.add_option('--year',
+                      type=int,
+                      action='append',
+                      help='only replay this season (can be given more '
+                      'than once)')
+    parser.add_option('--solver',
+                      action='append',
+                      help='only run this solver (can be given more than '
+                      'once), one of: ' + ', '.join(sorted(pairing.SOLVERS)))
+    parser.add_option('--params',
+                      help='a Parameters.csv to score with')
+    parser.add_option('--portfolio_starts',
+                      type=int,
+                      default=8,
+                      help='how many starts the portfolio solver uses')
+    parser.add_option('--log_level',
+                      help='set the log level')
+
+    (opts, args) = parser.parse_args(list(args) if len(args) > 0 else None)
+
+    if len(args) > 0:
+        raise ValueError("Did not expect to get any arguments: {0}".
+                         format(args))
+
+    for solver in opts.solver or ():
+        if solver not in pairing.SOLVERS:
+            raise ValueError("Unknown solver {0}, should be one of {1}".
+                             format(solver,
+                                    ', '.join(sorted(pairing.SOLVERS))))
+
+    if opts.log_level is not None:
+        level = getattr(logging, opts.log_level.upper())
+        logging.getLogger().setLevel(level)
+        logging.info("Setting log level to %s", level)
+
+    return opts
+
+# -------------------------------------------------------
+
+def peak_kb():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def replay_week(data_dir, year, session, date, solver, params, queue):
+    """
+    Run solver on one week, and put the result on queue, or if it
+    fails, the error.  This runs in its own process.
+    """
+    try:
+        queue.put(run_week(data_dir, year, session, date, solver, params))
+    except Exception:
+        queue.put({'error' : traceback.format_exc()})
+
+def run_week(data_dir, year, session, date, solver, params):
+    hist = pairing.DataCatalog(data_dir).get_data(year, year)
+    (actual, student_topics) = hist.get_pairing(date, session)
+    students = sorted(set(p[1] for p in actual))
+    tutors = sorted(set(p[0] for p in actual if p[0].strip() != ''))
+    past_data = hist.get_data_before(date, session)
+    past_data.data_by_key
+
+    before = peak_kb()
+    start = time.time()
+    # The solvers print their progress
+    with pairing.quiet_stdout():
+        (result, stats) = pairing.solve_pairing(
+            past_data, students, tutors, student_topics,
+            params.copy(solver=solver))
+    seconds = time.time() - start
+    after = peak_kb()
+
+    score = pairing.check_pairing(result, stats, past_data, students,
+                                  tutors, student_topics, params=params)
+    return {'score' : score,
+            'seconds' : round(seconds, 3),
+            'peak_kb' : None if after is None else after - before,
+            'stats' : stats}
+
+def wait_for_result(proc, queue):
+    """
+    The result replay_week puts on queue, or an error if proc exits
+    without putting one there
+    """
+    while True:
+        try:
+            return queue.get(timeout=1)
+        except Queue.Empty:
+            if proc.is_alive():
+                continue
+        # It may have put the result there just before exiting
+        try:
+            return queue.get(timeout=1)
+        except Queue.Empty:
+            return {'error' : "Exited with code {0} without a result".
+                    format(proc.exitcode)}
+
+def run_benchmark(catalog, solvers, params, years=None, portfolio_starts=8):
+    """
+    Replay every week of the seasons in catalog (or just the ones in
+    years) through each of solvers.
+
+    @return a dict with the results for each week and a summary for
+    each solver
+    """
+    params = params.copy(portfolio_starts=portfolio_starts)
+    weeks = []
+    for year in catalog.years:
+        if years is not None and year not in years:
+            continue
+        hist = catalog.get_data(year, year)
+        for (session, date) in sorted(set((p.session, p.date)
+                                          for p in hist.data)):
+            (actual, student_topics) = hist.get_pairing(date, session)
+            (actual_score, _) = pairing.score_historical(hist, date, session,
+                                                         params=params)
+            week = {'season' : year,
+                    'session' : session,
+                    'date' : date,
+                    'students' : len(set(p[1] for p in actual)),
+                    'actual_score' : actual_score,
+                    'results' : {}}
+            for solver in solvers:
+                queue = multiprocessing.Queue()
+                proc = multiprocessing.Process(
+                    target=replay_week,
+                    args=(catalog.data_dir, year, session, date, solver,
+                          params, queue))
+                proc.start()
+                result = wait_for_result(proc, queue)
+                proc.join()
+                if 'error' in result:
+                    logging.error("%s failed on %s %s %s:\n%s", solver, year,
+                                  session, date, result['error'])
+                else:
+                    result['vs_actual'] = result['score'] - actual_score
+                week['results'][solver] = result
+            scored = [r for r in week['results'].values() if 'error' not in r]
+            if len(scored) > 0:
+                best = max(r['score'] for r in scored)
+            for result in scored:
+                result['vs_best'] = result['score'] - best
+            logging.info("%s %s %s: %s", year, session, date,
+                         week['results'])
+            weeks.append(week)
+
+    summary = {}
+    for solver in solvers:
+        results = [week['results'][solver] for week in weeks]
+        errors = sum(1 for r in results if 'error' in r)
+        results = [r for r in results if 'error' not in r]
+        peaks = [r['peak_kb'] for r in results if r['peak_kb'] is not None]
+        summary[solver] = {
+            'weeks' : len(results),
+            'errors' : errors,
+            'total_score' : sum(r['score'] for r in results),
+            'total_vs_actual' : sum(r['vs_actual'] for r in results),
+            'weeks_below_actual' : sum(1 for r in results
+                                       if r['vs_actual'] < 0),
+            'weeks_below_best' : sum(1 for r in results if r['vs_best'] < 0),
+            'total_seconds' : round(sum(r['seconds'] for r in results), 3),
+            'max_peak_kb' : max(peaks) if len(peaks) > 0 else None}
+    return {'params' : dict((param, getattr(params, param))
+                            for param in params.PARAMS),
+            'solvers' : solvers,
+            'weeks' : weeks,
+            'summary' : summary}
+
+# -------------------------------------------------------
+
+if __name__ == "__main__":
+    with pairing.run_safely(spin=False):
+        main(*sys.argv[1:])
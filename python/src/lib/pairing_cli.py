@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+"""
+One command for everything that's done in a session directory, with a
+subcommand for each job:
+
+  python top_honors.py attendance
+  python top_honors.py run [--solver NAME]
+  python top_honors.py score
+  python top_honors.py save
+  python top_honors.py score-historical [--date DATE]
+  python top_honors.py backtest [--year YEAR] ...
+
+(top_honors.py is in src/bin, and the other scripts there run one of
+these subcommands.)  Run it with no subcommand to see them all.
+
+Only this module is loaded to start with.  The module a subcommand
+needs (pairing.py, or the benchmark or service, and whatever they
+import) is imported when it's run, so the list of subcommands, or a
+mistyped one, comes back right away.  --timing shows how long it took
+to load the subcommand and to run it.
+
+When a subcommand fails, the error is shown and it waits for Enter
+before exiting, so that the window it was started in (from one of the
+bat files) stays open long enough to read it.  --no_wait exits right
+away instead.
+"""
+# -------------------------------------------------------
+# Imports and Constants
+#
+
+from __future__ import absolute_import, division, with_statement
+
+import importlib
+import optparse
+import os.path
+import sys
+import time
+import traceback
+
+START = time.time()
+
+# (subcommand, module, function, whether the function takes the
+# arguments, description).  Functions that don't take the arguments
+# read them from sys.argv.
+COMMANDS = (
+    ('attendance', 'pairing', 'make_attendance_sheet', False,
+     "make a blank attendance sheet, with each student's last topic"),
+    ('run', 'pairing', 'run_pairing', False,
+     'find a pairing for the attendance sheet [--solver NAME]'),
+    ('repair', 'pairing', 'repair_pairing', False,
+     'update the pairing for changes to the attendance sheet'),
+    ('score', 'pairing', 'score_pairing', False,
+     'score the pairing, after changing it by hand'),
+    ('compare', 'pairing', 'compare_pairings', False,
+     'score and rank the pairings in Pairing*.csv [FILE ...]'),
+    ('save', 'pairing', 'save_pairing', False,
+     'add the pairing to the historical data'),
+    ('score-historical', 'pairing', 'score_historical_pairing', False,
+     'score a saved pairing, by default the last one [--date DATE]'),
+    ('backtest', 'pairing_benchmark', 'main', True,
+     'replay the old seasons through the solvers (see '
+     'pairing_benchmark.py)'),
+    ('service', 'pairing_service', 'main', True,
+     'start the pairing service'),
+)
+
+# -------------------------------------------------------
+# Main + command line parsing
+#
+
+def main(*args):
+    (opts, args) = getopts(args)
+    if len(args) == 0:
+        print usage()
+        return 0
+    return run_command(args[0], args[1:], wait=not opts.no_wait,
+                       timing=opts.timing)
+
+def getopts(args=None):
+    parser = optparse.OptionParser(usage=usage())
+    # The options after the subcommand are the subcommand's
+    parser.disable_interspersed_args()
+    parser.add_option('--timing',
+                      action='store_true',
+                      help='show how long the subcommand took to load '
+                      'and to run')
+    parser.add_option('--no_wait',
+                      action='store_true',
+                      help="if the subcommand fails, exit instead of "
+                      "waiting for Enter")
+    return parser.parse_args(list(args))
+
+def usage():
+    width = max(len(c[0]) for c in COMMANDS)
+    return '\n'.join(
+        ['{0} [--timing] [--no_wait] SUBCOMMAND [ARGS]'.format(
+            os.path.basename(sys.argv[0])), '',
+         'Subcommands:'] +
+        ['  {0:{1}s}  {2}'.format(name, width, description)
+         for (name, _, _, _, description) in COMMANDS])
+
+# -------------------------------------------------------
+
+def find_command(name):
+    for command in COMMANDS:
+        if command[0] == name:
+            return command
+    raise ValueError("Unknown subcommand {0}, should be one of {1}".format(
+        name, ', '.join(c[0] for c in COMMANDS)))
+
+def run_command(name, args, wait=True, timing=False):
+    """
+    Run the subcommand name with args.
+
+    @return the exit status: 0 if it worked, 1 if it didn't
+    """
+    loaded = None
+    try:
+        (_, module, function, takes_args, _) = find_command(name)
+        func = getattr(importlib.import_module(module), function)
+        loaded = time.time()
+        sys.argv = ['{0} {1}'.format(sys.argv[0], name)] + list(args)
+        if takes_args:
+            func(*args)
+        else:
+            func()
+    except (Exception, SystemExit) as e:
+        # optparse exits after showing the usage
+        if isinstance(e, SystemExit) and not e.code:
+            return 0
+        print "Error:"
+        print
+        traceback.print_exc()
+        print
+        if wait:
+            wait_to_exit()
+        return 1
+    finally:
+        if timing and loaded is None:
+            sys.stderr.write("{0}: failed after {1:.3f}s\n".format(
+                name, time.time() - START))
+        elif timing:
+            sys.stderr.write("{0}: loaded in {1:.3f}s, ran in {2:.3f}s\n".
+                             format(name, loaded - START,
+                                    time.time() - loaded))
+    return 0
+
+def wait_to_exit():
+    """
+    The same as pairing.wait_to_exit, which can't be used here in case
+    the error was in loading pairing
+    """
+    print "Press Enter to Exit"
+    try:
+        raw_input()
+    except (EOFError, KeyboardInterrupt):
+        pass
+
+# -------------------------------------------------------
+
+if __name__ == "__main__":
+    sys.exit(main(*sys.argv[1:]))
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+"""
+A feed of changes to the historical data and rosters, for the web
+client.
+
+The web client keeps its data in PouchDB, so rather than download all
+of the history every time it syncs, it asks for the changes since the
+last time it looked, like CouchDB's _changes feed.  Every student,
+tutor and week's pairing is a JSON document:
+
+  student:<name>               the Student's fields
+  tutor:<full name>            the Tutor's fields
+  pairing:<session>:<date>     the Pairs for that week
+
+The feed is a log, data/Changes.json, with a line for each version of
+a document.  Each line has a sequence number that's one more than the
+line before it.  When asked for changes, we first add a line for each
+document that's been added, changed or removed since the log was last
+updated, then return the latest version of each document with a
+sequence number after the one asked for.  Documents have a _rev (the
+number of versions, and a hash of the contents), so the client can
+store them with bulkDocs({docs: ..., new_edits: false}).
+
+When compact_history folds old seasons into the HistoryArchive, their
+weeks' pairings aren't in the historical data any more, but they
+haven't gone away, so the client keeps the versions it already has
+(see ChangeFeed.archived).
+
+From a session directory, print the changes since sequence number N:
+  python pairing_feed.py --since N
+
+The pairing service answers GET /changes?directory=DIR&since=N the same
+way.
+"""
+# -------------------------------------------------------
+# Imports and Constants
+#
+
+from __future__ import absolute_import, division, with_statement
+
+import hashlib
+import json
+import logging
+import operator
+import optparse
+import os.path
+import sys
+
+import pairing
+
+FEED_FILE = os.path.join('data', 'Changes.json')
+
+# -------------------------------------------------------
+# Main + command line parsing
+#
+
+def main(*args):
+    opts = getopts(args)
+    feed = ChangeFeed(os.path.join(opts.directory, FEED_FILE))
+    hist = pairing.open_history(opts.directory)
+    feed.update(ChangeFeed.documents(hist,
+                                     pairing.open_students(opts.directory),
+                                     pairing.open_tutors(opts.directory)),
+                archived=ChangeFeed.archived(hist))
+    print json.dumps(feed.changes_since(opts.since, doc_type=opts.type),
+                     indent=1)
+
+def getopts(args=None):
+    parser = optparse.OptionParser()
+    parser.add_option('--directory',
+                      default=os.curdir,
+                      help='the session directory')
+    parser.add_option('--since',
+                      type=int,
+                      default=0,
+                      help='only show changes after this sequence number')
+    parser.add_option('--type',
+                      help='only show documents of this type (student, '
+                      'tutor or pairing)')
+    parser.add_option('--log_level',
+                      help='set the log level')
+
+    (opts, args) = parser.parse_args(list(args) if len(args) > 0 else None)
+
+    if len(args) > 0:
+        raise ValueError("Did not expect to get any arguments: {0}".
+                         format(args))
+
+    if opts.log_level is not None:
+        level = getattr(logging, opts.log_level.upper())
+        logging.getLogger().setLevel(level)
+        logging.info("Setting log level to %s", level)
+
+    return opts
+
+# -------------------------------------------------------
+
+def to_doc(obj):
+    return dict((f, getattr(obj, f)) for f in obj.FIELDS)
+
+class ChangeFeed(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.last_seq = 0
+        # doc id -> _rev of the latest version in the log
+        self.revs = {}
+        self.deleted = set()
+        for change in self.read():
+            self.record(change['seq'], change['doc'])
+
+    def record(self, seq, doc):
+        self.last_seq = seq
+        self.revs[doc['_id']] = doc['_rev']
+        if doc.get('_deleted'):
+            self.deleted.add(doc['_id'])
+        else:
+            self.deleted.discard(doc['_id'])
+
+    def read(self):
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename) as fd:
+            for line in fd:
+                if line.strip():
+                    yield pairing.from_json(json.loads(line))
+
+    @classmethod
+    def documents(cls, hist, students, tutors):
+        """
+        Return a dict from doc id to document for everything that goes
+        in the feed
+        """
+        docs = {}
+        for student in students.data:
+            docs['student:' + student.name] = dict(to_doc(student),
+                                                   type='student')
+        for tutor in tutors.data:
+            docs['tutor:' + tutor.full_name] = dict(to_doc(tutor),
+                                                    type='tutor')
+        for pair in sorted(hist.data, key=operator.attrgetter(
+                *pairing.HistoricalData.ORDER)):
+            doc_id = 'pairing:{0}:{1}'.format(pair.session, pair.date)
+            if doc_id not in docs:
+                docs[doc_id] = {'type' : 'pairing',
+                                'session' : pair.session,
+                                'date' : pair.date,
+                                'pairs' : []}
+            docs[doc_id]['pairs'].append(to_doc(pair))
+        return docs
+
+    @classmethod
+    def archived(cls, hist):
+        """
+        Return the set of (session, season) that hist has folded into
+        its HistoryArchive, if it has one
+        """
+        archive = getattr(hist, 'archive', pairing.HistoryArchive())
+        return set((row.session, row.season) for row in archive.data)
+
+    @classmethod
+    def is_archived(cls, doc_id, archived):
+        if not doc_id.startswith('pairing:'):
+            return False
+        (session, date) = doc_id[len('pairing:'):].rsplit(':', 1)
+        return (session, pairing.get_season(int(date))) in archived
+
+    @classmethod
+    def content_hash(cls, doc):
+        return hashlib.md5(json.dumps(doc, sort_keys=True)).hexdigest()
+
+    def update(self, docs, archived=()):
+        """
+        Add a change to the log for every document in docs that's new
+        or different, and for every document that's no longer there,
+        except the pairings for archived seasons.
+
+        @param archived: the (session, season) that have been folded
+        into the HistoryArchive (see archived)
+
+        @return the number of changes added
+        """
+        changes = []
+        for doc_id in sorted(docs):
+            content = self.content_hash(docs[doc_id])
+            old_rev = self.revs.get(doc_id)
+            if old_rev is not None and old_rev.split('-', 1)[1] == content:
+                continue
+            if old_rev is None:
+                generation = 1
+            else:
+                generation = int(old_rev.split('-')[0]) + 1
+            changes.append(dict(docs[doc_id], _id=doc_id,
+                                _rev='{0}-{1}'.format(generation, content)))
+        for doc_id in sorted(self.revs):
+            if (doc_id not in docs and doc_id not in self.deleted and
+                not self.is_archived(doc_id, archived)):
+                generation = int(self.revs[doc_id].split('-')[0]) + 1
+                tombstone = {'_id' : doc_id, '_deleted' : True}
+                tombstone['_rev'] = '{0}-{1}'.format(
+                    generation, self.content_hash(tombstone))
+                changes.append(tombstone)
+        if not changes:
+            return 0
+        with open(self.filename, 'a') as fd:
+            for doc in changes:
+                self.record(self.last_seq + 1, doc)
+                fd.write(json.dumps({'seq' : self.last_seq,
+                                     'id' : doc['_id'],
+                                     'doc' : doc}))
+                fd.write("\n")
+        logging.info("Added %s changes to %s, up to %s",
+                     len(changes), self.filename, self.last_seq)
+        return len(changes)
+
+    def changes_since(self, since=0, doc_type=None):
+        """
+        Return the latest version of each document changed after
+        sequence number since, in the same form as CouchDB's _changes:
+        {'results' : [{'seq' : ..., 'id' : ..., 'doc' : ...}, ...],
+         'last_seq' : ...}
+
+        @param doc_type: if given, only include documents of this type
+        """
+        latest = {}
+        for change in self.read():
+            if change['seq'] <= since:
+                continue
+            if (doc_type is not None and
+                not change['id'].startswith(doc_type + ':')):
+                continue
+            latest[change['id']] = change
+        return {'results' : sorted(latest.values(), key=lambda c: c['seq']),
+                'last_seq' : self.last_seq}
+
+# -------------------------------------------------------
+
+if __name__ == "__main__":
+    with pairing.run_safely(spin=False):
+        main(*sys.argv[1:])
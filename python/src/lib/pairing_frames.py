@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+"""
+The historical data, rosters and scored pairings as columns, for
+exploring in a notebook.
+
+Everything in pairing.py works on lists of objects, so looking at a
+whole season means a python loop over its Pairs every time.  The
+functions here convert a list once into columns: a dict from each
+field's name to a tuple of its values, which is what
+pandas.DataFrame(columns, columns=names) takes, with names the order
+the columns should be in.  This module doesn't import pandas (or
+numpy) itself, so it works, and is checked, without them.  The
+conversions are kept in memory, keyed by the list's fingerprint, so
+asking again for the same data, even after reloading it, is free until
+the data changes.  clear_cache() forgets them.
+
+  import pandas, pairing, pairing_frames
+  hist = pairing.DataCatalog().get_data(2012, 2012)
+  pairs = pandas.DataFrame(pairing_frames.history_columns(hist),
+                           columns=pairing_frames.HISTORY_COLUMNS)
+  scores = pandas.DataFrame(pairing_frames.history_scores_columns(hist),
+                            columns=pairing_frames.PAIRING_COLUMNS)
+  scores.groupby(['session', 'date'])['score'].sum()
+
+Scored pairings have a row for each (tutor, student), with a column
+for each feature of the score (see FeatureTable.FEATURES) holding the
+points it's worth, and a score column with their sum.  Points that are
+for the student and tutor (past work, avoid tutor, good tutor match)
+are on that student's row, and points for the group as a whole are on
+the row of the group's first student, so the score column adds up to
+the same score as get_score.
+"""
+# -------------------------------------------------------
+# Imports and Constants
+#
+
+from __future__ import absolute_import, division, with_statement
+
+import collections
+import operator
+
+import pairing
+
+# (kind, list class, fingerprint, params) -> columns
+COLUMN_CACHE = {}
+
+HISTORY_COLUMNS = pairing.Pair.FIELDS + ('season',)
+
+PAIRING_COLUMNS = (('session', 'date', 'tutor', 'student', 'topic',
+                    'group_size') +
+                   pairing.FeatureTable.FEATURES + ('score',))
+
+# -------------------------------------------------------
+
+def clear_cache():
+    COLUMN_CACHE.clear()
+
+def to_columns(obj_list, fields):
+    """
+    Turn a list of CsvObjects into a dict from each of fields to a
+    tuple of its values.
+
+    >>> tutors = [pairing.Tutor('Ann'), pairing.Tutor('Bo', False)]
+    >>> columns = to_columns(tutors, pairing.Tutor.FIELDS)
+    >>> sorted(columns.items())
+    [('full_name', ('Ann', 'Bo')), ('is_active', (True, False))]
+    """
+    if len(obj_list) == 0:
+        return dict((f, ()) for f in fields)
+    if len(fields) == 1:
+        return {fields[0] : tuple(map(operator.attrgetter(fields[0]),
+                                      obj_list))}
+    return dict(zip(fields,
+                    zip(*map(operator.attrgetter(*fields), obj_list))))
+
+def cached(kind, csv_list, params, make):
+    """
+    Return the columns for kind and csv_list (and params, if it's
+    scored), making them with make() if they aren't in the cache.
+    The dict is a copy, so changing it doesn't change the cache.
+    """
+    param_key = (None if params is None else
+                 tuple(getattr(params, p) for p in sorted(params.PARAMS)))
+    key = (kind, csv_list.__class__.__name__, csv_list.fingerprint,
+           param_key)
+    if key not in COLUMN_CACHE:
+        COLUMN_CACHE[key] = make()
+    return dict(COLUMN_CACHE[key])
+
+def history_columns(hist):
+    """
+    The Pairs in hist, with a column for each field and a season column
+    (see get_season), in the order of HISTORY_COLUMNS
+
+    >>> flags = dict((f, False) for f in pairing.Pair.BOOL_FIELDS)
+    >>> hist = pairing.HistoricalData([
+    ...     pairing.Pair(20121006, 'am', 'Ann', 'Flo', topic='WP', **flags),
+    ...     pairing.Pair(20130112, 'am', 'Bo', 'Gus', topic='#', **flags)])
+    >>> columns = history_columns(hist)
+    >>> columns['student'], columns['season']
+    (('Flo', 'Gus'), (2012, 2012))
+    """
+    def make():
+        columns = to_columns(hist.data, pairing.Pair.FIELDS)
+        columns['season'] = tuple(pairing.get_season(d)
+                                  for d in columns['date'])
+        return columns
+    return cached('history', hist, None, make)
+
+def roster_columns(roster):
+    """
+    The Students or Tutors in roster, with a column for each field
+    """
+    return cached('roster', roster, None, lambda: to_columns(
+        roster.data, roster.OBJ_CLASS.FIELDS))
+
+def pairing_rows(table, pairs, student_topics, weights, session=None,
+                 date=None):
+    """
+    The rows for pairs (see the module docstring) scored with table,
+    as tuples in the order of PAIRING_COLUMNS
+    """
+    rows = []
+    by_tutor = pairing.HistoricalData.pairing_by_tutor(pairs)
+    for tutor in sorted(by_tutor):
+        group = by_tutor[tutor]
+        topics = [pairing.normalize_topic(student_topics[s]) for s in group]
+        rest = table.group_features(tutor, group, topics)
+        group_rows = []
+        for (student, topic) in zip(group, topics):
+            features = table.group_features(tutor, [student], [topic])
+            for feature in features:
+                rest[feature] -= features[feature]
+            group_rows.append([student_topics[student], features])
+        for feature in rest:
+            group_rows[0][1][feature] += rest[feature]
+        for (student, (topic, features)) in zip(group, group_rows):
+            points = tuple(features[f] * weights[f]
+                           for f in pairing.FeatureTable.FEATURES)
+            rows.append((session, date, tutor, student, topic, len(group)) +
+                        points + (sum(points),))
+    return rows
+
+def rows_columns(rows):
+    if len(rows) == 0:
+        return dict((c, ()) for c in PAIRING_COLUMNS)
+    return dict(zip(PAIRING_COLUMNS, zip(*rows)))
+
+def pairing_columns(hist, pairs, student_topics, params=None, session=None,
+                    date=None):
+    """
+    Score pairs (a list of (tutor, student)) against hist, like
+    get_score, with the points broken down into columns.  This isn't
+    cached, since it's quick.
+
+    @param session, date: what to put in the session and date columns
+
+    >>> flags = dict((f, False) for f in pairing.Pair.BOOL_FIELDS)
+    >>> hist = pairing.HistoricalData([
+    ...     pairing.Pair(20121006, 'am', 'Ann', 'Flo', topic='WP', **flags)])
+    >>> pairs = [('Ann', 'Flo'), ('Ann', 'Gus')]
+    >>> topics = {'Flo' : 'WP', 'Gus' : '#'}
+    >>> columns = pairing_columns(hist, pairs, topics)
+    >>> columns['student'], columns['score']
+    (('Flo', 'Gus'), (-10, 0))
+    >>> sum(columns['score']) == pairing.get_score(pairs, hist, topics)[0]
+    True
+    """
+    if params is None:
+        params = pairing.ScoreParams()
+    return rows_columns(pairing_rows(
+        pairing.FeatureTable.of(hist, params), pairs, student_topics,
+        pairing.FeatureTable.weights(params), session=session, date=date))
+
+def history_scores_columns(hist, params=None):
+    """
+    Score the pairing for every week in hist against the weeks of the
+    same session before it, like score_historical does, with the
+    points broken down into columns.
+
+    This goes through each session in date order, adding each week to
+    a FeatureTable after it's been scored, rather than making the
+    historical data before each week from scratch.  That can't be done
+    when params only count some of the history (see HistoryWindow),
+    since then how much each week counts changes every week.
+    """
+    if params is None:
+        params = pairing.ScoreParams()
+    windowed = pairing.HistoryWindow.params_key(params) is not None
+    def make():
+        weights = pairing.FeatureTable.weights(params)
+        weeks = collections.defaultdict(list)
+        for pair in hist.data:
+            weeks[(pair.session, pair.date)].append(pair)
+        tables = collections.defaultdict(pairing.FeatureTable)
+        before = collections.defaultdict(list)
+        rows = []
+        for (session, date) in sorted(weeks):
+            pairs = weeks[(session, date)]
+            if windowed:
+                tables[session] = pairing.FeatureTable.of(
+                    pairing.HistoricalData(before[session]), params)
+            rows.extend(pairing_rows(
+                tables[session], [(p.tutor, p.student) for p in pairs],
+                dict((p.student, p.topic) for p in pairs), weights,
+                session=session, date=date))
+            if windowed:
+                before[session].extend(pairs)
+            else:
+                tables[session].add_pairs(pairs)
+        return rows_columns(rows)
+    return cached('history_scores', hist, params, make)
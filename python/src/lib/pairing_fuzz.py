@@ -0,0 +1,613 @@
+#!/usr/bin/env python
+"""
+Check that every way of scoring a pairing gives the same answer as
+the reference: get_score as it was before anything else was added.
+
+get_score (with get_group_score) is what the annotations people read
+come from, and its odd parts are part of what it means, for example
+that a student's on own annotation is for penalty_tutor_on_own points
+while the score goes down by penalty_student_on_own, or that
+get_student_pairings matches students from any session.  The
+reference is a frozen copy of them (see reference_score), with the
+history window added, that doesn't use anything in pairing.py it
+could be checking.  get_score itself, and the faster ways of scoring
+(FeatureTable, score_candidates, CandidateTutors, the sqlite and
+compacted histories, pairing_frames), have to agree with it exactly.
+
+This makes up random cases (a history, the tutors here, a pairing of
+students to them, their topics and the score parameters), scores each
+one with the reference and with every scorer in SCORERS, and reports
+any case where they differ.  Scorers that give annotations have to give
+the same ones, and the others have to give the same total.  A case
+that fails is shrunk, by taking away history, students and tutors and
+turning off flags and parameters for as long as it still fails, and
+the smallest case is printed.
+
+  python pairing_fuzz.py [--cases 500] [--seed 0] [--scorer NAME]
+
+Each case's random numbers depend only on the seed and the case's
+number, so a failure can be run again on its own with --case N.
+"""
+# -------------------------------------------------------
+# Imports and Constants
+#
+
+from __future__ import absolute_import, division, with_statement
+
+import collections
+import json
+import logging
+import optparse
+import random
+import sys
+import traceback
+
+import pairing
+import pairing_frames
+import pairing_sqlite
+
+TUTORS = ('Ann', 'Bo', 'Cy', 'Di', 'Ed')
+STUDENTS = ('Flo', 'Gus', 'Hal', 'Ivy', 'Jo', 'Kim', 'Lu', 'Mo')
+TOPICS = ('#', 'NUMBERS', 'WP', 'wp', 'FRAC', '$')
+SESSIONS = ('am', 'pm')
+# Two seasons, so there's something for compacting to fold
+DATES = (20121006, 20121013, 20130112, 20131005, 20131012, 20131019)
+
+SCORE_PARAMS = pairing.FeatureTable.FEATURES
+
+# -------------------------------------------------------
+# Main + command line parsing
+#
+
+def main(*args):
+    opts = getopts(args)
+    scorers = sorted(SCORERS) if opts.scorer is None else opts.scorer
+    numbers = range(opts.cases) if opts.case is None else opts.case
+    failed = {}
+    skipped = collections.Counter()
+    for number in numbers:
+        case = random_case(random.Random('{0}:{1}'.format(opts.seed,
+                                                          number)))
+        for (name, difference) in sorted(check_case(case, scorers,
+                                                    skipped).items()):
+            logging.info("Case %s: %s %s", number, name, difference)
+            failed.setdefault(name, (number, case))
+    ran = [name for name in scorers if skipped[name] < len(numbers)]
+    print "Ran {0} cases through {1}".format(len(numbers),
+                                             ', '.join(ran) or 'no scorers')
+    for name in scorers:
+        if skipped[name] > 0:
+            print "{0} skipped {1} of the {2} cases".format(
+                name, skipped[name], len(numbers))
+    for name in sorted(failed):
+        (number, case) = failed[name]
+        case = shrink(case, name)
+        print
+        print "{0} differs from the reference, first in case {1}: {2}".format(
+            name, number, check_case(case, [name])[name])
+        print case
+    if len(failed) > 0:
+        raise RuntimeError("{0} of the scorers differ from the reference".
+                           format(len(failed)))
+
+def getopts(args=None):
+    parser = optparse.OptionParser()
+    parser.add_option('--cases',
+                      type=int,
+                      default=500,
+                      help='how many random cases to try')
+    parser.add_option('--seed',
+                      default='0',
+                      help='the seed for the random cases')
+    parser.add_option('--case',
+                      type=int,
+                      action='append',
+                      help='only try this case (can be given more than '
+                      'once)')
+    parser.add_option('--scorer',
+                      action='append',
+                      help='only check this scorer (can be given more '
+                      'than once), one of: ' + ', '.join(sorted(SCORERS)))
+    parser.add_option('--log_level',
+                      help='set the log level')
+
+    (opts, args) = parser.parse_args(list(args) if len(args) > 0 else None)
+
+    if len(args) > 0:
+        raise ValueError("Did not expect to get any arguments: {0}".
+                         format(args))
+
+    for name in opts.scorer or ():
+        if name not in SCORERS:
+            raise ValueError("Unknown scorer {0}, should be one of {1}".
+                             format(name, ', '.join(sorted(SCORERS))))
+
+    if opts.log_level is not None:
+        level = getattr(logging, opts.log_level.upper())
+        logging.getLogger().setLevel(level)
+        logging.info("Setting log level to %s", level)
+
+    return opts
+
+# -------------------------------------------------------
+# Cases
+#
+
+class Case(object):
+    """
+    Everything needed to score a pairing: the historical data (a list
+    of Pairs), the tutors who are here, the pairing (a list of
+    (tutor, student)), the students' topics, and the ScoreParams
+    """
+    def __init__(self, pairs, tutors, pairs_now, student_topics, params):
+        self.pairs = list(pairs)
+        self.tutors = list(tutors)
+        self.pairing = list(pairs_now)
+        self.student_topics = dict(student_topics)
+        self.params = params
+
+    def copy(self, **kwargs):
+        vals = {'pairs' : self.pairs,
+                'tutors' : self.tutors,
+                'pairs_now' : self.pairing,
+                'student_topics' : self.student_topics,
+                'params' : self.params}
+        vals.update(kwargs)
+        return self.__class__(**vals)
+
+    def hist(self):
+        return pairing.HistoricalData(self.pairs)
+
+    def changed_params(self):
+        defaults = pairing.ScoreParams()
+        return sorted((param, getattr(self.params, param))
+                      for param in self.params.PARAMS
+                      if getattr(self.params, param) !=
+                      getattr(defaults, param))
+
+    def __str__(self):
+        return '\n'.join([
+            "History:",
+            self.hist().to_csv(),
+            "Tutors: {0}".format(self.tutors),
+            "Pairing: {0}".format(self.pairing),
+            "Topics: {0}".format(sorted(self.student_topics.items())),
+            "Params: {0}".format(', '.join('{0}={1}'.format(p, v) for (p, v)
+                                           in self.changed_params()) or
+                                 'the defaults')])
+
+def random_pairs(rng):
+    """
+    A random history: some weeks, each with random groups of students
+    for some of the tutors (or no tutor), and a few flags set
+    """
+    pairs = []
+    for date in sorted(rng.sample(DATES, rng.randint(0, len(DATES)))):
+        for session in SESSIONS:
+            if rng.random() < 0.3:
+                continue
+            tutors = list(TUTORS) + ['']
+            for student in rng.sample(STUDENTS,
+                                      rng.randint(1, len(STUDENTS))):
+                flags = dict((f, rng.random() < 0.1)
+                             for f in pairing.Pair.BOOL_FIELDS)
+                pairs.append(pairing.Pair(
+                    date, session, rng.choice(tutors), student,
+                    topic=rng.choice(TOPICS), **flags))
+    return pairs
+
+def random_params(rng):
+    if rng.random() < 0.3:
+        return pairing.ScoreParams()
+    vals = dict((param, rng.randint(-5, 25)) for param in SCORE_PARAMS)
+    if rng.random() < 0.4:
+        vals.update(history_weeks=rng.randint(0, 4),
+                    history_seasons=rng.randint(0, 2),
+                    history_half_life=rng.randint(0, 3),
+                    history_sticky_flags=rng.randint(0, 1))
+    return pairing.ScoreParams(**vals)
+
+def random_case(rng):
+    tutors = rng.sample(TUTORS, rng.randint(1, len(TUTORS)))
+    students = rng.sample(STUDENTS, rng.randint(1, len(STUDENTS)))
+    return Case(random_pairs(rng), tutors,
+                [(rng.choice(tutors), s) for s in students],
+                dict((s, rng.choice(TOPICS)) for s in students),
+                random_params(rng))
+
+# -------------------------------------------------------
+# The reference
+#
+# A frozen copy of get_score and get_group_score from before the
+# faster scorers were written, without the logging.  The only change
+# is the history window, which is worked out here from the list of
+# pairs rather than with HistoryWindow, and history lookups go through
+# every pair like HistoricalData's used to.  Don't change this to match
+# pairing.py: a difference is what it's here to find.
+#
+
+STICKY_FLAGS = ('avoid_tutor', 'avoid_student', 'tutor_on_own', 'on_own')
+
+def season(date):
+    (year, month) = divmod(date // 100, 100)
+    return year - 1 if month < 6 else year
+
+class ReferenceHistory(object):
+    """
+    The history, with how much each of its dates counts under the
+    history_* score parameters: the dates are weeks, counted back from
+    the most recent one, and a week counts 0 if it's history_weeks or
+    more back or history_seasons or more seasons back, and otherwise
+    0.5 ** (week / history_half_life).  Flags count from weeks that
+    count at all, and with history_sticky_flags, the avoid and on own
+    flags always count.
+    """
+    def __init__(self, pairs, params):
+        self.data = list(pairs)
+        self.sticky = params.history_sticky_flags != 0
+        self.weights = {}
+        dates = sorted(set(p.date for p in self.data), reverse=True)
+        for (week, date) in enumerate(dates):
+            if params.history_weeks > 0 and week >= params.history_weeks:
+                self.weights[date] = 0
+            elif (params.history_seasons > 0 and
+                  season(dates[0]) - season(date) >= params.history_seasons):
+                self.weights[date] = 0
+            elif params.history_half_life > 0:
+                self.weights[date] = 0.5 ** (week / params.history_half_life)
+            else:
+                self.weights[date] = 1
+
+    def weight(self, pair):
+        return self.weights[pair.date]
+
+    def counts(self, pair, flag):
+        return bool(getattr(pair, flag) and
+                    (self.weights[pair.date] > 0 or
+                     (self.sticky and flag in STICKY_FLAGS)))
+
+    def get_matches(self, tutor=None, student=None):
+        return [d for d in self.data
+                if ((tutor   is None or tutor == d.tutor)
+                    and (student is None or student == d.student))]
+
+    def get_student_pairings(self, student1, student2):
+        by_key = collections.defaultdict(list)
+        for pair in self.data:
+            by_key[(pair.date, pair.tutor)].append(pair)
+        return [students
+                for students in by_key.itervalues()
+                if (len(students) > 1
+                    and any([s.student == student1 for s in students])
+                    and any([s.student == student2 for s in students]))]
+
+def reference_group_score(hist, tutor, students, topics, params):
+    annotations = collections.defaultdict(list)
+    score = 0
+    for student in students:
+        prev = hist.get_matches(tutor=tutor, student=student)
+        past_work = sum(hist.weight(p) for p in prev)
+        points_past_work = past_work * params.award_past_work
+        if points_past_work > 0:
+            score += points_past_work
+            annotations[(tutor, student)].append(
+                (points_past_work,
+                 "+{0:g}*{1} because {2} and {3} have worked together".
+                 format(past_work, params.award_past_work, tutor, student)))
+        if any([hist.counts(p, 'avoid_tutor') for p in prev]):
+            score -= params.penalty_avoid_tutor
+            annotations[(tutor, student)].append(
+                (-params.penalty_avoid_tutor,
+                  "-{0} because {1} and {2} shouldn't work together".
+                  format(params.penalty_avoid_tutor, tutor, student)))
+        if any([hist.counts(p, 'good_tutor_match') for p in prev]):
+            score += params.award_good_tutor_match
+            annotations[(tutor, student)].append(
+                (params.award_good_tutor_match,
+                 "+{0} because {1} and {2} are a good match".
+                 format(params.award_good_tutor_match, tutor, student)))
+
+    n_students = len(students)
+    if n_students < 2:
+        return (score, annotations)
+    # Arbitrarily attach annotations to the first student
+    student1 = students[0]
+    points_multiple_students = ((n_students - 1)**2 *
+                                params.penalty_multiple_students)
+    score -= points_multiple_students
+    annotations[(tutor, student1)].append(
+        (-points_multiple_students,
+          "-{0} because {1} is working with {2} students".
+          format(points_multiple_students, tutor, n_students)))
+    if any([t != topics[0] for t in topics[1:]]):
+        score -= params.penalty_different_topics
+        annotations[(tutor, student1)].append(
+            (-params.penalty_different_topics,
+             "-{0} because students {1} working with tutor {2} are working "
+             "on different topics {3}".format(
+                 params.penalty_different_topics,
+                 students, tutor, topics)))
+    if any([hist.counts(p, 'tutor_on_own')
+            for p in hist.get_matches(tutor=tutor)]):
+        score -= params.penalty_tutor_on_own
+        annotations[(tutor, student1)].append(
+            (-params.penalty_tutor_on_own,
+              "-{0} because tutor {1} should only work on own".
+              format(params.penalty_tutor_on_own, tutor)))
+    for student in students:
+        if any([hist.counts(p, 'on_own')
+                for p in hist.get_matches(student=student)]):
+            score -= params.penalty_student_on_own
+            annotations[(tutor, student)].append(
+                (-params.penalty_tutor_on_own,
+                  "-{0} because student {1} should only work on own".
+                  format(params.penalty_tutor_on_own, student)))
+    for ii in xrange(n_students):
+        for jj in xrange(ii+1, n_students):
+            hist_pairs = hist.get_student_pairings(students[ii],
+                                                   students[jj])
+            for pairs in hist_pairs:
+                if any([hist.counts(p, 'avoid_student') for p in pairs]):
+                    score -= params.penalty_avoid_student
+                    annotations[(tutor, students[ii])].append(
+                        (-params.penalty_avoid_student,
+                          "-{0} because students {1} and {2} should "
+                          "not work with each other".
+                          format(params.penalty_avoid_student,
+                                 students[ii],
+                                 students[jj])))
+                    break
+            for pairs in hist_pairs:
+                if any([hist.counts(p, 'good_student_match') for p in pairs]):
+                    score += params.award_good_student_match
+                    annotations[(tutor, students[ii])].append(
+                        (params.award_good_student_match,
+                         "-{0} because student {1} is a good match with "
+                         "student {2}".
+                         format(params.penalty_avoid_student,
+                                students[ii],
+                                students[jj])))
+                    break
+    return (score, annotations)
+
+def reference_score(case):
+    """
+    The score and annotations for case, from the frozen copy of
+    get_score
+    """
+    hist = ReferenceHistory(case.pairs, case.params)
+    by_tutor = collections.defaultdict(list)
+    for (tutor, student) in case.pairing:
+        by_tutor[tutor].append(student)
+    score = 0
+    annotations = {}
+    for tutor in by_tutor:
+        group = by_tutor[tutor]
+        topics = [pairing.normalize_topic(case.student_topics[s])
+                  for s in group]
+        (group_score, group_ann) = reference_group_score(
+            hist, tutor, group, topics, case.params)
+        score += group_score
+        annotations.update(group_ann)
+    return (score, annotations)
+
+# -------------------------------------------------------
+# Scorers
+#
+
+# The scorers to check against the reference, by name.  Each is called
+# with a Case and returns a tuple of the score and the annotations
+# (None if it doesn't give any), or None if it can't score that case.
+SCORERS = {}
+
+def register_scorer(name):
+    def register(func):
+        SCORERS[name] = func
+        return func
+    return register
+
+@register_scorer('get_score')
+def get_score_score(case):
+    return pairing.get_score(case.pairing, case.hist(), case.student_topics,
+                             params=case.params)
+
+@register_scorer('sqlite')
+def sqlite_score(case):
+    hist = pairing_sqlite.SqliteHistoricalData(
+        pairing_sqlite.connect(':memory:'))
+    hist.add_list(case.pairs)
+    return pairing.get_score(case.pairing, hist, case.student_topics,
+                             params=case.params)
+
+@register_scorer('compacted')
+def compacted_score(case):
+    # Archived pairs all have the last date of their season, so
+    # windows by weeks see less history (see CompactedHistoricalData)
+    if case.params.history_weeks or case.params.history_half_life:
+        return None
+    hist = pairing.CompactedHistoricalData.compact(case.hist())
+    return pairing.get_score(case.pairing, hist, case.student_topics,
+                             params=case.params)
+
+@register_scorer('feature_table')
+def feature_table_score(case):
+    table = pairing.FeatureTable.of(case.hist(), case.params)
+    return (table.dot(table.pairing_features(case.pairing,
+                                             case.student_topics),
+                      case.params),
+            None)
+
+@register_scorer('scoring_index')
+def scoring_index_score(case):
+    """
+    A FeatureTable that's been through the json of the scoring index
+    """
+    table = pairing.FeatureTable.from_json(json.loads(json.dumps(
+        pairing.FeatureTable.of(case.hist(), case.params).to_json())))
+    return (table.dot(table.pairing_features(case.pairing,
+                                             case.student_topics),
+                      case.params),
+            None)
+
+@register_scorer('score_candidates')
+def score_candidates_score(case):
+    [(score, _)] = pairing.score_candidates(
+        case.hist(), case.student_topics, [case.pairing], params=case.params)
+    return (score, None)
+
+@register_scorer('candidate_groups')
+def candidate_groups_score(case):
+    cands = pairing.CandidateTutors(case.hist(), case.tutors,
+                                    case.student_topics, case.params)
+    by_tutor = pairing.HistoricalData.pairing_by_tutor(case.pairing)
+    return (sum(cands.group_score(tutor, group)
+                for (tutor, group) in by_tutor.iteritems()),
+            None)
+
+@register_scorer('candidate_deltas')
+def candidate_deltas_score(case):
+    """
+    The sum of CandidateTutors.delta, adding the students to their
+    tutors one at a time like the solvers do
+    """
+    cands = pairing.CandidateTutors(case.hist(), case.tutors,
+                                    case.student_topics, case.params)
+    groups = collections.defaultdict(list)
+    score = 0
+    for (tutor, student) in case.pairing:
+        score += cands.delta(tutor, student, groups[tutor])
+        groups[tutor].append(student)
+    return (score, None)
+
+@register_scorer('columns')
+def columns_score(case):
+    columns = pairing_frames.pairing_columns(
+        case.hist(), case.pairing, case.student_topics, case.params)
+    return (sum(columns['score']), None)
+
+# -------------------------------------------------------
+# Checking and shrinking
+#
+
+def same_number(a, b):
+    # Windowed past work is fractional, and not always added up in the
+    # same order
+    return abs(a - b) <= 1e-9 * max(1, abs(a), abs(b))
+
+def annotation_difference(expected, got):
+    """
+    A description of the first difference between two sets of
+    annotations, or None if they're the same
+    """
+    expected = dict((k, v) for (k, v) in expected.items() if len(v) > 0)
+    got = dict((k, v) for (k, v) in got.items() if len(v) > 0)
+    for key in sorted(set(expected) | set(got)):
+        mine = expected.get(key, [])
+        theirs = got.get(key, [])
+        if (len(mine) != len(theirs) or
+            any(m[1] != t[1] or not same_number(m[0], t[0])
+                for (m, t) in zip(mine, theirs))):
+            return "annotations for {0} are {1}, not {2}".format(
+                key, theirs, mine)
+    return None
+
+def check_case(case, scorers, skipped=None):
+    """
+    Score case with the reference and each of scorers (names in SCORERS).
+
+    @param skipped: if given, a Counter to add 1 to for each scorer
+    that can't score case
+    @return a dict from the name of each scorer that doesn't agree with
+    the reference to a description of how
+    """
+    (expected, expected_ann) = reference_score(case)
+    differences = {}
+    for name in scorers:
+        try:
+            result = SCORERS[name](case)
+        except Exception:
+            logging.debug(traceback.format_exc())
+            differences[name] = traceback.format_exc().splitlines()[-1]
+            continue
+        if result is None:
+            if skipped is not None:
+                skipped[name] += 1
+            continue
+        (score, annotations) = result
+        if not same_number(score, expected):
+            differences[name] = "score is {0}, not {1}".format(score,
+                                                               expected)
+        elif annotations is not None:
+            difference = annotation_difference(expected_ann, annotations)
+            if difference is not None:
+                differences[name] = difference
+    return differences
+
+def simplifications(case):
+    """
+    Smaller or simpler versions of case, to try in order
+
+    >>> flags = dict((f, False) for f in pairing.Pair.BOOL_FIELDS)
+    >>> case = Case([pairing.Pair(20121006, 'am', 'Ann', 'Flo', **flags)],
+    ...             ['Ann'], [], {}, pairing.ScoreParams())
+    >>> next(simplifications(case)).pairs
+    []
+    """
+    pairs = case.pairs
+    size = len(pairs)
+    while size >= 1:
+        for start in xrange(0, len(pairs), size):
+            yield case.copy(pairs=pairs[:start] + pairs[start+size:])
+        size //= 2
+    for (tutor, student) in case.pairing:
+        topics = dict(case.student_topics)
+        del topics[student]
+        yield case.copy(pairs_now=[p for p in case.pairing
+                                   if p[1] != student],
+                        student_topics=topics)
+    used = set(tutor for (tutor, _) in case.pairing)
+    for tutor in case.tutors:
+        if tutor not in used:
+            yield case.copy(tutors=[t for t in case.tutors if t != tutor])
+    for (ii, pair) in enumerate(pairs):
+        for flag in pairing.Pair.BOOL_FIELDS:
+            if getattr(pair, flag):
+                vals = dict((f, getattr(pair, f)) for f in pair.FIELDS)
+                vals[flag] = False
+                yield case.copy(pairs=pairs[:ii] + [pairing.Pair(**vals)] +
+                                pairs[ii+1:])
+    for (param, _) in case.changed_params():
+        yield case.copy(params=case.params.copy(
+            **{param : pairing.ScoreParams.PARAMS[param]}))
+    for student in sorted(case.student_topics):
+        if case.student_topics[student] != TOPICS[0]:
+            topics = dict(case.student_topics)
+            topics[student] = TOPICS[0]
+            yield case.copy(student_topics=topics)
+
+def shrink(case, name):
+    """
+    Simplify case for as long as the scorer name still disagrees with
+    the reference on it
+    """
+    def fails(smaller):
+        try:
+            return name in check_case(smaller, [name])
+        except Exception:
+            # The reference itself can't score it
+            return False
+    shrunk = True
+    while shrunk:
+        shrunk = False
+        for smaller in simplifications(case):
+            if fails(smaller):
+                case = smaller
+                shrunk = True
+                break
+    return case
+
+# -------------------------------------------------------
+
+if __name__ == "__main__":
+    with pairing.run_safely(spin=False):
+        main(*sys.argv[1:])
@@ -0,0 +1,488 @@
+#!/usr/bin/env python
+"""
+Maximum weight matching in a general graph, for forming groups of
+students (see pairing.matched_pairing).
+
+This is Edmonds' blossom algorithm, in the O(n^3) form described in
+"Efficient Algorithms for Finding Maximum Matching in Graphs" by Zvi
+Galil, ACM Computing Surveys, 1986, and follows Joris van Rantwijk's
+well known Python version of it.  The comments use Galil's terms:
+vertices and blossoms are labeled S (outer) or T (inner) while
+searching for an augmenting path, and the dual variables are adjusted
+when no more progress can be made with the edges whose slack is 0.
+
+With integer weights, everything is done in integers, so the result
+is exact.
+"""
+# -------------------------------------------------------
+# Imports and Constants
+#
+
+from __future__ import absolute_import, division, with_statement
+
+# -------------------------------------------------------
+
+def max_weight_matching(edges, maxcardinality=False):
+    """
+    Find a matching with the largest total weight.
+
+    @param edges: a list of (i, j, weight), where i and j are vertices
+    numbered from 0.  There should be at most one edge between any
+    two vertices, and no edge from a vertex to itself.
+
+    @param maxcardinality: if true, only consider matchings with as
+    many edges as possible
+
+    @return a list with an entry for each vertex: the vertex it's
+    matched with, or -1 if it isn't matched
+
+    >>> max_weight_matching([(0, 1, 5), (1, 2, 11), (2, 3, 5)])
+    [-1, 2, 1, -1]
+    >>> max_weight_matching([(0, 1, 5), (1, 2, 11), (2, 3, 5)],
+    ...                     maxcardinality=True)
+    [1, 0, 3, 2]
+    >>> # A triangle (a blossom) with a tail
+    >>> max_weight_matching([(0, 1, 8), (0, 2, 9), (1, 2, 10), (2, 3, 7)])
+    [1, 0, 3, 2]
+    """
+    if len(edges) == 0:
+        return []
+
+    nedge = len(edges)
+    nvertex = 1 + max(max(i, j) for (i, j, _) in edges)
+    maxweight = max(0, max(wt for (_, _, wt) in edges))
+
+    # Edge k has endpoints 2k and 2k+1: endpoint[2k] is edges[k][0]
+    # and endpoint[2k+1] is edges[k][1]
+    endpoint = [edges[p // 2][p % 2] for p in xrange(2 * nedge)]
+    # For each vertex, the remote endpoints of its edges
+    neighbend = [[] for _ in xrange(nvertex)]
+    for (k, (i, j, _)) in enumerate(edges):
+        neighbend[i].append(2 * k + 1)
+        neighbend[j].append(2 * k)
+
+    # The remote endpoint of each vertex's matched edge, or -1
+    mate = nvertex * [-1]
+    # For each top-level blossom (vertices are blossoms 0 to nvertex-1,
+    # and nontrivial blossoms are nvertex to 2*nvertex-1): 0 if it's
+    # unlabeled, 1 for S, 2 for T.  The label of a vertex inside a
+    # blossom is the same as the blossom's, except that a T-vertex
+    # that's reachable from an S-vertex also has label 2.
+    label = (2 * nvertex) * [0]
+    # The remote endpoint of the edge through which each labeled
+    # blossom (or T-vertex) got its label, or -1
+    labelend = (2 * nvertex) * [-1]
+    # The top-level blossom each vertex is in
+    inblossom = range(nvertex)
+    # The blossom each blossom is directly inside of, or -1
+    blossomparent = (2 * nvertex) * [-1]
+    # The sub-blossoms of each nontrivial blossom, in order around it
+    blossomchilds = (2 * nvertex) * [None]
+    # The base vertex of each blossom
+    blossombase = range(nvertex) + nvertex * [-1]
+    # For each nontrivial blossom, the endpoints of the edges joining
+    # its sub-blossoms: blossomendps[b][i] joins blossomchilds[b][i]
+    # to the next one
+    blossomendps = (2 * nvertex) * [None]
+    # For each S-blossom, its least slack edge to another S-blossom,
+    # and for each unlabeled vertex, its least slack edge to an
+    # S-vertex, or -1
+    bestedge = (2 * nvertex) * [-1]
+    # For each nontrivial top-level S-blossom, its least slack edges to
+    # other S-blossoms
+    blossombestedges = (2 * nvertex) * [None]
+    unusedblossoms = range(nvertex, 2 * nvertex)
+    # The dual variables: u(v) for the vertices, z(b) for the blossoms
+    dualvar = nvertex * [maxweight] + nvertex * [0]
+    # Whether each edge is known to have slack 0
+    allowedge = nedge * [False]
+    # The S-vertices still to be scanned
+    queue = []
+
+    def slack(k):
+        (i, j, wt) = edges[k]
+        return dualvar[i] + dualvar[j] - 2 * wt
+
+    def blossom_leaves(b):
+        if b < nvertex:
+            yield b
+        else:
+            for t in blossomchilds[b]:
+                if t < nvertex:
+                    yield t
+                else:
+                    for v in blossom_leaves(t):
+                        yield v
+
+    def assign_label(w, t, p):
+        """
+        Label vertex w, and its top-level blossom, with t, through
+        the edge with remote endpoint p.  A T-blossom's mate gets
+        labeled S.
+        """
+        b = inblossom[w]
+        label[w] = label[b] = t
+        labelend[w] = labelend[b] = p
+        bestedge[w] = bestedge[b] = -1
+        if t == 1:
+            queue.extend(blossom_leaves(b))
+        elif t == 2:
+            base = blossombase[b]
+            assign_label(endpoint[mate[base]], 1, mate[base] ^ 1)
+
+    def scan_blossom(v, w):
+        """
+        Trace back from S-vertices v and w.  Return the base of the new
+        blossom if they meet, or -1 if there's an augmenting path.
+        """
+        path = []
+        base = -1
+        while v != -1 or w != -1:
+            b = inblossom[v]
+            if label[b] & 4:
+                base = blossombase[b]
+                break
+            path.append(b)
+            label[b] = 5
+            if labelend[b] == -1:
+                # The root of this alternating tree
+                v = -1
+            else:
+                v = endpoint[labelend[b]]
+                b = inblossom[v]
+                # b is a T-blossom; go on to its S-parent
+                v = endpoint[labelend[b]]
+            # Take turns going up each side
+            if w != -1:
+                (v, w) = (w, v)
+        for b in path:
+            label[b] = 1
+        return base
+
+    def add_blossom(base, k):
+        """
+        Make a new blossom out of the cycle formed by edge k and the
+        paths from its ends back to base
+        """
+        (v, w, _) = edges[k]
+        bb = inblossom[base]
+        bv = inblossom[v]
+        bw = inblossom[w]
+        b = unusedblossoms.pop()
+        blossombase[b] = base
+        blossomparent[b] = -1
+        blossomparent[bb] = b
+        blossomchilds[b] = path = []
+        blossomendps[b] = endps = []
+        # From v back to the base
+        while bv != bb:
+            blossomparent[bv] = b
+            path.append(bv)
+            endps.append(labelend[bv])
+            v = endpoint[labelend[bv]]
+            bv = inblossom[v]
+        path.append(bb)
+        path.reverse()
+        endps.reverse()
+        endps.append(2 * k)
+        # From w back to the base
+        while bw != bb:
+            blossomparent[bw] = b
+            path.append(bw)
+            endps.append(labelend[bw] ^ 1)
+            w = endpoint[labelend[bw]]
+            bw = inblossom[w]
+        label[b] = 1
+        labelend[b] = labelend[bb]
+        dualvar[b] = 0
+        # T-vertices in it become S-vertices, to be scanned
+        for v in blossom_leaves(b):
+            if label[inblossom[v]] == 2:
+                queue.append(v)
+            inblossom[v] = b
+        # Work out its least slack edges to other S-blossoms
+        bestedgeto = (2 * nvertex) * [-1]
+        for bv in path:
+            if blossombestedges[bv] is None:
+                nblists = [[p // 2 for p in neighbend[v]]
+                           for v in blossom_leaves(bv)]
+            else:
+                nblists = [blossombestedges[bv]]
+            for nblist in nblists:
+                for k in nblist:
+                    (i, j, _) = edges[k]
+                    if inblossom[j] == b:
+                        (i, j) = (j, i)
+                    bj = inblossom[j]
+                    if (bj != b and label[bj] == 1 and
+                        (bestedgeto[bj] == -1 or
+                         slack(k) < slack(bestedgeto[bj]))):
+                        bestedgeto[bj] = k
+            blossombestedges[bv] = None
+            bestedge[bv] = -1
+        blossombestedges[b] = [k for k in bestedgeto if k != -1]
+        bestedge[b] = -1
+        for k in blossombestedges[b]:
+            if bestedge[b] == -1 or slack(k) < slack(bestedge[b]):
+                bestedge[b] = k
+
+    def expand_blossom(b, endstage):
+        """
+        Turn blossom b back into its sub-blossoms, relabeling them if
+        b was a T-blossom in the middle of a stage
+        """
+        for s in blossomchilds[b]:
+            blossomparent[s] = -1
+            if s < nvertex:
+                inblossom[s] = s
+            elif endstage and dualvar[s] == 0:
+                expand_blossom(s, endstage)
+            else:
+                for v in blossom_leaves(s):
+                    inblossom[v] = s
+        if not endstage and label[b] == 2:
+            # Relabel the sub-blossoms on the even length path from the
+            # one it was entered through to the base
+            entrychild = inblossom[endpoint[labelend[b] ^ 1]]
+            j = blossomchilds[b].index(entrychild)
+            if j & 1:
+                # Go forward, wrapping around
+                j -= len(blossomchilds[b])
+                jstep = 1
+                endptrick = 0
+            else:
+                # Go backward
+                jstep = -1
+                endptrick = 1
+            p = labelend[b]
+            while j != 0:
+                label[endpoint[p ^ 1]] = 0
+                label[endpoint[blossomendps[b][j - endptrick] ^
+                               endptrick ^ 1]] = 0
+                assign_label(endpoint[p ^ 1], 2, p)
+                allowedge[blossomendps[b][j - endptrick] // 2] = True
+                j += jstep
+                p = blossomendps[b][j - endptrick] ^ endptrick
+                allowedge[p // 2] = True
+                j += jstep
+            # The base sub-blossom becomes a T-blossom, without labeling
+            # its mate
+            bv = blossomchilds[b][j]
+            label[endpoint[p ^ 1]] = label[bv] = 2
+            labelend[endpoint[p ^ 1]] = labelend[bv] = p
+            bestedge[bv] = -1
+            # The sub-blossoms on the other path that are reachable
+            # from S-vertices outside get labeled T
+            j += jstep
+            while blossomchilds[b][j] != entrychild:
+                bv = blossomchilds[b][j]
+                if label[bv] == 1:
+                    j += jstep
+                    continue
+                for v in blossom_leaves(bv):
+                    if label[v] != 0:
+                        break
+                if label[v] != 0:
+                    label[v] = 0
+                    label[endpoint[mate[blossombase[bv]]]] = 0
+                    assign_label(v, 2, labelend[v])
+                j += jstep
+        label[b] = labelend[b] = -1
+        blossomchilds[b] = blossomendps[b] = None
+        blossombase[b] = -1
+        blossombestedges[b] = None
+        bestedge[b] = -1
+        unusedblossoms.append(b)
+
+    def augment_blossom(b, v):
+        """
+        Swap matched and unmatched edges along the even path in
+        blossom b from vertex v to the base, making v the new base
+        """
+        t = v
+        while blossomparent[t] != b:
+            t = blossomparent[t]
+        if t >= nvertex:
+            augment_blossom(t, v)
+        i = j = blossomchilds[b].index(t)
+        if i & 1:
+            j -= len(blossomchilds[b])
+            jstep = 1
+            endptrick = 0
+        else:
+            jstep = -1
+            endptrick = 1
+        while j != 0:
+            j += jstep
+            t = blossomchilds[b][j]
+            p = blossomendps[b][j - endptrick] ^ endptrick
+            if t >= nvertex:
+                augment_blossom(t, endpoint[p])
+            j += jstep
+            t = blossomchilds[b][j]
+            if t >= nvertex:
+                augment_blossom(t, endpoint[p ^ 1])
+            mate[endpoint[p]] = p ^ 1
+            mate[endpoint[p ^ 1]] = p
+        # Rotate the sub-blossoms so the new base is first
+        blossomchilds[b] = blossomchilds[b][i:] + blossomchilds[b][:i]
+        blossomendps[b] = blossomendps[b][i:] + blossomendps[b][:i]
+        blossombase[b] = blossombase[blossomchilds[b][0]]
+
+    def augment_matching(k):
+        """
+        Swap matched and unmatched edges along the augmenting path
+        through edge k, between two S-vertices
+        """
+        (v, w, _) = edges[k]
+        for (s, p) in ((v, 2 * k + 1), (w, 2 * k)):
+            while True:
+                bs = inblossom[s]
+                if bs >= nvertex:
+                    augment_blossom(bs, s)
+                mate[s] = p
+                if labelend[bs] == -1:
+                    # The root of the alternating tree
+                    break
+                t = endpoint[labelend[bs]]
+                bt = inblossom[t]
+                s = endpoint[labelend[bt]]
+                j = endpoint[labelend[bt] ^ 1]
+                if bt >= nvertex:
+                    augment_blossom(bt, j)
+                mate[j] = labelend[bt]
+                p = labelend[bt] ^ 1
+
+    # Each stage adds one edge to the matching, until that can't be
+    # done
+    for _ in xrange(nvertex):
+        label[:] = (2 * nvertex) * [0]
+        bestedge[:] = (2 * nvertex) * [-1]
+        blossombestedges[nvertex:] = nvertex * [None]
+        allowedge[:] = nedge * [False]
+        queue[:] = []
+        # The unmatched vertices are the roots of the alternating trees
+        for v in xrange(nvertex):
+            if mate[v] == -1 and label[inblossom[v]] == 0:
+                assign_label(v, 1, -1)
+
+        augmented = False
+        while True:
+            # Grow the trees along the edges with no slack
+            while len(queue) > 0 and not augmented:
+                v = queue.pop()
+                for p in neighbend[v]:
+                    k = p // 2
+                    w = endpoint[p]
+                    if inblossom[v] == inblossom[w]:
+                        continue
+                    if not allowedge[k]:
+                        kslack = slack(k)
+                        if kslack <= 0:
+                            allowedge[k] = True
+                    if allowedge[k]:
+                        if label[inblossom[w]] == 0:
+                            assign_label(w, 2, p ^ 1)
+                        elif label[inblossom[w]] == 1:
+                            base = scan_blossom(v, w)
+                            if base >= 0:
+                                add_blossom(base, k)
+                            else:
+                                augment_matching(k)
+                                augmented = True
+                                break
+                        elif label[w] == 0:
+                            # w is in a T-blossom, but hasn't been
+                            # reached from an S-vertex yet
+                            label[w] = 2
+                            labelend[w] = p ^ 1
+                    elif label[inblossom[w]] == 1:
+                        b = inblossom[v]
+                        if bestedge[b] == -1 or kslack < slack(bestedge[b]):
+                            bestedge[b] = k
+                    elif label[w] == 0:
+                        if bestedge[w] == -1 or kslack < slack(bestedge[w]):
+                            bestedge[w] = k
+            if augmented:
+                break
+
+            # No augmenting path with the edges we have, so change the
+            # duals by as much as we can (delta): 1 means the vertex
+            # duals hit 0, 2 an edge from an S-vertex to an unlabeled
+            # one gets no slack, 3 an edge between S-blossoms does, and
+            # 4 a T-blossom's dual hits 0.
+            deltatype = -1
+            delta = deltaedge = deltablossom = None
+            if not maxcardinality:
+                deltatype = 1
+                delta = min(dualvar[:nvertex])
+            for v in xrange(nvertex):
+                if label[inblossom[v]] == 0 and bestedge[v] != -1:
+                    d = slack(bestedge[v])
+                    if deltatype == -1 or d < delta:
+                        delta = d
+                        deltatype = 2
+                        deltaedge = bestedge[v]
+            for b in xrange(2 * nvertex):
+                if (blossomparent[b] == -1 and label[b] == 1 and
+                    bestedge[b] != -1):
+                    kslack = slack(bestedge[b])
+                    if isinstance(kslack, (int, long)):
+                        d = kslack // 2
+                    else:
+                        d = kslack / 2
+                    if deltatype == -1 or d < delta:
+                        delta = d
+                        deltatype = 3
+                        deltaedge = bestedge[b]
+            for b in xrange(nvertex, 2 * nvertex):
+                if (blossombase[b] >= 0 and blossomparent[b] == -1 and
+                    label[b] == 2 and
+                    (deltatype == -1 or dualvar[b] < delta)):
+                    delta = dualvar[b]
+                    deltatype = 4
+                    deltablossom = b
+            if deltatype == -1:
+                # Only with maxcardinality: the matching can't get any
+                # bigger, so finish off the duals
+                deltatype = 1
+                delta = max(0, min(dualvar[:nvertex]))
+
+            for v in xrange(nvertex):
+                if label[inblossom[v]] == 1:
+                    dualvar[v] -= delta
+                elif label[inblossom[v]] == 2:
+                    dualvar[v] += delta
+            for b in xrange(nvertex, 2 * nvertex):
+                if blossombase[b] >= 0 and blossomparent[b] == -1:
+                    if label[b] == 1:
+                        dualvar[b] += delta
+                    elif label[b] == 2:
+                        dualvar[b] -= delta
+
+            if deltatype == 1:
+                # The matching is as good as it gets
+                break
+            elif deltatype == 2:
+                allowedge[deltaedge] = True
+                (i, j, _) = edges[deltaedge]
+                if label[inblossom[i]] == 0:
+                    (i, j) = (j, i)
+                queue.append(i)
+            elif deltatype == 3:
+                allowedge[deltaedge] = True
+                (i, j, _) = edges[deltaedge]
+                queue.append(i)
+            elif deltatype == 4:
+                expand_blossom(deltablossom, False)
+
+        if not augmented:
+            break
+        # At the end of each stage, expand the S-blossoms whose duals
+        # are 0
+        for b in xrange(nvertex, 2 * nvertex):
+            if (blossomparent[b] == -1 and blossombase[b] >= 0 and
+                label[b] == 1 and dualvar[b] == 0):
+                expand_blossom(b, True)
+
+    return [-1 if p == -1 else endpoint[p] for p in mate]
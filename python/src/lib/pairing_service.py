@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+"""
+A pairing service that stays running on this computer.
+
+Each of the commands in src/bin starts python, reads all of the csv
+files, does its work, and exits.  The service instead keeps the data
+for each session directory (historical data, students, tutors, score
+parameters, and the historical data before each date that's been
+asked about, with its indexes) in memory, and answers the same
+questions over HTTP/JSON on localhost.  When a data file changes, the
+session is reloaded the next time it is used.
+
+Start it with:
+  python pairing_service.py [--port PORT]
+
+run_pairing, repair_pairing and score_pairing ask the service first,
+and do the work themselves if it isn't running (see
+pairing.call_service).
+
+Requests are POSTs of a JSON object to /<command>, where <command> is
+one of the keys of PairingHandler.COMMANDS.  Every request has the
+session 'directory' (the directory the commands are run from), and
+most have the attendance: 'tutors', 'student_topics' and 'date'.  A
+GET of /ping can be used to see if the service is up.
+
+A GET of /changes?directory=DIR&since=N[&type=TYPE] returns the
+changes to the session's data since sequence number N, for the web
+client (see pairing_feed).
+
+Only the session directories the service was started for are served:
+by default the directory it was started in and the session
+directories next to it, or the ones given with --directory.  Requests
+for any other directory get a 403.  Browsers say which page a request
+came from (the Origin header), and requests from pages other than the
+web client (--allow_origin) get a 403 too, so that other web pages
+can't read the rosters or start solves.  The commands in src/bin
+don't send an Origin.
+"""
+# -------------------------------------------------------
+# Imports and Constants
+#
+
+from __future__ import absolute_import, division, with_statement
+
+import BaseHTTPServer
+import json
+import logging
+import optparse
+import os.path
+import sys
+import traceback
+import urlparse
+
+import pairing
+import pairing_feed
+
+# Where web/web.js serves the web client
+DEFAULT_ORIGINS = ('http://localhost:8080', 'http://127.0.0.1:8080')
+
+# -------------------------------------------------------
+# Main + command line parsing
+#
+
+def main(*args):
+    opts = getopts(args)
+    server = BaseHTTPServer.HTTPServer((opts.host, opts.port),
+                                       PairingHandler)
+    server.sessions = {}
+    server.memory_report = opts.memory_report
+    server.directories = session_directories(opts.directory)
+    server.allow_origins = opts.allow_origin or DEFAULT_ORIGINS
+    print "Pairing service listening on {0}:{1}".format(opts.host,
+                                                        opts.port)
+    print "Serving {0}".format(', '.join(sorted(server.directories)))
+    print "Type Control-C to Exit"
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+def getopts(args=None):
+    parser = optparse.OptionParser()
+    parser.add_option('--host',
+                      default=pairing.SERVICE_HOST)
+    parser.add_option('--port',
+                      type=int,
+                      default=pairing.SERVICE_PORT)
+    parser.add_option('--directory',
+                      action='append',
+                      help='a session directory to serve (can be given '
+                      'more than once).  By default, the current directory '
+                      'and the session directories next to it.')
+    parser.add_option('--allow_origin',
+                      action='append',
+                      help='a web page origin that can use the service, '
+                      '(can be given more than once), by default: ' +
+                      ', '.join(DEFAULT_ORIGINS))
+    parser.add_option('--memory_report',
+                      action='store_true',
+                      help='after each request, show how much memory it '
+                      'used and the sizes of the main data structures')
+    parser.add_option('--log_level',
+                      help='set the log level')
+
+    (opts, args) = parser.parse_args(list(args) if len(args) > 0 else None)
+
+    if len(args) > 0:
+        raise ValueError("Did not expect to get any arguments: {0}".
+                         format(args))
+
+    if opts.log_level is not None:
+        level = getattr(logging, opts.log_level.upper())
+        logging.getLogger().setLevel(level)
+        logging.info("Setting log level to %s", level)
+
+    return opts
+
+# -------------------------------------------------------
+
+def is_session_directory(directory):
+    return any(os.path.exists(os.path.join(directory, fn))
+               for fn in (pairing.HIST_FILE, pairing.HIST_DB,
+                          pairing.HIST_MANIFEST))
+
+def session_directories(directories=None):
+    """
+    The real paths of the session directories to serve: directories,
+    or if that's None, the current directory and the session
+    directories next to it
+    """
+    if directories is None:
+        here = os.path.realpath(os.curdir)
+        parent = os.path.dirname(here)
+        directories = [here] + [
+            os.path.join(parent, fn) for fn in os.listdir(parent)
+            if is_session_directory(os.path.join(parent, fn))]
+    return set(os.path.realpath(d) for d in directories)
+
+class Forbidden(Exception):
+    """
+    A request the service won't answer, see check_origin and get_session
+    """
+    pass
+
+class SessionState(object):
+    """
+    Everything the service keeps in memory for one session directory
+    """
+    FILES = (pairing.HIST_FILE, pairing.STUDENT_FILE, pairing.TUTOR_FILE,
+             pairing.PARAM_FILE, pairing.HIST_DB, pairing.HIST_MANIFEST,
+             pairing.HIST_ARCHIVE)
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.session = os.path.basename(directory)
+        self.cache = pairing.SolveCache(os.path.join(directory,
+                                                     pairing.CACHE_FILE))
+        self.stamp = None
+        self.feed = pairing_feed.ChangeFeed(
+            os.path.join(directory, pairing_feed.FEED_FILE))
+        self.refresh()
+
+    def file_stamp(self):
+        stamp = []
+        for fn in self.FILES:
+            path = os.path.join(self.directory, fn)
+            if not os.path.exists(path):
+                stamp.append((fn, None, None))
+                continue
+            st = os.stat(path)
+            stamp.append((fn, st.st_mtime, st.st_size))
+        return tuple(stamp)
+
+    def refresh(self):
+        """
+        Reload the data files if any of them changed since we last
+        read them (for example, after save_pairing)
+        """
+        stamp = self.file_stamp()
+        if stamp == self.stamp:
+            return
+        logging.info("Loading session %s", self.directory)
+        self.data = pairing.load_session(self.directory)
+        self.stamp = stamp
+        self._hist_before = {}
+        (hist, allstds, alltuts, _) = self.data
+        self.feed.update(
+            pairing_feed.ChangeFeed.documents(hist, allstds, alltuts),
+            archived=pairing_feed.ChangeFeed.archived(hist))
+
+    def hist_before(self, date):
+        """
+        The historical data for this session before date.  This is
+        kept around, along with its data_by_key index, since every
+        command for the same week asks for it.
+        """
+        if date not in self._hist_before:
+            (hist, _, _, _) = self.data
+            before = hist.get_data_before(date, self.session)
+            before.data_by_key
+            self._hist_before[date] = before
+        return self._hist_before[date]
+
+    def data_before(self, date):
+        """
+        Like self.data, but with only the historical data before date
+        """
+        (_, allstds, alltuts, params) = self.data
+        return (self.hist_before(date), allstds, alltuts, params)
+
+class PairingHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    COMMANDS = ('solve', 'repair', 'score', 'compare')
+
+    def check_origin(self):
+        origin = self.headers.getheader('origin')
+        if origin is not None and origin not in self.server.allow_origins:
+            raise Forbidden("Requests from {0} are not allowed".format(
+                origin))
+
+    def get_session(self, directory):
+        if os.path.realpath(directory) not in self.server.directories:
+            raise Forbidden("{0} is not one of the session directories "
+                            "this service was started for".format(directory))
+        directory = os.path.realpath(directory)
+        sessions = self.server.sessions
+        if directory not in sessions:
+            sessions[directory] = SessionState(directory)
+        else:
+            sessions[directory].refresh()
+        return sessions[directory]
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        try:
+            self.check_origin()
+        except Forbidden as e:
+            self.reply(403, {'error' : str(e)})
+            return
+        if url.path.strip('/') == 'ping':
+            self.reply(200, {'ok' : True,
+                             'sessions' : sorted(self.server.sessions)})
+        elif url.path.strip('/') == 'changes':
+            try:
+                query = urlparse.parse_qs(url.query)
+                state = self.get_session(query['directory'][0])
+                reply = state.feed.changes_since(
+                    int(query.get('since', [0])[0]),
+                    doc_type=query.get('type', [None])[0])
+            except Forbidden as e:
+                self.reply(403, {'error' : str(e)})
+                return
+            except Exception:
+                logging.error(traceback.format_exc())
+                self.reply(500, {'error' : traceback.format_exc()})
+                return
+            self.reply(200, reply)
+        else:
+            self.reply(404, {'error' : "Unknown path {0}".format(self.path)})
+
+    def do_POST(self):
+        command = self.path.strip('/')
+        if command not in self.COMMANDS:
+            self.reply(404, {'error' : "Unknown command {0}".format(command)})
+            return
+        try:
+            self.check_origin()
+            length = int(self.headers.getheader('content-length'))
+            request = pairing.from_json(json.loads(self.rfile.read(length)))
+            if self.server.memory_report:
+                pairing.start_memory_report()
+            state = self.get_session(request['directory'])
+            reply = getattr(self, 'run_' + command)(state, request)
+            if self.server.memory_report:
+                print pairing.MEMORY_REPORT.report()
+        except Forbidden as e:
+            self.reply(403, {'error' : str(e)})
+            return
+        except Exception:
+            logging.error(traceback.format_exc())
+            self.reply(500, {'error' : traceback.format_exc()})
+            return
+        self.reply(200, reply)
+
+    def reply(self, code, obj):
+        body = json.dumps(obj)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        # So the web front end can call us
+        origin = self.headers.getheader('origin')
+        if origin in self.server.allow_origins:
+            self.send_header('Access-Control-Allow-Origin', origin)
+            self.send_header('Vary', 'Origin')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def run_solve(self, state, request):
+        (pairs, score, annotations) = pairing.solve_attendance(
+            state.data_before(request['date']), request['tutors'],
+            request['students'], request['student_topics'],
+            cache=state.cache, solver=request.get('solver'))
+        return {'pairing' : pairs,
+                'score' : score,
+                'annotations' : pairing.annotations_to_json(annotations)}
+
+    def run_repair(self, state, request):
+        (pairs, score, annotations, changed) = pairing.repair_attendance(
+            state.data_before(request['date']), request['tutors'],
+            request['students'], request['student_topics'],
+            [tuple(c) for c in request['current']],
+            pairing.annotations_from_json(request['annotations']))
+        return {'pairing' : pairs,
+                'score' : score,
+                'annotations' : pairing.annotations_to_json(annotations),
+                'changed' : sorted(changed)}
+
+    def run_score(self, state, request):
+        (score, annotations) = pairing.score_attendance(
+            state.data, request['tutors'], request['student_topics'],
+            [tuple(p) for p in request['pairing']])
+        return {'score' : score,
+                'annotations' : pairing.annotations_to_json(annotations)}
+
+    def run_compare(self, state, request):
+        return {'results' : pairing.compare_attendance(
+            state.data, request['tutors'], request['student_topics'],
+            [[tuple(p) for p in pairs] for pairs in request['pairings']])}
+
+    def log_message(self, format, *args):
+        logging.info("%s - %s", self.address_string(), format % args)
+
+# -------------------------------------------------------
+
+if __name__ == "__main__":
+    with pairing.run_safely():
+        main(*sys.argv[1:])
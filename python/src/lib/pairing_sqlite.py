@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+"""
+Keep the historical data, students and tutors in a sqlite database
+instead of csv files.
+
+The csv files are read into python lists in their entirety, and every
+lookup is a scan of the whole list.  The classes here have the same
+interface as HistoricalData, Students and Tutors, but they answer
+get_matches, get_pairing, get_data_before and most_recent with
+indexed queries, so an archive of many years and sites doesn't have to
+be loaded to find one week's data.  Adding data is done in a
+transaction.
+
+When data/pairing.db exists in a session directory, the commands use
+it instead of the csv files (see pairing.open_history).  To switch a
+session over, or back, run one of these from the session directory:
+
+  python pairing_sqlite.py --import_csv
+  python pairing_sqlite.py --export_csv
+"""
+# -------------------------------------------------------
+# Imports and Constants
+#
+
+from __future__ import absolute_import, division, with_statement
+
+import logging
+import optparse
+import os.path
+import sqlite3
+import sys
+
+import pairing
+
+# -------------------------------------------------------
+# Main + command line parsing
+#
+
+def main(*args):
+    opts = getopts(args)
+    if opts.import_csv:
+        import_csv(opts.directory)
+    elif opts.export_csv:
+        export_csv(opts.directory)
+
+def getopts(args=None):
+    parser = optparse.OptionParser()
+    parser.add_option('--directory',
+                      default=os.curdir,
+                      help='the session directory')
+    parser.add_option('--import_csv',
+                      action='store_true',
+                      help='copy the csv files into the database')
+    parser.add_option('--export_csv',
+                      action='store_true',
+                      help='write the csv files from the database')
+    parser.add_option('--log_level',
+                      help='set the log level')
+
+    (opts, args) = parser.parse_args(list(args) if len(args) > 0 else None)
+
+    if len(args) > 0:
+        raise ValueError("Did not expect to get any arguments: {0}".
+                         format(args))
+
+    if opts.log_level is not None:
+        level = getattr(logging, opts.log_level.upper())
+        logging.getLogger().setLevel(level)
+        logging.info("Setting log level to %s", level)
+
+    return opts
+
+def connect(filename):
+    conn = sqlite3.connect(filename)
+    # Give back strs, like the csv files do
+    conn.text_factory = str
+    return conn
+
+def import_csv(directory=os.curdir):
+    """
+    Copy the historical data, students and tutors from the csv files
+    in directory into the database, replacing anything already there.
+    """
+    conn = connect(os.path.join(directory, pairing.HIST_DB))
+    for (table_class, list_class, filename) in (
+            (SqliteHistoricalData, pairing.HistoricalData, pairing.HIST_FILE),
+            (SqliteStudents, pairing.Students, pairing.STUDENT_FILE),
+            (SqliteTutors, pairing.Tutors, pairing.TUTOR_FILE)):
+        table = table_class(conn)
+        data = list_class().from_csv(os.path.join(directory, filename))
+        with conn:
+            conn.execute('DELETE FROM {0}'.format(table.TABLE))
+            table.insert(data.data)
+        if table != data:
+            raise RuntimeError("Error importing {0}".format(filename))
+        print "Imported {0} rows from {1}".format(len(data.data), filename)
+
+def export_csv(directory=os.curdir):
+    """
+    Write the csv files in directory from the database
+    """
+    conn = connect(os.path.join(directory, pairing.HIST_DB))
+    for (table_class, filename) in ((SqliteHistoricalData, pairing.HIST_FILE),
+                                    (SqliteStudents, pairing.STUDENT_FILE),
+                                    (SqliteTutors, pairing.TUTOR_FILE)):
+        table = table_class(conn)
+        with open(os.path.join(directory, filename), 'w') as fd:
+            fd.write(table.to_csv())
+            fd.write("\n")
+        print "Exported {0} rows to {1}".format(len(table.data), filename)
+
+# -------------------------------------------------------
+
+class SqliteList(object):
+    """
+    A mixin for a CsvList whose objects are rows in a sqlite table
+    instead of a python list.  The table has a column for each field
+    of OBJ_CLASS.
+
+    self.data still works, but it reads the whole table (once, until
+    something is added), so the query methods should be used instead
+    where possible.
+    """
+    TABLE = None
+    # Each index is a tuple of column names
+    INDEXES = ()
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._data = None
+        self._data_by_key = None
+        self._digest = None
+        cls = self.OBJ_CLASS
+        columns = ', '.join(
+            '{0} {1}'.format(f, 'TEXT' if f in cls.STR_FIELDS else 'INTEGER')
+            for f in cls.FIELDS)
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS {0} ({1})'.format(
+                self.TABLE, columns))
+            for index in self.INDEXES:
+                conn.execute('CREATE INDEX IF NOT EXISTS {0}_{1} '
+                             'ON {0} ({2})'.format(self.TABLE,
+                                                   '_'.join(index),
+                                                   ', '.join(index)))
+
+    def to_obj(self, row):
+        cls = self.OBJ_CLASS
+        return cls(**dict((f, bool(v) if f in cls.BOOL_FIELDS else v)
+                          for (f, v) in zip(cls.FIELDS, row)))
+
+    def query(self, where='', args=(), order='rowid'):
+        """
+        Return the objects for the rows matching the where clause, in
+        the order they were added unless order says otherwise.
+        """
+        sql = 'SELECT {0} FROM {1}'.format(', '.join(self.OBJ_CLASS.FIELDS),
+                                           self.TABLE)
+        if where:
+            sql += ' WHERE ' + where
+        sql += ' ORDER BY ' + order
+        return [self.to_obj(row) for row in self.conn.execute(sql, args)]
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = self.query()
+        return self._data
+
+    def insert(self, obj_list):
+        fields = self.OBJ_CLASS.FIELDS
+        self.conn.executemany(
+            'INSERT INTO {0} ({1}) VALUES ({2})'.format(
+                self.TABLE, ', '.join(fields), ', '.join('?' for f in fields)),
+            [tuple(getattr(obj, f) for f in fields) for obj in obj_list])
+        self._data = None
+        self._data_by_key = None
+        self._digest = None
+        self.features = None
+
+    def add(self, obj):
+        self.add_list([obj])
+
+    def add_list(self, obj_list):
+        """
+        Add all of obj_list in one transaction
+        """
+        with self.conn:
+            self.insert(obj_list)
+
+    def get_matches(self, **kwargs):
+        for fld in kwargs:
+            if fld not in self.OBJ_CLASS.FIELDS:
+                raise ValueError("Invalid field {0}, must be one of {1}".
+                                 format(fld, self.OBJ_CLASS.FIELDS))
+        return self.query(' AND '.join('{0} = ?'.format(f) for f in kwargs),
+                          tuple(kwargs.values()))
+
+class SqliteHistoricalData(SqliteList, pairing.HistoricalData):
+    TABLE = 'pairs'
+    INDEXES = (('session', 'date'), ('tutor', 'student'), ('student',))
+
+    def __init__(self, conn):
+        SqliteList.__init__(self, conn)
+
+    def get_matches(self,
+                    tutor=None,
+                    student=None,
+                    date=None,
+                    session=None):
+        kwargs = dict((k, v) for (k, v) in (('tutor', tutor),
+                                            ('student', student),
+                                            ('date', date),
+                                            ('session', session))
+                      if v is not None)
+        return SqliteList.get_matches(self, **kwargs)
+
+    def get_pairing(self, date, session):
+        pairs = self.get_matches(date=date, session=session)
+        pairing = [(d.tutor, d.student) for d in pairs]
+        student_topics = dict((d.student, d.topic) for d in pairs)
+        return (pairing, student_topics)
+
+    def get_data_before(self, date, session):
+        """
+        Unlike the rest of this class, this returns an ordinary
+        HistoricalData, since that's what gets used for scoring.
+        """
+        return pairing.HistoricalData(
+            self.query('session = ? AND date < ?', (session, date)))
+
+    @property
+    def all_students(self):
+        return [row[0] for row in self.conn.execute(
+            'SELECT DISTINCT student FROM pairs ORDER BY student')]
+
+    @property
+    def all_tutors(self):
+        return [row[0] for row in self.conn.execute(
+            'SELECT DISTINCT tutor FROM pairs ORDER BY tutor')]
+
+    @property
+    def all_dates(self):
+        return [row[0] for row in self.conn.execute(
+            'SELECT DISTINCT date FROM pairs ORDER BY date')]
+
+    def most_recent(self, by_student=False, by_tutor=False, date=None,
+                    criteria=None):
+        if not by_student and not by_tutor:
+            return pairing.HistoricalData.most_recent(
+                self, date=date, criteria=criteria)
+        key = 'student' if by_student else 'tutor'
+        before = '' if date is None else 'AND last.date < ?'
+        args = () if date is None else (date,)
+        # Just the rows from the last date for each key.  Sorting by
+        # date then rowid means that, like in HistoricalData, the last
+        # of those rows wins.
+        recent = {}
+        for pair in self.query(
+                'date = (SELECT MAX(date) FROM pairs AS last '
+                'WHERE last.{0} = pairs.{0} {1})'.format(key, before),
+                args, order='date, rowid'):
+            recent[getattr(pair, key)] = pair
+        return recent
+
+    def validate(self, students, tutors):
+        valid = True
+        for tutor in self.all_tutors:
+            if tutor not in tutors.data_by_key:
+                for pair in self.get_matches(tutor=tutor):
+                    print "Invalid Tutor in {0}".format(pair)
+                pairing.suggest(tutor, tutors.data_by_key)
+                valid = False
+        for student in self.all_students:
+            if student not in students.data_by_key:
+                for pair in self.get_matches(student=student):
+                    print "Invalid Student in {0}".format(pair)
+                pairing.suggest(student, students.data_by_key)
+                valid = False
+        if not valid:
+            raise ValueError("Errors in historical data, aborting.")
+
+class SqliteStudents(SqliteList, pairing.Students):
+    TABLE = 'students'
+    INDEXES = (('name',),)
+
+    def __init__(self, conn):
+        SqliteList.__init__(self, conn)
+
+class SqliteTutors(SqliteList, pairing.Tutors):
+    TABLE = 'tutors'
+    INDEXES = (('full_name',),)
+
+    def __init__(self, conn):
+        SqliteList.__init__(self, conn)
+
+# -------------------------------------------------------
+
+if __name__ == "__main__":
+    with pairing.run_safely(spin=False):
+        main(*sys.argv[1:])
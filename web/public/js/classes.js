@@ -83,6 +83,45 @@ function DbTable(dbname, $scope)
 	this.cancels = []
     }
 
+    /*-------------------  Pairing service change feed ------------------*/
+
+    // Pull the changes to this table from the local pairing service
+    // (see python/src/lib/pairing_feed.py) since the last pull.
+    // doc_type is student, tutor or pairing.
+    var pairing_service = 'http://localhost:8473/changes';
+
+    this.pull = function(directory, doc_type, $scope) {
+	var seq_key = 'last_seq:' + dbname;
+	var since = localStorage.getItem(seq_key) || 0;
+	var xhr = new XMLHttpRequest();
+	xhr.open('GET', pairing_service
+		 + '?directory=' + encodeURIComponent(directory)
+		 + '&type=' + doc_type + '&since=' + since);
+	xhr.onload = function() {
+	    var feed = JSON.parse(xhr.responseText);
+	    if (xhr.status != 200) {
+		console.log("Error pulling changes");
+		console.log(feed.error);
+		return;
+	    }
+	    var docs = [];
+	    for (var ii = 0; ii < feed.results.length; ii++) {
+		docs.push(feed.results[ii].doc);
+	    }
+	    dbtable.db.bulkDocs({docs: docs, new_edits: false},
+				function(err, response) {
+		if (err) {
+		    console.log("Error saving changes");
+		    console.log(err);
+		} else {
+		    localStorage.setItem(seq_key, feed.last_seq);
+		    dbtable.refresh(dbtable.db, $scope);
+		}
+	    });
+	}
+	xhr.send();
+    }
+
     this.refresh = function(db, $scope) {
 	db.allDocs(function(err, response) {
 	    if (err) {